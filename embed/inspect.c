@@ -1,13 +1,48 @@
 #define _GNU_SOURCE
 #include <arpa/inet.h>
 #include <dlfcn.h>
+#include <errno.h>
+#include <netinet/tcp.h>
 #include <pthread.h>
 #include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/epoll.h>
+#include <sys/uio.h>
+#include <time.h>
 #include <unistd.h>
 
+// Build with -DINSPECT_LOG=1 to print every command, printing costs more than handling most commands
+#ifndef INSPECT_LOG
+#define INSPECT_LOG 0
+#endif
+#define inspect_log(...)                                                                                               \
+    do {                                                                                                               \
+        if (INSPECT_LOG) printf(__VA_ARGS__);                                                                          \
+    } while (0)
+
+// Clients served at the same time, further connections are closed right away
+#ifndef INSPECT_MAX_CLIENTS
+#define INSPECT_MAX_CLIENTS 8
+#endif
+
+// Replies that are not sent yet, a client that sends more requests without reading the replies has to wait
+#define INSPECT_OUTPUT_LIMIT (256 * 1024)
+
+// Largest single reply and largest amount of replies handled at once, a client that asks for more is disconnected
+#ifndef INSPECT_MAX_REPLY
+#define INSPECT_MAX_REPLY (16 * 1024 * 1024)
+#endif
+#define INSPECT_MAX_OUTPUT (64 * 1024 * 1024)
+
+// Ranges per client whose last compressed read is kept, the next read of the same range is sent as a delta
+#define INSPECT_BASE_SLOTS 8
+
+// Watched ranges per client, and the shortest time between two checks of one range
+#define INSPECT_MAX_SUBSCRIPTIONS 16
+#define INSPECT_MIN_INTERVAL_US 1000
+
 static unsigned int DEBUG_DATA[1024] = {
     0x452307a1,         // magic 1
     0x4cae5cf0,         // magic 2
@@ -15,6 +50,808 @@ static unsigned int DEBUG_DATA[1024] = {
     0,                  // used size
 };
 
+// Reply to the features command, the magic value is odd so it never matches the reply to an info command
+#define INSPECT_FEATURES_MAGIC 0x3ba7f0e1
+
+// Optional commands supported by this server
+#define INSPECT_FEATURE_READ_MANY (1 << 0)
+#define INSPECT_FEATURE_CHECKSUM (1 << 2)
+#define INSPECT_FEATURE_SAMPLE (1 << 3)
+#define INSPECT_FEATURE_SUBSCRIBE (1 << 4)
+#define INSPECT_FEATURE_COMPRESSED_READ (1 << 5)
+#define INSPECT_FEATURES                                                                                               \
+    (INSPECT_FEATURE_READ_MANY | INSPECT_FEATURE_CHECKSUM | INSPECT_FEATURE_SAMPLE | INSPECT_FEATURE_SUBSCRIBE |           \
+     INSPECT_FEATURE_COMPRESSED_READ)
+
+// Ring buffer for samples, every record holds a timestamp followed by the data of all sampled ranges
+#ifndef INSPECT_SAMPLE_BUFFER_SIZE
+#define INSPECT_SAMPLE_BUFFER_SIZE (64 * 1024)
+#endif
+#define INSPECT_SAMPLE_MAX_RANGES 32
+
+// Target memory is copied through the kernel, an address that is not mapped or not writable fails with EFAULT
+// instead of crashing the target. Returns 0 when all bytes were copied.
+static int inspect_peek(void *dst, const void *addr, uint64_t size) {
+    struct iovec local = {.iov_base = dst, .iov_len = size};
+    struct iovec remote = {.iov_base = (void *)addr, .iov_len = size};
+    return size == 0 || process_vm_readv(getpid(), &local, 1, &remote, 1, 0) == (ssize_t)size ? 0 : -1;
+}
+
+static int inspect_poke(void *addr, const void *src, uint64_t size) {
+    struct iovec local = {.iov_base = (void *)src, .iov_len = size};
+    struct iovec remote = {.iov_base = addr, .iov_len = size};
+    return size == 0 || process_vm_writev(getpid(), &local, 1, &remote, 1, 0) == (ssize_t)size ? 0 : -1;
+}
+
+// Returns 0 when the whole range can be read
+static int inspect_check_readable(const unsigned char *addr, uint64_t size) {
+    unsigned char buffer[4096];
+    while (size > 0) {
+        uint64_t n = size < sizeof(buffer) ? size : sizeof(buffer);
+        if (inspect_peek(buffer, addr, n) < 0) return -1;
+        addr += n;
+        size -= n;
+    }
+    return 0;
+}
+
+// Adler-32, cheap enough to run over every polled block. Continues from sum, which is 1 for new data.
+static uint32_t inspect_adler32(uint32_t sum, const unsigned char *data, uint64_t size) {
+    uint32_t a = sum & 0xffff, b = sum >> 16;
+    while (size > 0) {
+        // The sums can not overflow within 5552 bytes
+        uint64_t n = size < 5552 ? size : 5552;
+        size -= n;
+        while (n--) {
+            a += *data++;
+            b += a;
+        }
+        a %= 65521;
+        b %= 65521;
+    }
+    return (b << 16) | a;
+}
+
+// Checksum of a block that can not be read, the low half of an Adler-32 is always below 65521
+#define INSPECT_CHECKSUM_ERROR 0xffffffff
+
+static uint32_t inspect_checksum(const unsigned char *addr, uint64_t size) {
+    unsigned char buffer[4096];
+    uint32_t sum = 1;
+    while (size > 0) {
+        uint64_t n = size < sizeof(buffer) ? size : sizeof(buffer);
+        if (inspect_peek(buffer, addr, n) < 0) return INSPECT_CHECKSUM_ERROR;
+        sum = inspect_adler32(sum, buffer, n);
+        addr += n;
+        size -= n;
+    }
+    return sum;
+}
+
+struct inspect_client;
+
+static struct {
+    pthread_mutex_t lock;
+    pthread_cond_t started;
+
+    // Client that configured the sampling, other clients can not change it until the owner stops or disconnects
+    struct inspect_client *owner;
+
+    // Sampled ranges, record_size is 0 when sampling is off
+    uint32_t range_count;
+    const unsigned char *range_addr[INSPECT_SAMPLE_MAX_RANGES];
+    uint64_t range_size[INSPECT_SAMPLE_MAX_RANGES];
+    uint32_t record_size;
+    uint32_t capacity;
+
+    // Microseconds between samples taken by the sample thread, 0 to only sample on inspect_sample()
+    uint32_t period_us;
+
+    // Number of records written and drained since sampling was configured
+    uint64_t written;
+    uint64_t drained;
+
+    unsigned char buffer[INSPECT_SAMPLE_BUFFER_SIZE];
+} inspect_sampler = {.lock = PTHREAD_MUTEX_INITIALIZER, .started = PTHREAD_COND_INITIALIZER};
+
+static uint64_t inspect_time_ns(void) {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (uint64_t)now.tv_sec * 1000000000 + now.tv_nsec;
+}
+
+// Copy all sampled ranges into the ring buffer, the oldest record is overwritten when it is full.
+// The ranges were checked to be readable when sampling was configured, so they are copied directly.
+void inspect_sample(void) {
+    uint64_t time = inspect_time_ns();
+    pthread_mutex_lock(&inspect_sampler.lock);
+    if (inspect_sampler.record_size) {
+        unsigned char *record = inspect_sampler.buffer + (inspect_sampler.written % inspect_sampler.capacity) * inspect_sampler.record_size;
+        memcpy(record, &time, sizeof(time));
+        record += sizeof(time);
+        for (uint32_t i = 0; i < inspect_sampler.range_count; ++i) {
+            memcpy(record, inspect_sampler.range_addr[i], inspect_sampler.range_size[i]);
+            record += inspect_sampler.range_size[i];
+        }
+        inspect_sampler.written++;
+    }
+    pthread_mutex_unlock(&inspect_sampler.lock);
+}
+
+// Takes a sample every period, waits while there is no period
+static void *inspect_sample_thread(void *arg) {
+    (void)arg;
+    uint64_t next = 0;
+    for (;;) {
+        pthread_mutex_lock(&inspect_sampler.lock);
+        if (!inspect_sampler.period_us) {
+            while (!inspect_sampler.period_us) pthread_cond_wait(&inspect_sampler.started, &inspect_sampler.lock);
+            next = 0;
+        }
+        uint64_t period = (uint64_t)inspect_sampler.period_us * 1000;
+        pthread_mutex_unlock(&inspect_sampler.lock);
+
+        // Sleep until an absolute time so the samples do not drift, ticks that were missed are skipped
+        uint64_t now = inspect_time_ns();
+        next = next ? next + period : now + period;
+        if (next <= now) next += ((now - next) / period + 1) * period;
+        struct timespec deadline = {.tv_sec = next / 1000000000, .tv_nsec = next % 1000000000};
+        while (clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, &deadline, 0) == EINTR) {
+        }
+        inspect_sample();
+    }
+    return 0;
+}
+
+// Encodings of a compressed read
+#define INSPECT_ENCODING_RAW 0
+#define INSPECT_ENCODING_RLE 1
+#define INSPECT_ENCODING_DELTA 2
+#define INSPECT_ENCODING_ERROR 3
+
+static size_t inspect_put_varint(unsigned char *out, size_t pos, size_t cap, uint64_t value) {
+    do {
+        if (pos >= cap) return cap + 1;
+        out[pos++] = (value & 0x7f) | (value > 0x7f ? 0x80 : 0);
+        value >>= 7;
+    } while (value);
+    return pos;
+}
+
+// Run-length encoding of data, or of data XOR base when there is a base.
+// Every token starts with a varint, bit 0 is set for a run of one repeated byte and clear for literal bytes,
+// the other bits hold the length. Returns the encoded size, 0 when it is not smaller than the data.
+static size_t inspect_rle(unsigned char *out, const unsigned char *data, const unsigned char *base, size_t size) {
+#define INSPECT_BYTE(i) (base ? data[i] ^ base[i] : data[i])
+    size_t cap = size ? size - 1 : 0;
+    size_t pos = 0, literal = 0, n = 0;
+    while (pos <= size) {
+        size_t run = 0;
+        unsigned char value = 0;
+        if (pos < size) {
+            value = INSPECT_BYTE(pos);
+            run = 1;
+            while (pos + run < size && INSPECT_BYTE(pos + run) == value) run++;
+            if (run < 4) {
+                pos += run;
+                continue;
+            }
+        }
+
+        // Literal bytes before the run, or before the end
+        if (literal < pos) {
+            n = inspect_put_varint(out, n, cap, (uint64_t)(pos - literal) << 1);
+            if (n + pos - literal > cap) return 0;
+            for (size_t i = literal; i < pos; ++i) out[n++] = INSPECT_BYTE(i);
+        }
+        if (!run) break;
+
+        n = inspect_put_varint(out, n, cap, (uint64_t)run << 1 | 1);
+        if (n >= cap) return 0;
+        out[n++] = value;
+        pos += run;
+        literal = pos;
+    }
+    return n;
+#undef INSPECT_BYTE
+}
+
+struct inspect_base {
+    const unsigned char *addr;
+    uint64_t size;
+    uint64_t used;
+    unsigned char *data;
+};
+
+struct inspect_subscription {
+    uint32_t id;
+    const unsigned char *addr;
+    uint64_t size;
+    uint64_t interval_ns;
+    uint64_t next_check;
+
+    // Data of the last notification, followed by room for the current data
+    unsigned char *last;
+};
+
+struct inspect_client {
+    int fd;
+
+    // Received bytes that do not form a complete command yet, the largest command header is 25 bytes
+    unsigned char input[4096];
+    size_t input_size;
+
+    // Data of a write command that is still coming, it goes straight into memory.
+    // The rest of the data is dropped after a part could not be written.
+    unsigned char *write_addr;
+    uint64_t write_size;
+    int write_failed;
+
+    // Set when the client asked for more than the server can reply, the client is disconnected
+    int failed;
+
+    // Ranges of a read many command that are still coming
+    uint32_t read_many_count;
+
+    // Sample command of which ranges are still coming, the ranges are used after the last one arrived.
+    // The bytes of rejected ranges are skipped.
+    uint32_t sample_count;
+    uint32_t sample_received;
+    uint32_t sample_period_us;
+    const unsigned char *sample_addr[INSPECT_SAMPLE_MAX_RANGES];
+    uint64_t sample_size[INSPECT_SAMPLE_MAX_RANGES];
+    uint64_t skip_size;
+
+    // Replies of all handled commands, sent together
+    unsigned char *output;
+    size_t output_size;
+    size_t output_sent;
+    size_t output_cap;
+
+    // Events the client is waiting for
+    uint32_t events;
+
+    // Last compressed read of some ranges, and a buffer for the next one
+    struct inspect_base bases[INSPECT_BASE_SLOTS];
+    uint64_t base_clock;
+    unsigned char *scratch;
+    uint64_t scratch_size;
+
+    // Watched ranges, a client with subscriptions only receives notifications
+    struct inspect_subscription subscriptions[INSPECT_MAX_SUBSCRIPTIONS];
+    uint32_t subscription_count;
+};
+
+static struct inspect_client inspect_clients[INSPECT_MAX_CLIENTS];
+
+// Room for a reply of size bytes at the end of the output, 0 when the reply is too large and the client failed
+static void *inspect_reply_space(struct inspect_client *client, uint64_t size) {
+    if (client->failed || size > INSPECT_MAX_REPLY || client->output_size + size > INSPECT_MAX_OUTPUT) {
+        client->failed = 1;
+        return 0;
+    }
+    if (client->output_size + size > client->output_cap) {
+        size_t cap = client->output_cap ? client->output_cap : 4096;
+        while (cap < client->output_size + size) cap *= 2;
+        unsigned char *output = realloc(client->output, cap);
+        if (!output) {
+            client->failed = 1;
+            return 0;
+        }
+        client->output = output;
+        client->output_cap = cap;
+    }
+    void *reply = client->output + client->output_size;
+    client->output_size += size;
+    return reply;
+}
+
+static void inspect_reply(struct inspect_client *client, const void *data, size_t size) {
+    void *reply = inspect_reply_space(client, size);
+    if (reply) memcpy(reply, data, size);
+}
+
+// Reply with target memory. Unreadable memory is sent as zeros, so the replies that follow stay in place.
+static void inspect_reply_memory(struct inspect_client *client, const void *addr, uint64_t size) {
+    void *reply = inspect_reply_space(client, size);
+    if (reply && inspect_peek(reply, addr, size) < 0) {
+        inspect_log("unreadable %p %lu\n", addr, size);
+        memset(reply, 0, size);
+    }
+}
+
+// Notifications start with the subscription id, the data size and the time, a size of 0 means the subscription failed
+static void inspect_notify(struct inspect_client *client, uint32_t id, const void *data, uint32_t size, uint64_t time) {
+    uint32_t header[4] = {id, size, (uint32_t)time, (uint32_t)(time >> 32)};
+    inspect_reply(client, header, sizeof(header));
+    if (size) inspect_reply(client, data, size);
+}
+
+static struct inspect_subscription *inspect_find_subscription(struct inspect_client *client, uint32_t id) {
+    for (uint32_t i = 0; i < client->subscription_count; ++i) {
+        if (client->subscriptions[i].id == id) return &client->subscriptions[i];
+    }
+    return 0;
+}
+
+static void inspect_remove_subscription(struct inspect_client *client, struct inspect_subscription *sub) {
+    free(sub->last);
+    *sub = client->subscriptions[--client->subscription_count];
+    memset(&client->subscriptions[client->subscription_count], 0, sizeof(*sub));
+}
+
+// Notify the subscriptions that are due and changed, returns the time of the next check
+static uint64_t inspect_check_subscriptions(struct inspect_client *client, uint64_t now) {
+    uint64_t next = UINT64_MAX;
+    for (uint32_t i = 0; i < client->subscription_count; ++i) {
+        struct inspect_subscription *sub = &client->subscriptions[i];
+        if (now >= sub->next_check) {
+            // A client that does not take its notifications gets the latest data later
+            if (client->output_size - client->output_sent < INSPECT_OUTPUT_LIMIT) {
+                unsigned char *current = sub->last + sub->size;
+                if (inspect_peek(current, sub->addr, sub->size) < 0) {
+                    // The range can not be read anymore, the empty notification ends the subscription
+                    inspect_notify(client, sub->id, 0, 0, now);
+                    inspect_remove_subscription(client, sub);
+                    --i;
+                    continue;
+                }
+                if (memcmp(sub->last, current, sub->size)) {
+                    memcpy(sub->last, current, sub->size);
+                    inspect_notify(client, sub->id, sub->last, sub->size, now);
+                }
+            }
+            sub->next_check = now + sub->interval_ns;
+        }
+        if (sub->next_check < next) next = sub->next_check;
+    }
+    return next;
+}
+
+// Send a range compressed, as a delta to its previous compressed read when both sides still have it
+static void inspect_read_compressed(struct inspect_client *client, const unsigned char *addr, uint64_t size, int host_has_base) {
+    if (size > INSPECT_MAX_REPLY) {
+        client->failed = 1;
+        return;
+    }
+
+    // Take a snapshot first, the memory can change while it is encoded.
+    // Memory that can not be read, or no room for the snapshot, is an error without data.
+    if (client->scratch_size < size) {
+        unsigned char *scratch = realloc(client->scratch, size);
+        if (scratch) {
+            client->scratch = scratch;
+            client->scratch_size = size;
+        }
+    }
+    if (client->scratch_size < size || inspect_peek(client->scratch, addr, size) < 0) {
+        inspect_log("unreadable %p %lu\n", (void *)addr, size);
+        unsigned char reply[5] = {INSPECT_ENCODING_ERROR};
+        inspect_reply(client, reply, sizeof(reply));
+        return;
+    }
+
+    // Find the previous read of this range, or the least recently used slot
+    struct inspect_base *base = &client->bases[0];
+    int found = 0;
+    for (int i = 0; i < INSPECT_BASE_SLOTS; ++i) {
+        struct inspect_base *slot = &client->bases[i];
+        if (slot->data && slot->addr == addr && slot->size == size) {
+            base = slot;
+            found = 1;
+            break;
+        }
+        if (slot->used < base->used) base = slot;
+    }
+
+    size_t start = client->output_size;
+    unsigned char *reply = inspect_reply_space(client, 5 + size);
+    if (!reply) return;
+    uint8_t encoding = INSPECT_ENCODING_DELTA;
+    size_t length = found && host_has_base ? inspect_rle(reply + 5, client->scratch, base->data, size) : 0;
+    if (!length) {
+        encoding = INSPECT_ENCODING_RLE;
+        length = inspect_rle(reply + 5, client->scratch, 0, size);
+    }
+    if (!length) {
+        encoding = INSPECT_ENCODING_RAW;
+        length = size;
+        memcpy(reply + 5, client->scratch, size);
+    }
+    uint32_t length32 = length;
+    reply[0] = encoding;
+    memcpy(reply + 1, &length32, 4);
+    client->output_size = start + 5 + length;
+
+    // The snapshot becomes the base of the next read, the old base becomes the next snapshot buffer
+    unsigned char *old = base->data;
+    uint64_t old_size = found ? size : 0;
+    base->addr = addr;
+    base->size = size;
+    base->used = ++client->base_clock;
+    base->data = client->scratch;
+    client->scratch = old;
+    client->scratch_size = old_size;
+    if (!found) {
+        free(old);
+        client->scratch = 0;
+    }
+}
+
+// Stop sampling when it belongs to client
+static void inspect_sample_release(struct inspect_client *client) {
+    pthread_mutex_lock(&inspect_sampler.lock);
+    if (inspect_sampler.owner == client) {
+        inspect_sampler.owner = 0;
+        inspect_sampler.record_size = 0;
+        inspect_sampler.capacity = 0;
+        inspect_sampler.period_us = 0;
+    }
+    pthread_mutex_unlock(&inspect_sampler.lock);
+}
+
+// Start sampling with the received ranges of client, replies with the record size and the number of records that fit.
+// Sampling stops when a range does not fit or can not be read, or when there are no ranges.
+// While another client is sampling the command is rejected and its sampling continues.
+static void inspect_sample_configure(struct inspect_client *client) {
+    uint32_t count = client->sample_received;
+    uint64_t record_size = sizeof(uint64_t);
+    for (uint32_t i = 0; i < count && record_size; ++i) {
+        uint64_t size = client->sample_size[i];
+        if (size > INSPECT_SAMPLE_BUFFER_SIZE || inspect_check_readable(client->sample_addr[i], size) < 0) {
+            inspect_log("sample range %p %lu rejected\n", (void *)client->sample_addr[i], size);
+            record_size = 0;
+        } else {
+            record_size += size;
+        }
+    }
+    if (!count || record_size > INSPECT_SAMPLE_BUFFER_SIZE) record_size = 0;
+
+    uint32_t response[2] = {0, 0};
+    pthread_mutex_lock(&inspect_sampler.lock);
+    if (inspect_sampler.owner && inspect_sampler.owner != client) {
+        inspect_log("sample rejected, another client is sampling\n");
+    } else {
+        inspect_sampler.owner = record_size ? client : 0;
+        inspect_sampler.range_count = record_size ? count : 0;
+        memcpy(inspect_sampler.range_addr, client->sample_addr, count * sizeof(client->sample_addr[0]));
+        memcpy(inspect_sampler.range_size, client->sample_size, count * sizeof(client->sample_size[0]));
+        inspect_sampler.record_size = record_size;
+        inspect_sampler.capacity = record_size ? INSPECT_SAMPLE_BUFFER_SIZE / record_size : 0;
+        inspect_sampler.written = 0;
+        inspect_sampler.drained = 0;
+        inspect_sampler.period_us = record_size ? client->sample_period_us : 0;
+        pthread_cond_signal(&inspect_sampler.started);
+        response[0] = record_size;
+        response[1] = inspect_sampler.capacity;
+    }
+    pthread_mutex_unlock(&inspect_sampler.lock);
+    inspect_reply(client, response, sizeof(response));
+}
+
+// Handle the start of the received data, returns the number of bytes used or 0 when more data is needed
+static size_t inspect_handle(struct inspect_client *client, const unsigned char *data, size_t size) {
+    uint64_t args[3];
+
+    // Data of a write command
+    if (client->write_size) {
+        size_t n = size < client->write_size ? size : client->write_size;
+        if (!client->write_failed && inspect_poke(client->write_addr, data, n) < 0) {
+            inspect_log("unwritable %p %lu\n", (void *)client->write_addr, (uint64_t)n);
+            client->write_failed = 1;
+        }
+        client->write_addr += n;
+        client->write_size -= n;
+        return n;
+    }
+
+    // Ranges of a rejected sample command
+    if (client->skip_size) {
+        size_t n = size < client->skip_size ? size : client->skip_size;
+        client->skip_size -= n;
+        return n;
+    }
+
+    // Next range of a sample command, the new configuration is used after the last range
+    if (client->sample_count) {
+        if (size < 16) return 0;
+        memcpy(args, data, 16);
+        uint32_t i = client->sample_received++;
+        client->sample_addr[i] = (const unsigned char *)args[0];
+        client->sample_size[i] = args[1];
+        if (!--client->sample_count) inspect_sample_configure(client);
+        return 16;
+    }
+
+    // Next range of a read many command
+    if (client->read_many_count) {
+        if (size < 16) return 0;
+        memcpy(args, data, 16);
+        inspect_reply_memory(client, (void *)args[0], args[1]);
+        client->read_many_count--;
+        return 16;
+    }
+
+    // Info command
+    if (data[0] == 0) {
+        void *response = (void *)DEBUG_DATA;
+        inspect_reply(client, &response, sizeof(response));
+        return 1;
+    }
+
+    // Read data
+    if (data[0] == 1) {
+        if (size < 17) return 0;
+        memcpy(args, data + 1, 16);
+        inspect_log("read %p %lu\n", (void *)args[0], args[1]);
+        inspect_reply_memory(client, (void *)args[0], args[1]);
+        return 17;
+    }
+
+    // Write data, the data follows the command
+    if (data[0] == 2) {
+        if (size < 17) return 0;
+        memcpy(args, data + 1, 16);
+        inspect_log("write %p %lu\n", (void *)args[0], args[1]);
+        client->write_addr = (unsigned char *)args[0];
+        client->write_size = args[1];
+        client->write_failed = 0;
+        return 17;
+    }
+
+    // Features command
+    if (data[0] == 3) {
+        uint32_t response[2] = {INSPECT_FEATURES_MAGIC, INSPECT_FEATURES};
+        inspect_reply(client, response, sizeof(response));
+        return 1;
+    }
+
+    // Read multiple ranges, the data is sent back to back
+    if (data[0] == 4) {
+        if (size < 5) return 0;
+        memcpy(&client->read_many_count, data + 1, 4);
+        inspect_log("read_many %u\n", client->read_many_count);
+        return 5;
+    }
+
+    // Checksum of every block of a range, the last block can be shorter
+    if (data[0] == 7) {
+        if (size < 25) return 0;
+        memcpy(args, data + 1, 24);
+        inspect_log("checksum %p %lu %lu\n", (void *)args[0], args[1], args[2]);
+        const unsigned char *addr = (const unsigned char *)args[0];
+        uint64_t left = args[1];
+        uint64_t block_size = args[2] ? args[2] : left;
+        uint64_t count = left ? left / block_size + (left % block_size != 0) : 0;
+        uint32_t *sums = inspect_reply_space(client, count < INSPECT_MAX_REPLY ? count * sizeof(uint32_t) : INSPECT_MAX_REPLY + 1);
+        if (!sums) return 25;
+        while (left > 0) {
+            uint64_t n = left < block_size ? left : block_size;
+            *sums++ = inspect_checksum(addr, n);
+            addr += n;
+            left -= n;
+        }
+        return 25;
+    }
+
+    // Configure sampling, the period and number of ranges are followed by the ranges
+    if (data[0] == 8) {
+        if (size < 9) return 0;
+        uint32_t header[2];
+        memcpy(header, data + 1, 8);
+        inspect_log("sample %u %u\n", header[0], header[1]);
+        // The current sampling continues until all ranges are received
+        client->sample_period_us = header[0];
+        client->sample_received = 0;
+        if (header[1] > INSPECT_SAMPLE_MAX_RANGES) {
+            client->skip_size = (uint64_t)header[1] * 16;
+            inspect_sample_configure(client);
+            return 9;
+        }
+        client->sample_count = header[1];
+        if (!client->sample_count) inspect_sample_configure(client);
+        return 9;
+    }
+
+    // Send the oldest samples that were not drained yet
+    if (data[0] == 9) {
+        if (size < 5) return 0;
+        uint32_t max_count;
+        memcpy(&max_count, data + 1, 4);
+        pthread_mutex_lock(&inspect_sampler.lock);
+        // Records that were overwritten are lost, the host sees the gap in the sequence number
+        if (inspect_sampler.written - inspect_sampler.drained > inspect_sampler.capacity) {
+            inspect_sampler.drained = inspect_sampler.written - inspect_sampler.capacity;
+        }
+        uint64_t first = inspect_sampler.drained;
+        uint32_t count = inspect_sampler.written - first < max_count ? inspect_sampler.written - first : max_count;
+        // Only the client that configured the sampling receives the samples
+        if (inspect_sampler.owner != client) first = count = 0;
+        inspect_reply(client, &first, sizeof(first));
+        inspect_reply(client, &count, sizeof(count));
+        for (uint32_t i = 0; i < count; ++i) {
+            const unsigned char *record = inspect_sampler.buffer + ((first + i) % inspect_sampler.capacity) * inspect_sampler.record_size;
+            inspect_reply(client, record, inspect_sampler.record_size);
+        }
+        inspect_sampler.drained += count;
+        pthread_mutex_unlock(&inspect_sampler.lock);
+        return 5;
+    }
+
+    // Read data compressed, the flag tells if the host still has the previous compressed read of this range
+    if (data[0] == 12) {
+        if (size < 18) return 0;
+        memcpy(args, data + 1, 16);
+        inspect_log("read_compressed %p %lu %u\n", (void *)args[0], args[1], data[17]);
+        inspect_read_compressed(client, (const unsigned char *)args[0], args[1], data[17] & 1);
+        return 18;
+    }
+
+    // Subscribe to changes of a range, the current data is sent right away
+    if (data[0] == 10) {
+        if (size < 25) return 0;
+        uint32_t id, interval_us;
+        memcpy(&id, data + 1, 4);
+        memcpy(args, data + 5, 16);
+        memcpy(&interval_us, data + 21, 4);
+        inspect_log("subscribe %u %p %lu %u\n", id, (void *)args[0], args[1], interval_us);
+
+        uint64_t now = inspect_time_ns();
+        struct inspect_subscription *sub = inspect_find_subscription(client, id);
+        if (!sub && client->subscription_count < INSPECT_MAX_SUBSCRIPTIONS) {
+            sub = &client->subscriptions[client->subscription_count++];
+            sub->id = id;
+        }
+
+        // The range has to be readable now, a failed subscription is removed
+        unsigned char *last = sub && args[1] && args[1] <= INSPECT_MAX_REPLY ? realloc(sub->last, 2 * args[1]) : 0;
+        if (last) sub->last = last;
+        if (!last || inspect_peek(last, (const void *)args[0], args[1]) < 0) {
+            if (sub) inspect_remove_subscription(client, sub);
+            inspect_notify(client, id, 0, 0, now);
+            return 25;
+        }
+
+        sub->addr = (const unsigned char *)args[0];
+        sub->size = args[1];
+        sub->interval_ns = (uint64_t)(interval_us > INSPECT_MIN_INTERVAL_US ? interval_us : INSPECT_MIN_INTERVAL_US) * 1000;
+        inspect_notify(client, id, sub->last, sub->size, now);
+        sub->next_check = now + sub->interval_ns;
+        return 25;
+    }
+
+    // Stop notifications of a subscription
+    if (data[0] == 11) {
+        if (size < 5) return 0;
+        uint32_t id;
+        memcpy(&id, data + 1, 4);
+        inspect_log("unsubscribe %u\n", id);
+        struct inspect_subscription *sub = inspect_find_subscription(client, id);
+        if (sub) inspect_remove_subscription(client, sub);
+        return 5;
+    }
+
+    // Unknown commands are ignored
+    return 1;
+}
+
+// Receive and handle everything that arrived, returns -1 when the client is gone
+static int inspect_receive(struct inspect_client *client) {
+    while (client->output_size - client->output_sent < INSPECT_OUTPUT_LIMIT) {
+        ssize_t n;
+        if (client->write_size && !client->write_failed && client->input_size == 0) {
+            // Large writes are received straight into memory, memory that is not writable fails without receiving anything
+            n = recv(client->fd, client->write_addr, client->write_size < (1 << 30) ? client->write_size : (1 << 30), 0);
+            if (n > 0) {
+                client->write_addr += n;
+                client->write_size -= n;
+                continue;
+            }
+            if (n < 0 && errno == EFAULT) {
+                inspect_log("unwritable %p %lu\n", (void *)client->write_addr, client->write_size);
+                client->write_failed = 1;
+                continue;
+            }
+        } else {
+            n = recv(client->fd, client->input + client->input_size, sizeof(client->input) - client->input_size, 0);
+            if (n > 0) {
+                client->input_size += n;
+                size_t pos = 0;
+                while (pos < client->input_size) {
+                    size_t used = inspect_handle(client, client->input + pos, client->input_size - pos);
+                    if (used == 0) break;
+                    pos += used;
+                }
+                memmove(client->input, client->input + pos, client->input_size - pos);
+                client->input_size -= pos;
+                if (client->failed) return -1;
+                continue;
+            }
+        }
+        if (n == 0) return -1;
+        if (errno == EINTR) continue;
+        if (errno == EAGAIN || errno == EWOULDBLOCK) return 0;
+        return -1;
+    }
+    return 0;
+}
+
+// Send as much of the replies as the socket takes, returns -1 when the client is gone
+static int inspect_flush(struct inspect_client *client) {
+    while (client->output_sent < client->output_size) {
+        ssize_t n = send(client->fd, client->output + client->output_sent, client->output_size - client->output_sent, MSG_NOSIGNAL);
+        if (n < 0) {
+            if (errno == EINTR) continue;
+            if (errno == EAGAIN || errno == EWOULDBLOCK) return 0;
+            return -1;
+        }
+        client->output_sent += n;
+    }
+    client->output_size = 0;
+    client->output_sent = 0;
+    return 0;
+}
+
+static void inspect_close(struct inspect_client *client) {
+    printf("Client disconnected.\n");
+    inspect_sample_release(client);
+    close(client->fd);
+    free(client->output);
+    for (uint32_t i = 0; i < client->subscription_count; ++i) free(client->subscriptions[i].last);
+    for (int i = 0; i < INSPECT_BASE_SLOTS; ++i) free(client->bases[i].data);
+    free(client->scratch);
+    memset(client, 0, sizeof(*client));
+    client->fd = -1;
+}
+
+// Send the replies, stop reading while the client does not take them. Returns -1 when the client is gone.
+static int inspect_send(int epoll_fd, struct inspect_client *client) {
+    if (client->failed || inspect_flush(client) < 0) {
+        epoll_ctl(epoll_fd, EPOLL_CTL_DEL, client->fd, 0);
+        inspect_close(client);
+        return -1;
+    }
+
+    uint32_t events_wanted = client->output_size ? EPOLLOUT : EPOLLIN;
+    if (events_wanted != client->events) {
+        client->events = events_wanted;
+        struct epoll_event event = {.events = events_wanted, .data.ptr = client};
+        epoll_ctl(epoll_fd, EPOLL_CTL_MOD, client->fd, &event);
+    }
+    return 0;
+}
+
+static void inspect_accept(int epoll_fd, int server_fd) {
+    int client_fd = accept4(server_fd, 0, 0, SOCK_NONBLOCK);
+    if (client_fd < 0) return;
+
+    struct inspect_client *client = 0;
+    for (int i = 0; i < INSPECT_MAX_CLIENTS; ++i) {
+        if (inspect_clients[i].fd < 0) {
+            client = &inspect_clients[i];
+            break;
+        }
+    }
+    if (!client) {
+        printf("Too many clients.\n");
+        close(client_fd);
+        return;
+    }
+
+    // Replies are already batched, send them right away
+    int opt = 1;
+    setsockopt(client_fd, IPPROTO_TCP, TCP_NODELAY, &opt, sizeof(opt));
+
+    client->fd = client_fd;
+    client->events = EPOLLIN;
+    struct epoll_event event = {.events = client->events, .data.ptr = client};
+    if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, client_fd, &event) < 0) {
+        inspect_close(client);
+        return;
+    }
+    printf("Client connected.\n");
+}
+
 void *inspect_command_thread(void *arg) {
     int port = (int)(intptr_t)arg;
 
@@ -42,55 +879,72 @@ void *inspect_command_thread(void *arg) {
     }
 
     // Listen for connections
-    if (listen(server_fd, 1) < 0) {
+    if (listen(server_fd, INSPECT_MAX_CLIENTS) < 0) {
+        exit(EXIT_FAILURE);
+    }
+
+    // The server socket has no client, clients are found through the event data
+    int epoll_fd = epoll_create1(0);
+    struct epoll_event event = {.events = EPOLLIN, .data.ptr = 0};
+    if (epoll_fd < 0 || epoll_ctl(epoll_fd, EPOLL_CTL_ADD, server_fd, &event) < 0) {
         exit(EXIT_FAILURE);
     }
+    for (int i = 0; i < INSPECT_MAX_CLIENTS; ++i) {
+        inspect_clients[i].fd = -1;
+    }
 
     printf("Server listening on port %d...\n", port);
 
+    // Time of the next subscription check, if there are any subscriptions
+    uint64_t next_check = UINT64_MAX;
+
     for (;;) {
-        // Accept one client
-        socklen_t addrlen = sizeof(address);
-        int client_fd = accept(server_fd, (struct sockaddr *)&address, &addrlen);
-        if (client_fd < 0) {
-            exit(EXIT_FAILURE);
+        int timeout = -1;
+        if (next_check != UINT64_MAX) {
+            uint64_t now = inspect_time_ns();
+            timeout = next_check > now ? (next_check - now + 999999) / 1000000 : 0;
         }
 
-        printf("Client connected.\n");
-
-        for (;;) {
-            unsigned char command;
-            int n = recv(client_fd, &command, sizeof(command), 0);
-            if (n != sizeof(command)) break;
+        struct epoll_event events[INSPECT_MAX_CLIENTS + 1];
+        int count = epoll_wait(epoll_fd, events, INSPECT_MAX_CLIENTS + 1, timeout);
+        if (count < 0) {
+            if (errno == EINTR) continue;
+            exit(EXIT_FAILURE);
+        }
 
-            // Info command
-            if (command == 0) {
-                void *response = (void *)DEBUG_DATA;
-                send(client_fd, &response, sizeof(response), 0);
+        for (int i = 0; i < count; ++i) {
+            struct inspect_client *client = events[i].data.ptr;
+            if (!client) {
+                inspect_accept(epoll_fd, server_fd);
+                continue;
             }
 
-            // Read data
-            if (command == 1) {
-                uint64_t args[2];
-                recv(client_fd, &args, sizeof(args), 0);
-                printf("read %p %lu\n", (void *)args[0], args[1]);
-                send(client_fd, (void *)args[0], args[1], 0);
+            // Handle all requests that arrived, then send all their replies at once
+            if (inspect_flush(client) == 0 && client->output_size == 0 && inspect_receive(client) < 0) {
+                epoll_ctl(epoll_fd, EPOLL_CTL_DEL, client->fd, 0);
+                inspect_close(client);
+                continue;
             }
+            inspect_send(epoll_fd, client);
+        }
 
-            // Write data
-            if (command == 2) {
-                uint64_t args[2];
-                recv(client_fd, &args, sizeof(args), 0);
-                printf("write %p %lu\n", (void *)args[0], args[1]);
-                recv(client_fd, (void *)args[0], args[1], 0);
-            }
+        // Notify changes of watched ranges
+        uint64_t now = inspect_time_ns();
+        next_check = UINT64_MAX;
+        for (int i = 0; i < INSPECT_MAX_CLIENTS; ++i) {
+            struct inspect_client *client = &inspect_clients[i];
+            if (client->fd < 0 || !client->subscription_count) continue;
+            uint64_t next = inspect_check_subscriptions(client, now);
+            if (inspect_send(epoll_fd, client) == 0 && next < next_check) next_check = next;
         }
     }
     return 0;
 }
 
 static pthread_t command_thread_handle;
+static pthread_t sample_thread_handle;
 
 void inspect_start(int port) {
     pthread_create(&command_thread_handle, 0, inspect_command_thread, (void *) (intptr_t) port);
+    pthread_create(&sample_thread_handle, 0, inspect_sample_thread, 0);
 }
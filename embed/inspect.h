@@ -1 +1,4 @@
 void inspect_start(int port);
+
+// Take a sample of the ranges the host asked for, for example from a timer interrupt or a control loop
+void inspect_sample(void);
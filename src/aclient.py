@@ -0,0 +1,545 @@
+import asyncio
+import struct
+from collections import deque
+from typing import Awaitable, Callable
+from client import READ_MANY_MAX
+from transport import FEATURES_MAGIC, FEATURE_DEVICES, FEATURE_READ_MANY, FEATURE_SUBSCRIBE
+
+Reply = Callable[[asyncio.StreamReader], Awaitable[object]]
+
+
+class AsyncClient:
+    """
+    Client that keeps many requests in flight over one connection.
+
+    Requests are sent right away and the target answers them in order, so every reply belongs to the oldest
+    request that is still waiting. At most max_pending requests wait for a reply, further requests wait for room.
+    The protocol has no framing, after a missing reply the connection can not be trusted anymore,
+    so a timeout closes the connection and fails every waiting request.
+
+    Commands take the id of the device behind a router. The select command is sent in the same write
+    as the command itself, so requests for different devices can be in flight at the same time.
+    """
+
+    def __init__(self, max_pending: int = 64, timeout: float = 5.0):
+        self.host = None
+        self.port = 0
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+        self.features = 0
+        self.timeout = timeout
+        self.max_pending = max_pending
+
+        # Requests waiting for a reply, oldest first
+        self.pending: deque[(asyncio.Future, Reply)] = deque()
+        self.slots: asyncio.Semaphore = None
+        self.wakeup: asyncio.Event = None
+        self.receiver: asyncio.Task = None
+        self.error: Exception = None
+
+        # Second connection for notifications, opened by the first subscribe
+        self.subscriber: Subscriber = None
+
+    async def connect(self, host: str, port: int) -> int:
+        """Connect and find the optional commands, returns the address of the DEBUG_DATA section"""
+        self.host = host
+        self.port = port
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.slots = asyncio.Semaphore(self.max_pending)
+        self.wakeup = asyncio.Event()
+        self.error = None
+        self.receiver = asyncio.create_task(self.receive())
+        return await self.probe()
+
+    async def close(self):
+        if self.subscriber is not None:
+            await self.subscriber.close()
+            self.subscriber = None
+        self.fail(ConnectionError("Connection closed"))
+        if self.receiver is not None:
+            try:
+                await self.receiver
+            except asyncio.CancelledError:
+                pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def fail(self, error: Exception):
+        """Close the connection, waiting and future requests raise error"""
+        if self.error is not None:
+            return
+        self.error = error
+        for future, _ in self.pending:
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+        if self.receiver is not None and self.receiver is not asyncio.current_task():
+            self.receiver.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    async def receive(self):
+        """Hand every reply to the oldest waiting request"""
+        try:
+            while True:
+                while not self.pending:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                future, reply = self.pending[0]
+                result = await reply(self.reader)
+                self.pending.popleft()
+                if not future.done():
+                    future.set_result(result)
+        except (asyncio.IncompleteReadError, OSError) as error:
+            self.fail(ConnectionError(f"Connection to target lost: {error}"))
+
+    async def request(self, data: bytes, reply: Reply = None, device: int = None) -> object:
+        """Send a request to device, then wait for its reply if it has one"""
+        if self.error is not None:
+            raise self.error
+        if device is not None:
+            if self.features & FEATURE_DEVICES:
+                data = struct.pack("<BI", 6, device) + data
+            elif device != 0:
+                raise ValueError(f"Target has no device {device}")
+
+        async with self.slots:
+            future = None
+            if reply is not None:
+                future = asyncio.get_running_loop().create_future()
+                self.pending.append((future, reply))
+                self.wakeup.set()
+
+            # Appending and writing happen without a switch in between, so the requests stay in order
+            self.writer.write(data)
+            try:
+                await asyncio.wait_for(self.writer.drain(), self.timeout)
+                if future is None:
+                    return None
+                return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except TimeoutError:
+                self.fail(TimeoutError("No reply from target"))
+                raise
+
+    # The protocol commands, see Client
+    async def info(self, device: int = None) -> int:
+        """Return address of the DEBUG_DATA section"""
+        return await self.request(struct.pack("<B", 0), read_u64, device)
+
+    async def probe(self) -> int:
+        """Find the optional commands of the target, returns the address of the DEBUG_DATA section"""
+
+        self.features, addr = await self.request(struct.pack("<BB", 3, 0), read_features)
+        return addr
+
+    async def devices(self) -> list[(int, str, int)]:
+        """List the (id, name, addr) of the devices behind the target, a target without the devices command is device 0"""
+        if not self.features & FEATURE_DEVICES:
+            return [(0, "", await self.info())]
+
+        async def reply(reader: asyncio.StreamReader) -> list[(int, str, int)]:
+            (count,) = struct.unpack("<I", await reader.readexactly(4))
+            devices = []
+            for _ in range(count):
+                id, addr, name_size = struct.unpack("<IQB", await reader.readexactly(13))
+                devices.append((id, (await reader.readexactly(name_size)).decode(), addr))
+            return devices
+
+        return await self.request(struct.pack("<B", 5), reply)
+
+    async def read(self, addr: int, size: int, device: int = None) -> bytes:
+        """Read memory from address"""
+        if size == 0:
+            return bytes()
+        return await self.request(struct.pack("<BQQ", 1, addr, size), lambda reader: reader.readexactly(size), device)
+
+    async def read_many(self, ranges: list[(int, int)], device: int = None) -> list[bytes]:
+        """Read multiple (addr, size) ranges, all requests are in flight at the same time"""
+        if not self.features & FEATURE_READ_MANY:
+            return list(await asyncio.gather(*[self.read(addr, size, device) for addr, size in ranges]))
+
+        async def read_batch(batch: list[(int, int)]) -> list[bytes]:
+            request = [struct.pack("<BI", 4, len(batch))]
+            request += [struct.pack("<QQ", addr, size) for addr, size in batch]
+            data = await self.request(b"".join(request), lambda reader: reader.readexactly(sum(size for _, size in batch)), device)
+
+            result = []
+            offset = 0
+            for _, size in batch:
+                result.append(data[offset : offset + size])
+                offset += size
+            return result
+
+        batches = [ranges[i : i + READ_MANY_MAX] for i in range(0, len(ranges), READ_MANY_MAX)]
+        return [data for batch in await asyncio.gather(*map(read_batch, batches)) for data in batch]
+
+    async def write(self, addr: int, data: bytes, device: int = None):
+        """Write memory to address"""
+        await self.request(struct.pack("<BQQ", 2, addr, len(data)) + data, None, device)
+
+    # Helper functions
+    async def read_int(self, addr: int, len: int, device: int = None) -> int:
+        return int.from_bytes(await self.read(addr, len, device), "little")
+
+    async def write_int(self, addr: int, len: int, data: int, device: int = None):
+        await self.write(addr, data.to_bytes(len, "little"), device)
+
+    async def subscribe(self, addr: int, size: int, interval: float = 0.01, callback: "Callback" = None) -> "Subscription":
+        """Watch a range for changes, see Subscriber"""
+        if self.subscriber is None:
+            subscriber = Subscriber(self.timeout)
+            await subscriber.connect(self.host, self.port)
+            self.subscriber = subscriber
+        return await self.subscriber.subscribe(addr, size, interval, callback)
+
+
+Callback = Callable[["Subscription"], None]
+
+
+class Subscription:
+    """
+    Changes of one watched range. Every notification is passed to the callback,
+    without a callback they are queued for `async for time, data in subscription`.
+    """
+
+    def __init__(self, subscriber: "Subscriber", id: int, addr: int, size: int, callback: Callback = None):
+        self.subscriber = subscriber
+        self.id = id
+        self.addr = addr
+        self.size = size
+        self.callback = callback
+
+        # Latest data and its time in nanoseconds of the target clock
+        self.data: bytes = None
+        self.time = 0
+        self.notifications = 0
+
+        self.started = asyncio.get_running_loop().create_future()
+        self.queue: asyncio.Queue[(int, bytes)] = asyncio.Queue()
+
+    def notify(self, time: int, data: bytes):
+        # Without data the target can not read the range (anymore) and dropped the subscription
+        if not data:
+            if not self.started.done():
+                self.started.set_exception(ValueError(f"Target can not watch {self.size} bytes at {self.addr:#x}"))
+            self.subscriber.subscriptions.pop(self.id, None)
+            self.end()
+            return
+
+        if not self.started.done():
+            self.started.set_result(None)
+        self.time = time
+        self.data = data
+        self.notifications += 1
+        if self.callback is None:
+            self.queue.put_nowait((time, data))
+            return
+
+        # A failing callback is reported, it does not stop the notifications of the other subscriptions
+        try:
+            self.callback(self)
+        except Exception as error:
+            asyncio.get_running_loop().call_exception_handler(
+                {"message": f"Callback of the subscription to {self.size} bytes at {self.addr:#x} failed", "exception": error}
+            )
+
+    def end(self):
+        """No more notifications, ends the iteration"""
+        if not self.started.done():
+            self.started.set_exception(ConnectionError("Subscription ended"))
+        self.queue.put_nowait(None)
+
+    async def close(self):
+        await self.subscriber.unsubscribe(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> (int, bytes):
+        item = await self.queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+
+class Subscriber:
+    """
+    Connection that only carries subscriptions.
+
+    The target sends the current data of a watched range right away, then sends it again whenever it changed,
+    at most once per interval. Notifications arrive at any time, so they can not share a connection with requests
+    that wait for their reply in order. Every notification has a header with the subscription id, size and time.
+    """
+
+    def __init__(self, timeout: float = 5.0):
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+        self.timeout = timeout
+        self.subscriptions: dict[int, Subscription] = {}
+        self.next_id = 1
+        self.receiver: asyncio.Task = None
+
+    async def connect(self, host: str, port: int):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(struct.pack("<BB", 3, 0))
+        try:
+            features, _ = await asyncio.wait_for(read_features(self.reader), self.timeout)
+        except BaseException:
+            self.writer.close()
+            raise
+        if not features & FEATURE_SUBSCRIBE:
+            self.writer.close()
+            raise ValueError("Target does not support subscriptions")
+        self.receiver = asyncio.create_task(self.receive())
+
+    async def close(self):
+        if self.receiver is not None:
+            self.receiver.cancel()
+            try:
+                await self.receiver
+            except asyncio.CancelledError:
+                pass
+        self.writer.close()
+        for subscription in self.subscriptions.values():
+            subscription.end()
+        self.subscriptions.clear()
+
+    async def receive(self):
+        try:
+            while True:
+                id, size, time = struct.unpack("<IIQ", await self.reader.readexactly(16))
+                data = await self.reader.readexactly(size)
+                subscription = self.subscriptions.get(id)
+                if subscription is not None:
+                    subscription.notify(time, data)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            # Nothing is received anymore, end the iteration of every subscription
+            for subscription in self.subscriptions.values():
+                subscription.end()
+            self.subscriptions.clear()
+
+    async def subscribe(self, addr: int, size: int, interval: float = 0.01, callback: Callback = None) -> Subscription:
+        """Watch size bytes at addr, returns when the current data is received"""
+        subscription = Subscription(self, self.next_id, addr, size, callback)
+        self.next_id += 1
+        self.subscriptions[subscription.id] = subscription
+        self.writer.write(struct.pack("<BIQQI", 10, subscription.id, addr, size, round(interval * 1e6)))
+        try:
+            await asyncio.wait_for(asyncio.shield(subscription.started), self.timeout)
+        except BaseException:
+            self.subscriptions.pop(subscription.id, None)
+            raise
+        return subscription
+
+    async def unsubscribe(self, subscription: Subscription):
+        if self.subscriptions.pop(subscription.id, None) is None:
+            return
+        self.writer.write(struct.pack("<BI", 11, subscription.id))
+        await self.writer.drain()
+        subscription.end()
+
+
+async def read_u64(reader: asyncio.StreamReader) -> int:
+    return struct.unpack("<Q", await reader.readexactly(8))[0]
+
+
+async def read_features(reader: asyncio.StreamReader) -> (int, int):
+    """Reply to the features command sent together with info, the features are 0 for targets without it"""
+    data = await reader.readexactly(8)
+    magic, features = struct.unpack("<II", data)
+    if magic != FEATURES_MAGIC:
+        return 0, struct.unpack("<Q", data)[0]
+    return features, await read_u64(reader)
+
+
+async def serve_memory(memories: list[bytearray], features: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Minimal target for the tests, with one device per memory, memory starts at address 0x1000"""
+    memory = memories[0]
+    watches: dict[int, asyncio.Task] = {}
+
+    async def watch(id: int, memory: bytearray, addr: int, size: int, interval: float):
+        last = None
+        while True:
+            # A range outside of memory can not be watched, the subscription ends
+            if addr < 0x1000 or addr - 0x1000 + size > len(memory):
+                writer.write(struct.pack("<IIQ", id, 0, 0))
+                return
+            data = bytes(memory[addr - 0x1000 : addr - 0x1000 + size])
+            if data != last:
+                writer.write(struct.pack("<IIQ", id, size, 0) + data)
+                last = data
+            await asyncio.sleep(interval)
+
+    try:
+        while True:
+            command = (await reader.readexactly(1))[0]
+            if command == 0:
+                writer.write(struct.pack("<Q", 0x1000))
+            elif command == 1 or command == 2:
+                addr, size = struct.unpack("<QQ", await reader.readexactly(16))
+                if command == 1:
+                    writer.write(memory[addr - 0x1000 : addr - 0x1000 + size])
+                else:
+                    memory[addr - 0x1000 : addr - 0x1000 + size] = await reader.readexactly(size)
+            elif command == 3 and features >= 0:
+                writer.write(struct.pack("<II", FEATURES_MAGIC, features))
+            elif command == 4 and features & FEATURE_READ_MANY:
+                (count,) = struct.unpack("<I", await reader.readexactly(4))
+                for _ in range(count):
+                    addr, size = struct.unpack("<QQ", await reader.readexactly(16))
+                    writer.write(memory[addr - 0x1000 : addr - 0x1000 + size])
+            elif command == 5 and features & FEATURE_DEVICES:
+                writer.write(struct.pack("<I", len(memories)))
+                for id in range(len(memories)):
+                    name = f"board{id}".encode()
+                    writer.write(struct.pack("<IQB", id, 0x1000, len(name)) + name)
+            elif command == 6 and features & FEATURE_DEVICES:
+                (id,) = struct.unpack("<I", await reader.readexactly(4))
+                memory = memories[id]
+            elif command == 10 and features & FEATURE_SUBSCRIBE:
+                id, addr, size, interval = struct.unpack("<IQQI", await reader.readexactly(24))
+                watches[id] = asyncio.create_task(watch(id, memory, addr, size, interval / 1e6))
+            elif command == 11 and features & FEATURE_SUBSCRIBE:
+                (id,) = struct.unpack("<I", await reader.readexactly(4))
+                watches.pop(id).cancel()
+            await writer.drain()
+    except asyncio.IncompleteReadError:
+        writer.close()
+    finally:
+        for task in watches.values():
+            task.cancel()
+
+
+def test_async_client():
+    async def run(features: int):
+        memory = bytearray(range(256))
+        server = await asyncio.start_server(lambda r, w: serve_memory([memory], features, r, w), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with AsyncClient(max_pending=4) as client:
+            assert await client.connect("127.0.0.1", port) == 0x1000
+            assert client.features == max(features, 0)
+
+            # More requests than max_pending, the replies still end up at the right request
+            reads = await asyncio.gather(*[client.read(0x1000 + i, 3) for i in range(20)])
+            assert reads == [bytes(memory[i : i + 3]) for i in range(20)]
+            assert await client.read_many([(0x1010, 2), (0x1000, 1)]) == [b"\x10\x11", b"\x00"]
+
+            await client.write_int(0x1004, 2, 0xABCD)
+            assert await client.read_int(0x1004, 2) == 0xABCD
+        server.close()
+        await server.wait_closed()
+
+    # Without the features command, with it, and with read_many
+    for features in [-1, 0, FEATURE_READ_MANY]:
+        asyncio.run(run(features))
+
+
+def test_async_client_devices():
+    async def run(features: int):
+        memories = [bytearray([id]) * 16 for id in range(3)]
+        server = await asyncio.start_server(lambda r, w: serve_memory(memories, features, r, w), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with AsyncClient() as client:
+            await client.connect("127.0.0.1", port)
+            if not features & FEATURE_DEVICES:
+                assert await client.devices() == [(0, "", 0x1000)]
+                assert await client.read(0x1000, 1, 0) == b"\x00"
+            else:
+                assert await client.devices() == [(id, f"board{id}", 0x1000) for id in range(3)]
+
+                # Requests for different devices in flight at the same time
+                reads = await asyncio.gather(*[client.read(0x1000 + i, 2, i % 3) for i in range(12)])
+                assert reads == [bytes([i % 3]) * 2 for i in range(12)]
+                assert await client.read_many([(0x1000, 1), (0x1002, 2)], 2) == [b"\x02", b"\x02\x02"]
+                await client.write_int(0x1000, 1, 9, 1)
+                assert await client.read_int(0x1000, 1, 1) == 9
+                assert memories[1][0] == 9 and memories[0][0] == 0
+        server.close()
+        await server.wait_closed()
+
+    for features in [0, FEATURE_READ_MANY | FEATURE_DEVICES]:
+        asyncio.run(run(features))
+
+
+def test_subscribe():
+    async def run():
+        memory = bytearray(16)
+        server = await asyncio.start_server(lambda r, w: serve_memory([memory], FEATURE_SUBSCRIBE, r, w), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with AsyncClient() as client:
+            await client.connect("127.0.0.1", port)
+
+            # The current data arrives right away, after that only changes
+            changes = []
+            counter = await client.subscribe(0x1000, 4, 0.001)
+            flag = await client.subscribe(0x1008, 1, 0.001, lambda s: changes.append(s.data))
+            assert (counter.data, flag.data) == (bytes(4), b"\x00")
+
+            memory[0] = 1
+            assert await anext(counter) == (0, bytes(4))
+            assert await anext(counter) == (0, b"\x01\x00\x00\x00")
+            await asyncio.sleep(0.01)
+            assert counter.queue.empty() and changes == [b"\x00"]
+
+            memory[8] = 5
+            await asyncio.sleep(0.01)
+            assert changes == [b"\x00", b"\x05"]
+
+            await counter.close()
+            assert [item async for item in counter] == []
+
+            # A failing callback is reported, the other subscriptions keep going
+            errors = []
+            asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context["exception"]))
+            await client.subscribe(0x1004, 1, 0.001, lambda s: 1 / 0)
+            memory[8] = 6
+            await asyncio.sleep(0.01)
+            assert changes[-1] == b"\x06" and len(errors) == 1 and isinstance(errors[0], ZeroDivisionError)
+
+            # A range that can not be read is rejected, one that can not be read anymore ends
+            try:
+                await client.subscribe(0x1010, 4)
+                assert False
+            except ValueError:
+                pass
+            tail = await client.subscribe(0x100C, 4, 0.001)
+            del memory[12:]
+            assert [item async for item in tail] == [(0, bytes(4))]
+            assert tail.id not in client.subscriber.subscriptions
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
+
+
+def test_async_client_timeout():
+    async def run():
+        # A target that never answers
+        async def silent(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            await reader.read()
+            writer.close()
+
+        server = await asyncio.start_server(silent, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        client = AsyncClient(timeout=0.05)
+        try:
+            await client.connect("127.0.0.1", port)
+            assert False
+        except TimeoutError:
+            pass
+        try:
+            await client.read(0, 4)
+            assert False
+        except TimeoutError:
+            pass
+        await client.close()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
@@ -0,0 +1,185 @@
+import argparse
+import random
+import struct
+import threading
+import time
+from io import BytesIO
+import store
+from client import Client
+from table import ValueTable
+from transport import TcpTransport
+from value import Value, ValueTag
+
+
+def make_tree(cu_count: int, type_count: int) -> Value:
+    """Every compile unit gets its own copy of the same types, like a C++ image including the same headers everywhere"""
+    root = Value(ValueTag.Namespace, "root")
+    for cu_index in range(cu_count):
+        cu = Value(ValueTag.Namespace, f"cu{cu_index}.cpp")
+        type_int = Value(ValueTag.BaseType, "int", 4)
+        types: list[Value] = []
+        for type_index in range(type_count):
+            # struct Type { int value; Type *next; OtherType *other; }
+            struct = Value(ValueTag.Struct, f"Type{type_index}", 24)
+            ptr = Value(ValueTag.Pointer, "", 8)
+            ptr.children = [struct]
+            member_value = Value(ValueTag.Variable, "value", 0)
+            member_value.children = [type_int]
+            member_next = Value(ValueTag.Variable, "next", 8)
+            member_next.children = [ptr]
+            struct.children = [member_value, member_next]
+            if types:
+                member_other = Value(ValueTag.Variable, "other", 16)
+                member_other.children = [types[type_index // 2].children[1].children[0]]
+                struct.children.append(member_other)
+            types.append(struct)
+
+        for type_index, struct in enumerate(types):
+            var = Value(ValueTag.Variable, f"g_cu{cu_index}_var{type_index}", cu_index * type_count + type_index)
+            var.children = [struct]
+            cu.children.append(var)
+        root.children.append(cu)
+    return root
+
+
+def count_nodes(root: Value) -> int:
+    visited = set()
+    todo = [root]
+    while todo:
+        value = todo.pop()
+        if value in visited:
+            continue
+        visited.add(value)
+        todo += value.children
+    return len(visited)
+
+
+def bench_dedup(args):
+    print(f"{'cus':>6} {'types':>6} {'nodes':>9} {'unique':>9} {'time':>10} {'per node':>10}")
+    for type_count in args.sizes:
+        root = make_tree(args.cus, type_count)
+        nodes = count_nodes(root)
+        start = time.perf_counter()
+        root.deduplicate()
+        duration = time.perf_counter() - start
+        unique = count_nodes(root)
+        print(f"{args.cus:>6} {type_count:>6} {nodes:>9} {unique:>9} {duration * 1000:>8.1f}ms {duration / nodes * 1e9:>8.0f}ns")
+
+
+def bench_varint(args):
+    rng = random.Random(1)
+    values = [rng.choice([rng.randrange(128), rng.randrange(1 << 16), rng.randrange(1 << 32)]) for _ in range(args.count)]
+    root = make_tree(args.cus, args.types)
+    root.deduplicate()
+    table = ValueTable.from_value(root)
+
+    modes = [("python", False)]
+    if store.numpy is not None:
+        modes.append(("numpy", True))
+    else:
+        print("numpy is not installed, only the pure python version is measured")
+
+    def measure(func) -> float:
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+    # Single varint reads, as done before the bulk decoder
+    data = store.write_varints(values)
+    buf = BytesIO(data)
+    duration = measure(lambda: [store.read_varint(buf) for _ in values])
+    print(f"{'read_varint':<24} {len(values):>9} varints {duration * 1000:>8.1f}ms {len(data) / duration / 1e6:>8.1f} MB/s")
+
+    print(f"{'table':<24} {len(table):>9} rows")
+    for name, enabled in modes:
+        store.use_numpy = enabled
+        encoded = store.write_varints(values)
+        assert encoded == data
+        duration = measure(lambda: store.write_varints(values))
+        print(f"{'write_varints ' + name:<24} {len(values):>9} varints {duration * 1000:>8.1f}ms {len(data) / duration / 1e6:>8.1f} MB/s")
+        duration = measure(lambda: store.read_varints(data, 0, len(values)))
+        print(f"{'read_varints ' + name:<24} {len(values):>9} varints {duration * 1000:>8.1f}ms {len(data) / duration / 1e6:>8.1f} MB/s")
+
+        table_data = store.encode(table)
+        assert store.encode(store.decode(table_data)) == table_data
+        duration = measure(lambda: store.encode(table))
+        print(f"{'store.encode ' + name:<24} {len(table_data):>9} bytes   {duration * 1000:>8.1f}ms {len(table_data) / duration / 1e6:>8.1f} MB/s")
+        duration = measure(lambda: store.decode(table_data))
+        print(f"{'store.decode ' + name:<24} {len(table_data):>9} bytes   {duration * 1000:>8.1f}ms {len(table_data) / duration / 1e6:>8.1f} MB/s")
+
+
+def bench_server(args):
+    """Load generator for a target server, every client keeps a batch of read requests in flight"""
+
+    def worker(deadline: float, latencies: list[float]):
+        client = Client()
+        client.transport = TcpTransport(args.host, args.port)
+        try:
+            addr = client.probe()
+            request = struct.pack("<BQQ", 1, addr, args.size) * args.pipeline
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                client.transport.sendall(request)
+                client.recv_exact(args.size * args.pipeline)
+                latencies.append(time.perf_counter() - start)
+        except ConnectionError as error:
+            # Servers close connections above their client limit
+            print(f"Client stopped: {error}")
+        finally:
+            client.transport.close()
+
+    print(f"{'clients':>7} {'pipeline':>8} {'requests/s':>11} {'MB/s':>8} {'p50':>9} {'p99':>9} {'p99.9':>9} {'max':>9}")
+    for client_count in args.clients:
+        deadline = time.perf_counter() + args.time
+        latencies = [[] for _ in range(client_count)]
+        threads = [threading.Thread(target=worker, args=(deadline, l)) for l in latencies]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - start
+
+        # Every request in a batch waits as long as the batch
+        batches = sorted(latency for l in latencies for latency in l)
+        requests = len(batches) * args.pipeline
+
+        def percentile(p: float) -> str:
+            return f"{batches[min(int(len(batches) * p), len(batches) - 1)] * 1e6:>7.0f}us"
+
+        print(
+            f"{client_count:>7} {args.pipeline:>8} {requests / duration:>11.0f} {requests * args.size / duration / 1e6:>8.1f} "
+            f"{percentile(0.5)} {percentile(0.99)} {percentile(0.999)} {percentile(1.0)}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    commands = parser.add_subparsers(required=True)
+
+    dedup = commands.add_parser("dedup", help="Value.deduplicate scaling with the number of nodes")
+    dedup.add_argument("-c", "--cus", type=int, default=4, help="Number of compile units")
+    dedup.add_argument("sizes", type=int, nargs="*", default=[500, 1000, 2000, 4000, 8000, 16000], help="Types per compile unit")
+    dedup.set_defaults(func=bench_dedup)
+
+    varint = commands.add_parser("varint", help="Bulk varint and store round trip")
+    varint.add_argument("-n", "--count", type=int, default=1000000, help="Number of varints")
+    varint.add_argument("-c", "--cus", type=int, default=100, help="Compile units in the table")
+    varint.add_argument("-t", "--types", type=int, default=1000, help="Types per compile unit")
+    varint.set_defaults(func=bench_varint)
+
+    server = commands.add_parser("server", help="Requests per second and latency of a running target server")
+    server.add_argument("-H", "--host", default="localhost", help="Target host")
+    server.add_argument("-p", "--port", type=int, default=1234, help="Target port")
+    server.add_argument("-c", "--clients", type=int, nargs="*", default=[1, 2, 4, 8], help="Number of concurrent clients")
+    server.add_argument("-d", "--pipeline", type=int, default=16, help="Read requests sent together by each client")
+    server.add_argument("-s", "--size", type=int, default=64, help="Bytes per read request")
+    server.add_argument("-t", "--time", type=float, default=2.0, help="Seconds per measurement")
+    server.set_defaults(func=bench_server)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import os
+import tempfile
+
+
+def default_path(name: str) -> str:
+    """Default cache directory for `name`, following the XDG convention"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "inspect", name)
+
+
+class DiskCache:
+    """
+    Size bounded key-value store, one file per entry.
+
+    Entries are written to a temporary file and renamed into place, so readers never see a partial entry
+    and multiple processes can share the same directory. Reading an entry updates its modification time,
+    eviction removes the least recently used entries first.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def file(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(self.file(key))
+
+    def get(self, key: str) -> bytes:
+        try:
+            with open(self.file(key), "rb") as file:
+                data = file.read()
+            os.utime(self.file(key))
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.replace(tmp, self.file(key))
+        except OSError:
+            # Caching is best effort
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_size"""
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.startswith(".tmp-"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                # Already removed by another process
+                pass
+            total -= size
+
+
+def test_cache(tmp_path):
+    cache = DiskCache(str(tmp_path), 10)
+    assert cache.get("a") is None
+    cache.put("a", b"12345")
+    cache.put("b", b"67890")
+    assert cache.get("a") == b"12345"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # 'b' is the least recently used entry
+    os.utime(cache.file("b"), (0, 0))
+    cache.put("c", b"abc")
+    cache.evict()
+    assert cache.get("b") is None
+    assert cache.get("a") == b"12345"
+    assert cache.get("c") == b"abc"
@@ -1,22 +1,103 @@
+import contextlib
+import pickle
 import socket
-import zlib
 import struct
-import store
+import zlib
+from typing import Callable, Iterator
+import rle
+import tableformat
+from cache import DiskCache
+from planner import ReadPlan, ReadStats
+from shadow import ShadowMemory, ShadowView
+from symbols import Symbol, SymbolIndex
+from table import ValueTable
+from transport import CHECKSUM_ERROR, FEATURES_MAGIC, FEATURE_CHECKSUM, FEATURE_COMPRESSED_READ, FEATURE_DEVICES, FEATURE_READ_MANY, FEATURE_SAMPLE, SocketTransport, TcpTransport, Transport
 from value import Value, ValueTag
 
+# Ranges per read_many command, the request always fits in the socket buffer
+READ_MANY_MAX = 256
+
+# Most ranges a target samples at the same time
+SAMPLE_MAX_RANGES = 32
+
+# Called with the number of bytes done and the total during long reads
+Progress = Callable[[int, int], None]
+
+
+def print_progress(done: int, total: int):
+    print(f"\rDownloading {done}/{total} bytes", end="\n" if done == total else "", flush=True)
+
+
+class Sample:
+    """Data of all sampled ranges at one moment, seq counts the samples and time is in nanoseconds of the target clock"""
+
+    def __init__(self, seq: int, time: int, values: list[bytes]):
+        self.seq = seq
+        self.time = time
+        self.values = values
+
+    def __repr__(self) -> str:
+        return f"Sample({self.seq}, {self.time}, {self.values!r})"
+
 
 class Client:
-    def __init__(self):
-        self.sock: socket.socket = None
+    def __init__(self, cache: DiskCache = None):
+        self.transport: Transport = None
         self.root: Value = None
         self.base_address = 0
+        self.features = 0
+
+        # Nearby reads are merged, see read_ranges.
+        # Larger reads are split into transfers of max_transfer, with max_pending transfers in flight.
+        self.max_gap = 64
+        self.max_transfer = 4096
+        self.max_pending = 16
+        self.read_stats = ReadStats()
 
-    def connect(self, host: str, port: int, symbol_name: str = "DEBUG_DATA"):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((host, port))
+        # Number of times read_many waited for replies
+        self.round_trips = 0
+
+        # Reads of at least compress_min bytes are compressed when the target supports it.
+        # The last data of every compressed range is kept, the next read of it only transfers the changes.
+        self.compress_min = 256
+        self.read_bases: dict[(int, int), bytes] = {}
+        self.max_read_bases = 256
+        self.compressed_bytes = 0
+        self.received_bytes = 0
+
+        # Sizes of the sampled ranges, the next expected sample and the number of samples that were overwritten before draining
+        self.sample_sizes: list[int] = []
+        self.sample_next = 0
+        self.samples_lost = 0
+
+        # Mirror of the memory read through a view, missing blocks are read together with read_ranges
+        self.shadow = ShadowMemory(self.read_ranges)
+
+        # Table layout, the namespace of every section and the namespaces that are not read yet
+        self.data_addr = 0
+        self.index: tableformat.TableIndex = None
+        self.namespaces: list[Value] = []
+        self.unloaded: dict[Value, tableformat.Section] = {}
+
+        # Built on first use, namespaces are read when a variable in them is looked up
+        self.symbol_index: SymbolIndex = None
+
+        # Decoded parts of earlier tables by table hash, so reconnecting to the same firmware needs no download
+        self.cache = cache
+
+    def connect(self, host: str, port: int, symbol_name: str = "DEBUG_DATA", progress: Progress = None, device: int = None):
+        self.open(TcpTransport(host, port), symbol_name, progress, device)
+
+    def open(self, transport: Transport, symbol_name: str = "DEBUG_DATA", progress: Progress = None, device: int = None):
+        """Read the table of the target behind transport, device selects one of the devices behind a router"""
+        self.transport = transport
+        self.shadow.invalidate()
 
         # Request deubg_data table address
-        addr = self.info()
+        addr = self.probe()
+        if device is not None:
+            self.select(device)
+            addr = self.info()
 
         # Read table header
         header = self.read(addr, 16)
@@ -25,39 +106,314 @@ class Client:
         data_size = int.from_bytes(header[12:16], "little")
         print(f"Found Header magic={magic.hex()}, max_size={max_size}, data_size={data_size}")
 
-        # Read and parse entire table
-        store_data = self.read(addr + 16, data_size)
-        store_data = zlib.decompress(store_data)
-        self.root = store.decode(store_data)
-        vars = self.root.variables()
-        print(f"Found {len(vars)} variables")
-        for var in vars:
-            print(f"    {var.pretty()}")
+        # Read the start of the table to find its format
+        self.data_addr = addr + 16
+        prefix = self.read(self.data_addr, min(data_size, tableformat.PREFIX_SIZE))
+        self.index = tableformat.unpack_prefix(prefix)
+        if self.index.version == 0:
+            # Read and parse entire table
+            store_data = self.read(self.data_addr, data_size, progress)
+            self.root = tableformat.unpack_legacy(store_data).to_value()
+            vars = self.root.variables()
+            print(f"Found {len(vars)} variables")
+            for var in vars:
+                print(f"    {var.pretty()}")
+        else:
+            # Only read the index, namespaces are read when they are needed
+            self.index.sections, self.index.directory = self.cached("sections", self.read_index)
+            self.root = self.read_section(self.index.sections[0], progress)
+            self.namespaces = [self.root]
+            print(f"Found {len(self.index.sections) - 1} namespaces (table version {self.index.version}, {self.index.codec.name})")
+            for section in self.index.sections[1:]:
+                print(f"    {section.name} ({section.size} bytes)")
+                namespace = Value(ValueTag.Namespace, section.name)
+                self.namespaces.append(namespace)
+                self.unloaded[namespace] = section
+                self.root.children.append(namespace)
 
         # Calculate base_address
-        base_var = self.find_variable(symbol_name)
-        self.base_address = addr - base_var.value
+        if self.index.table_addr:
+            self.base_address = addr - self.index.table_addr
+        else:
+            base_var = self.find_variable(symbol_name)
+            self.base_address = addr - base_var.value
         print(f"Base address: {self.base_address:#x}")
 
+    def cached(self, name: str, load: Callable[[], object]) -> object:
+        """Decoded part of the table from the cache, load() is only called when it is not there"""
+        if self.cache is None or not self.index.hash:
+            return load()
+
+        key = f"{self.index.hash.hex()}-{name}"
+        data = self.cache.get(key)
+        if data is not None:
+            try:
+                return pickle.loads(data)
+            except Exception:
+                # Corrupt or incompatible entry, just read it again
+                pass
+
+        value = load()
+        self.cache.put(key, pickle.dumps(value))
+        self.cache.evict()
+        return value
+
+    def read_index(self) -> (list[tableformat.Section], dict[str, int]):
+        index_data = self.read(self.data_addr + self.index.prefix_size, self.index.index_size)
+        tableformat.unpack_index(self.index, index_data)
+        return self.index.sections, self.index.directory
+
+    def read_section(self, section: tableformat.Section, progress: Progress = None) -> Value:
+        def download() -> ValueTable:
+            data = self.read(self.data_addr + section.offset, section.size, progress)
+            return tableformat.unpack_section(self.index, data)
+
+        number = self.index.sections.index(section)
+        return self.cached(f"section{number}", download).to_value()
+
+    def load(self, value: Value):
+        """Read the contents of a namespace if that did not happen yet"""
+        section = self.unloaded.pop(value, None)
+        if section is not None:
+            value.children = self.read_section(section).children
+
+    def load_all(self):
+        for value in list(self.unloaded):
+            self.load(value)
+
+    def recv_into(self, view: memoryview):
+        """Receive exactly len(view) bytes into view"""
+        while view:
+            size = self.transport.recv_into(view)
+            if size == 0:
+                raise ConnectionError("Connection closed by target")
+            view = view[size:]
+
+    def recv_exact(self, size: int) -> bytearray:
+        data = bytearray(size)
+        self.recv_into(memoryview(data))
+        return data
+
     # The protocol commands
     def info(self) -> int:
         """Return address of the DEBUG_DATA section"""
-        self.sock.sendall(struct.pack("<B", 0))
-        addr = struct.unpack("<Q", self.sock.recv(8))[0]
+        self.transport.sendall(struct.pack("<B", 0))
+        addr = struct.unpack("<Q", self.recv_exact(8))[0]
         return addr
 
-    def read(self, addr: int, size: int) -> bytes:
-        """Read memory from address"""
+    def probe(self) -> int:
+        """Find the optional commands of the target, returns the address of the DEBUG_DATA section"""
+        # Targets without the features command ignore it and only reply to the info command
+        self.transport.sendall(struct.pack("<BB", 3, 0))
+        reply = self.recv_exact(8)
+        magic, features = struct.unpack("<II", reply)
+        if magic != FEATURES_MAGIC:
+            self.features = 0
+            return struct.unpack("<Q", reply)[0]
+
+        self.features = features
+        return struct.unpack("<Q", self.recv_exact(8))[0]
+
+    def devices(self) -> list[(int, str, int)]:
+        """List the (id, name, addr) of the devices behind the target, a target without the devices command is device 0"""
+        if not self.features & FEATURE_DEVICES:
+            return [(0, "", self.info())]
+
+        self.transport.sendall(struct.pack("<B", 5))
+        (count,) = struct.unpack("<I", self.recv_exact(4))
+        devices = []
+        for _ in range(count):
+            id, addr, name_size = struct.unpack("<IQB", self.recv_exact(13))
+            devices.append((id, self.recv_exact(name_size).decode(), addr))
+        return devices
+
+    def select(self, device: int):
+        """Send all following commands to device"""
+        if not self.features & FEATURE_DEVICES:
+            if device != 0:
+                raise ValueError(f"Target has no device {device}")
+            return
+        self.transport.sendall(struct.pack("<BI", 6, device))
+
+    def read(self, addr: int, size: int, progress: Progress = None) -> bytearray:
+        """Read memory from address, large reads are split into transfers of max_transfer"""
+        data = bytearray(size)
+        view = memoryview(data)
+        compressed = self.features & FEATURE_COMPRESSED_READ and size >= self.compress_min
+        self.read_into([(addr + offset, view[offset : offset + self.max_transfer]) for offset in range(0, size, self.max_transfer)], progress, compressed)
+        return data
+
+    def read_into(self, parts: list[(int, memoryview)], progress: Progress = None, compressed: bool = False):
+        """Read every (addr, view) part into its view, with up to max_pending read commands in flight"""
+        total = sum(len(view) for _, view in parts)
+        done = 0
+        sent = 0
+
+        # Previous data of compressed parts, taken when the request is sent
+        bases: list[bytes] = []
+        for index, (addr, view) in enumerate(parts):
+            while sent < len(parts) and sent < index + self.max_pending:
+                next_addr, next_view = parts[sent]
+                if compressed:
+                    base = self.read_bases.get((next_addr, len(next_view)))
+                    self.transport.sendall(struct.pack("<BQQB", 12, next_addr, len(next_view), base is not None))
+                    bases.append(base)
+                else:
+                    self.transport.sendall(struct.pack("<BQQ", 1, next_addr, len(next_view)))
+                sent += 1
+
+            if compressed:
+                self.recv_compressed(addr, view, bases[index])
+            else:
+                self.recv_into(view)
+            done += len(view)
+            if progress is not None:
+                progress(done, total)
+
+    def recv_compressed(self, addr: int, view: memoryview, base: bytes):
+        """Receive the reply to a compressed read, the data becomes the base of the next read of the range"""
+        encoding, size = struct.unpack("<BI", self.recv_exact(5))
+        view[:] = rle.unpack(encoding, self.recv_exact(size), len(view), base)
+        self.compressed_bytes += len(view)
+        self.received_bytes += 5 + size
+
+        # The target keeps no base for a range it could not read
+        key = (addr, len(view))
+        self.read_bases.pop(key, None)
+        if encoding == rle.ENCODING_ERROR:
+            return
+        self.read_bases[key] = bytes(view)
+        while len(self.read_bases) > self.max_read_bases:
+            del self.read_bases[next(iter(self.read_bases))]
+
+    def read_many(self, ranges: list[(int, int)]) -> list[bytes]:
+        """Read multiple (addr, size) ranges, with one round trip per READ_MANY_MAX ranges if the target supports it"""
+        if not self.features & FEATURE_READ_MANY:
+            result = [bytearray(size) for _, size in ranges]
+            parts = []
+            for (addr, size), data in zip(ranges, result):
+                view = memoryview(data)
+                parts += [(addr + offset, view[offset : offset + self.max_transfer]) for offset in range(0, size, self.max_transfer)]
+            self.read_into(parts)
+            self.round_trips += -(-len(parts) // self.max_pending)
+            return result
+
+        result = []
+        for start in range(0, len(ranges), READ_MANY_MAX):
+            batch = ranges[start : start + READ_MANY_MAX]
+            request = [struct.pack("<BI", 4, len(batch))]
+            request += [struct.pack("<QQ", addr, size) for addr, size in batch]
+            self.transport.sendall(b"".join(request))
+            self.round_trips += 1
+
+            data = self.recv_exact(sum(size for _, size in batch))
+            offset = 0
+            for _, size in batch:
+                result.append(data[offset : offset + size])
+                offset += size
+        return result
+
+    def read_ranges(self, ranges: list[(int, int)]) -> list[bytes]:
+        """Read (addr, size) ranges with as few transfers as possible, nearby ranges are read together"""
+        plan = ReadPlan(ranges, self.max_gap, self.max_transfer)
+        self.read_stats.add(plan)
+        return plan.split(self.read_many(plan.transfers))
+
+    def checksums(self, addr: int, size: int, block_size: int) -> list[int]:
+        """
+        Adler-32 of every block of a range, the last block can be shorter. A block_size of 0 is one block, like on the target.
+        Blocks the target can not read have CHECKSUM_ERROR, which never matches the Adler-32 of any data.
+        """
         if size == 0:
-            return bytes()
+            return []
+        self.transport.sendall(struct.pack("<BQQQ", 7, addr, size, block_size))
+        count = (size + block_size - 1) // block_size if block_size else 1
+        return list(struct.unpack(f"<{count}I", self.recv_exact(count * 4)))
+
+    def read_changed(self, addr: int, old: bytes, block_size: int = 256) -> bytearray:
+        """
+        Read len(old) bytes from address, old is the data of an earlier read of the same range.
+
+        When the target supports checksums only the blocks that changed since then are read,
+        the others cost 4 bytes each instead of block_size.
+        """
+        if not self.features & FEATURE_CHECKSUM:
+            return self.read(addr, len(old))
 
-        self.sock.sendall(struct.pack("<BQQ", 1, addr, size))
-        return self.sock.recv(size)
+        block_size = block_size or max(len(old), 1)
+        sums = self.checksums(addr, len(old), block_size)
+        changed = []
+        for offset, checksum in zip(range(0, len(old), block_size), sums):
+            if zlib.adler32(old[offset : offset + block_size]) != checksum:
+                changed.append((addr + offset, min(block_size, len(old) - offset)))
+
+        data = bytearray(old)
+        for (block_addr, size), block in zip(changed, self.read_ranges(changed)):
+            data[block_addr - addr : block_addr - addr + size] = block
+        return data
+
+    def sample_start(self, ranges: list[(int, int)], period_us: int = 0) -> int:
+        """
+        Let the target copy (addr, size) ranges into its sample buffer every period_us microseconds,
+        or on every inspect_sample() call in the target when period_us is 0. Returns the number of samples the buffer holds.
+        """
+        if not self.features & FEATURE_SAMPLE:
+            raise ValueError("Target does not support sampling")
+        if len(ranges) > SAMPLE_MAX_RANGES:
+            raise ValueError(f"At most {SAMPLE_MAX_RANGES} ranges can be sampled")
+
+        request = [struct.pack("<BII", 8, period_us, len(ranges))]
+        request += [struct.pack("<QQ", addr, size) for addr, size in ranges]
+        self.transport.sendall(b"".join(request))
+        record_size, capacity = struct.unpack("<II", self.recv_exact(8))
+        if ranges and record_size == 0:
+            raise ValueError("Sampled ranges do not fit in the sample buffer of the target, can not be read, or another client is sampling")
+
+        self.sample_sizes = [size for _, size in ranges]
+        self.sample_next = 0
+        self.samples_lost = 0
+        return capacity
+
+    def sample_stop(self):
+        self.sample_start([])
+
+    def sample_drain(self, max_count: int = None) -> list[Sample]:
+        """Receive all samples taken since the last drain, in large replies"""
+        record_size = 8 + sum(self.sample_sizes)
+        if max_count is None:
+            max_count = max(65536 // record_size, 1)
+
+        samples = []
+        while True:
+            self.transport.sendall(struct.pack("<BI", 9, max_count))
+            seq, count = struct.unpack("<QI", self.recv_exact(12))
+            data = memoryview(self.recv_exact(count * record_size))
+
+            # Samples that were overwritten before they were drained
+            self.samples_lost += seq - self.sample_next
+            self.sample_next = seq + count
+
+            for index in range(count):
+                record = data[index * record_size : (index + 1) * record_size]
+                values = []
+                offset = 8
+                for size in self.sample_sizes:
+                    values.append(bytes(record[offset : offset + size]))
+                    offset += size
+                samples.append(Sample(seq + index, int.from_bytes(record[:8], "little"), values))
+
+            if count < max_count:
+                return samples
 
     def write(self, addr: int, data: bytes):
         """Write memory to address"""
-        self.sock.sendall(struct.pack("<BQQ", 2, addr, len(data)))
-        self.sock.sendall(data)
+        self.transport.sendall(struct.pack("<BQQ", 2, addr, len(data)))
+        self.transport.sendall(data)
+        self.shadow.store(addr, data)
+
+    def view(self, max_age: float) -> ShadowView:
+        """Reads through the memory mirror, data that is at most max_age seconds old is not read again"""
+        return ShadowView(self, max_age)
 
     # Helper functions
     def read_int(self, addr: int, len: int) -> int:
@@ -66,8 +422,219 @@ class Client:
     def write_int(self, addr: int, len: int, data: int):
         self.write(addr, data.to_bytes(len, "little"))
 
+    def symbols(self) -> SymbolIndex:
+        """
+        Index of the variables, built once from the namespaces that are read.
+        With a table directory the other namespaces are read and added when a variable in them is looked up,
+        older tables read every namespace first.
+        """
+        if self.symbol_index is None:
+            if self.index.directory is None:
+                # Tables before version 5 have no directory, every namespace is needed to find a name
+                self.load_all()
+                self.symbol_index = SymbolIndex(self.root)
+            else:
+                directory = {name: self.namespaces[number] for name, number in self.index.directory.items()}
+                self.symbol_index = SymbolIndex(self.root, directory, self.load)
+        return self.symbol_index
+
     def find_variable(self, name: str) -> Value:
-        for var in self.root.variables():
-            if var.name == name:
-                return var
-        return None
+        """Variable by plain or qualified name, None if there is none. Reads the namespace of the variable when it was not read yet."""
+        return self.symbols().find(name)
+
+    def resolve(self, path: str) -> Symbol:
+        """
+        Address and type of a variable or one of its members, like `ns::g_state.motor[2].speed`.
+        Reads the namespace of the variable when it was not read yet, and the pointers along the path.
+        """
+        return self.symbols().resolve(path, self.base_address, self.read_int)
+
+
+@contextlib.contextmanager
+def fake_target(handle: Callable[[int, socket.socket], None], features: int = 0) -> Iterator[Client]:
+    """
+    Client connected to a target for the tests, running in a thread.
+    Every command byte is passed to handle, which receives the rest of the command and sends the reply.
+    """
+    import threading
+
+    def serve(sock: socket.socket):
+        with sock:
+            while command := sock.recv(1):
+                handle(command[0], sock)
+
+    client = Client()
+    client_sock, target_sock = socket.socketpair()
+    client.transport = SocketTransport(client_sock)
+    client.features = features
+    thread = threading.Thread(target=serve, args=(target_sock,))
+    thread.start()
+    try:
+        yield client
+    finally:
+        client.transport.close()
+        thread.join()
+
+
+def recv_args(sock: socket.socket, format: str) -> tuple:
+    """Arguments of a command received by a test target"""
+    return struct.unpack(format, sock.recv(struct.calcsize(format), socket.MSG_WAITALL))
+
+
+def test_read_chunked():
+    memory = bytes(range(256)) * 4
+    commands = []
+
+    def handle(command: int, sock: socket.socket):
+        # Only answers the read command, memory starts at address 0x1000
+        addr, size = recv_args(sock, "<QQ")
+        commands.append((command, addr, size))
+        sock.sendall(memory[addr - 0x1000 : addr - 0x1000 + size])
+
+    with fake_target(handle) as client:
+        client.max_transfer = 100
+        client.max_pending = 3
+        progress = []
+        assert client.read(0x1010, 1000, lambda done, total: progress.append((done, total))) == memory[0x10 : 0x10 + 1000]
+        assert commands == [(1, 0x1010 + offset, min(100, 1000 - offset)) for offset in range(0, 1000, 100)]
+        assert progress == [(min(done, 1000), 1000) for done in range(100, 1001, 100)]
+
+        assert client.read(0x1000, 0) == b""
+        assert client.read_many([(0x1000, 150), (0x1002, 2)]) == [memory[0:150], memory[2:4]]
+
+
+def test_read_changed():
+    memory = bytearray(1000)
+    commands = []
+    unreadable = set()
+
+    def handle(command: int, sock: socket.socket):
+        # Answers the read and checksum commands, memory starts at address 0x1000
+        if command == 1:
+            addr, size = recv_args(sock, "<QQ")
+            commands.append((1, addr, size))
+            sock.sendall(memory[addr - 0x1000 : addr - 0x1000 + size])
+        elif command == 7:
+            addr, size, block_size = recv_args(sock, "<QQQ")
+            block_size = block_size or size
+            data = memory[addr - 0x1000 : addr - 0x1000 + size]
+            sums = [CHECKSUM_ERROR if addr + i in unreadable else zlib.adler32(data[i : i + block_size]) for i in range(0, size, block_size)]
+            sock.sendall(struct.pack(f"<{len(sums)}I", *sums))
+
+    with fake_target(handle, FEATURE_CHECKSUM) as client:
+        old = bytes(memory)
+        memory[10] = 1
+        memory[999] = 2
+        client.max_gap = 0
+        assert client.read_changed(0x1000, old, 100) == memory
+        assert commands == [(1, 0x1000, 100), (1, 0x1000 + 900, 100)]
+        assert client.read_changed(0x1000, memory, 100) == memory
+        assert len(commands) == 2
+
+        # A block the target can not checksum is read again
+        unreadable.add(0x1000 + 500)
+        assert client.read_changed(0x1000, memory, 100) == memory
+        assert commands[2:] == [(1, 0x1000 + 500, 100)]
+
+        # A block size of 0 is one block for the whole range, the connection stays in sync
+        unreadable.clear()
+        assert client.checksums(0x1000, 1000, 0) == [zlib.adler32(memory)]
+        memory[0] = 3
+        assert client.read_changed(0x1000, old, 0) == memory
+        assert commands[3:] == [(1, 0x1000, 1000)]
+        assert client.checksums(0x1000, 10, 4) == [zlib.adler32(memory[i : min(i + 4, 10)]) for i in range(0, 10, 4)]
+
+
+def test_sample():
+    memory = bytearray(range(64))
+    samples = []
+    drained_count = [0]
+
+    def handle(command: int, sock: socket.socket):
+        # Answers the sample commands, every configured sample is taken right away and the buffer holds 4 samples
+        if command == 8:
+            period, count = recv_args(sock, "<II")
+            ranges = [recv_args(sock, "<QQ") for _ in range(count)]
+            sock.sendall(struct.pack("<II", 8 + sum(size for _, size in ranges), 4))
+            for time in range(6):
+                memory[0] = time
+                samples.append(struct.pack("<Q", time * 1000) + b"".join(memory[addr : addr + size] for addr, size in ranges))
+        elif command == 9:
+            (max_count,) = recv_args(sock, "<I")
+            first = max(drained_count[0], len(samples) - 4)
+            count = min(len(samples) - first, max_count)
+            sock.sendall(struct.pack("<QI", first, count) + b"".join(samples[first : first + count]))
+            drained_count[0] = first + count
+
+    with fake_target(handle, FEATURE_SAMPLE) as client:
+        assert client.sample_start([(0, 1), (10, 2)]) == 4
+        drained = client.sample_drain(max_count=3)
+        assert [(s.seq, s.time, s.values) for s in drained] == [(seq, seq * 1000, [bytes([seq]), b"\x0a\x0b"]) for seq in range(2, 6)]
+        assert client.samples_lost == 2
+        assert client.sample_drain() == []
+
+
+def test_read_compressed():
+    memory = bytearray(4096)
+    memory[100:110] = b"0123456789"
+
+    # The last data of every range, like inspect.c
+    bases = {}
+
+    def handle(command: int, sock: socket.socket):
+        # Answers the read and compressed read commands
+        addr, size = recv_args(sock, "<QQ")
+        data = bytes(memory[addr - 0x1000 : addr - 0x1000 + size])
+        if command == 1:
+            sock.sendall(data)
+            return
+        (has_base,) = recv_args(sock, "<B")
+        base = bases.get((addr, size)) if has_base else None
+        if addr >= 0x2000:
+            sock.sendall(struct.pack("<BI", rle.ENCODING_ERROR, 0))
+            return
+        if base is not None:
+            reply = (rle.ENCODING_DELTA, rle.encode(rle.xor(data, base)))
+        else:
+            reply = (rle.ENCODING_RLE, rle.encode(data))
+        if len(reply[1]) >= size:
+            reply = (rle.ENCODING_RAW, data)
+        bases[addr, size] = data
+        sock.sendall(struct.pack("<BI", reply[0], len(reply[1])) + reply[1])
+
+    with fake_target(handle, FEATURE_COMPRESSED_READ) as client:
+        client.max_transfer = 1024
+        assert client.read(0x1000, 4096) == memory
+        assert client.received_bytes < 64
+
+        # Random data is sent raw, the next read of it only sends what changed
+        memory[2000:3000] = bytes((i * 7919) % 251 for i in range(1000))
+        assert client.read(0x1000, 4096) == memory
+        memory[2500] ^= 0xFF
+        received = client.received_bytes
+        assert client.read(0x1000, 4096) == memory
+        assert client.received_bytes - received < 64
+        assert client.read(0x1000, 100) == memory[:100]
+
+        # Memory the target can not read is zeros and leaves no base behind
+        assert client.read(0x2000, 1024) == bytes(1024)
+        assert (0x2000, 1024) not in client.read_bases
+
+
+def test_table_cache(tmp_path):
+    client = Client(DiskCache(str(tmp_path), 1024))
+    client.index = tableformat.TableIndex(tableformat.FORMAT_VERSION, hash=bytes(16))
+    loads = []
+
+    def load() -> list[int]:
+        loads.append(1)
+        return [1, 2, 3]
+
+    assert client.cached("index", load) == [1, 2, 3]
+    assert client.cached("index", load) == [1, 2, 3]
+    assert len(loads) == 1
+
+    # Tables without a hash are never cached
+    client.index = tableformat.TableIndex(3)
+    client.cached("index", load)
+    assert len(loads) == 2
@@ -1,3 +1,9 @@
+import hashlib
+import multiprocessing
+import pickle
+from array import array
+from io import BytesIO
+from typing import Iterator
 from elftools.elf.elffile import ELFFile
 from elftools.dwarf.descriptions import describe_DWARF_expr, set_global_machine_arch
 from elftools.dwarf.locationlists import LocationEntry, LocationExpr, LocationParser, LocationLists
@@ -5,12 +11,359 @@ from elftools.dwarf.dwarf_expr import DWARFExprParser
 from elftools.dwarf.dwarfinfo import DWARFInfo
 from elftools.dwarf.compileunit import CompileUnit
 from elftools.dwarf.die import DIE
+import value as value_module
 from value import Value, ValueTag
+from table import ValueTable
+from cache import DiskCache
+import store
 
 
-def load(path: str) -> Value:
-    elf = ELFFile(open(path, "rb"))
-    dwarf: DWARFInfo = elf.get_dwarf_info()
+def load(path: str, jobs: int = 1, cache: DiskCache = None) -> ValueTable:
+    """
+    Load all compile units, using a pool of `jobs` worker processes when jobs > 1.
+    When a cache is given, compile units that did not change since the previous run are loaded from the cache.
+
+    The values of each compile unit are added to the returned table and then dropped,
+    so only a few compile units exist as Value objects at any time.
+    """
+    table = ValueTable()
+    table.add(ValueTag.Namespace, path)
+    root_children = array("I")
+
+    with open(path, "rb") as file:
+        dwarf: DWARFInfo = ELFFile(file).get_dwarf_info()
+        cu_list: list[CompileUnit] = list(dwarf.iter_CUs())
+        cu_keys = cu_cache_keys(dwarf, cu_list) if cache is not None else [None] * len(cu_list)
+        missing = [i for i, key in enumerate(cu_keys) if key is None or not cache.contains(key)]
+
+        # Results for the missing compile units, in order
+        pool = None
+        results: Iterator[(list[Value], bool)] = (load_cu(dwarf, cu_list[i]) for i in missing)
+        if jobs > 1 and missing:
+            # Each worker opens its own copy of the ELF file and converts whole compile units.
+            # The results are collected in the original CU order, so the tree is identical to the serial path.
+            cu_offsets = [cu_list[i].cu_offset for i in missing]
+            chunk_size = max(1, len(cu_offsets) // (jobs * 4))
+            pool = multiprocessing.Pool(jobs, initializer=load_worker_init, initargs=(path,))
+            results = pool.imap(load_worker, cu_offsets, chunk_size)
+
+        missing = set(missing)
+        for i, key in enumerate(cu_keys):
+            if i in missing:
+                values, self_contained = next(results)
+                if cache is not None and self_contained:
+                    cache.put(key, pickle.dumps(values, pickle.HIGHEST_PROTOCOL))
+            else:
+                values = cache_load(cache, key)
+                if values is None:
+                    # Removed by another process or unreadable
+                    values, _ = load_cu(dwarf, cu_list[i])
+
+            # Values are only shared within a compile unit
+            rows: dict[Value, int] = {}
+            root_children.extend(table.add_value(v, rows) for v in values)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    table.set_children(0, root_children)
+    if cache is not None:
+        cache.evict()
+        print(f"Compile unit cache: {len(cu_list) - len(missing)} hits, {len(missing)} misses")
+    return table
+
+
+# The dwarf info for the current worker process
+worker_dwarf: DWARFInfo = None
+
+
+def load_worker_init(path: str):
+    global worker_dwarf
+    worker_dwarf = ELFFile(open(path, "rb")).get_dwarf_info()
+
+
+def load_worker(cu_offset: int) -> (list[Value], bool):
+    return load_cu(worker_dwarf, worker_dwarf.get_CU_at(cu_offset))
+
+
+# Cached compile units are invalidated when the conversion code or the pickled Value class changes
+loader_digest = b""
+for module in [__file__, value_module.__file__]:
+    with open(module, "rb") as file:
+        loader_digest = hashlib.blake2b(loader_digest + file.read(), digest_size=16).digest()
+
+
+def section_data(section) -> bytes:
+    if section is None:
+        return b""
+    section.stream.seek(0)
+    return section.stream.read()
+
+
+def read_abbrev_table(stream, offset: int) -> dict[int, list[(int, int)]]:
+    """Attributes and forms of every abbreviation code in the table at offset"""
+    stream.seek(offset)
+    table = {}
+    while (code := store.read_varint(stream)) != 0:
+        # Tag and children flag
+        store.read_varint(stream)
+        stream.read(1)
+        attrs = table[code] = []
+        while True:
+            attr = store.read_varint(stream)
+            form = store.read_varint(stream)
+            if attr == 0 and form == 0:
+                break
+            attrs.append((attr, form))
+            # DW_FORM_implicit_const stores the value inside the table
+            if form == 0x21:
+                store.read_varint(stream)
+    return table
+
+
+# Size of the forms with a fixed size, see section 7.5.6 of the DWARF 5 standard
+FORM_SIZE = {
+    0x05: 2, 0x06: 4, 0x07: 8, 0x0B: 1, 0x0C: 1, 0x11: 1, 0x12: 2, 0x13: 4, 0x14: 8, 0x19: 0,
+    0x1E: 16, 0x20: 8, 0x21: 0, 0x25: 1, 0x26: 2, 0x27: 3, 0x28: 4, 0x29: 1, 0x2A: 2, 0x2B: 3, 0x2C: 4,
+}  # fmt: skip
+
+# Forms holding a LEB128 value (sdata, udata, ref_udata, strx, addrx, loclistx, rnglistx)
+FORM_LEB128 = {0x0D, 0x0F, 0x15, 0x1A, 0x1B, 0x22, 0x23}
+
+# Forms holding an index into .debug_str_offsets (strx, strx1-4) or .debug_addr (addrx, addrx1-4)
+FORM_STRX = {0x1A, 0x25, 0x26, 0x27, 0x28}
+FORM_ADDRX = {0x1B, 0x29, 0x2A, 0x2B, 0x2C}
+
+# Forms holding an offset into a string section (strp, line_strp)
+FORM_STRP = {0x0E: "str", 0x1F: "line_str"}
+
+# Forms referring outside the unit (ref_addr, ref_sup4, strp_sup, ref_sup8), the unit is never cached
+FORM_EXTERNAL = {0x10, 0x1C, 0x1D, 0x24}
+
+# Forms with a length before the data (block1, block2, block4)
+FORM_BLOCK = {0x0A: 1, 0x03: 2, 0x04: 4}
+
+DW_FORM_data4 = 0x06
+DW_FORM_data8 = 0x07
+DW_FORM_sec_offset = 0x17
+DW_FORM_loclistx = 0x22
+
+DW_AT_location = 0x02
+DW_AT_data_member_location = 0x38
+DW_AT_str_offsets_base = 0x72
+DW_AT_addr_base = 0x73
+DW_AT_loclists_base = 0x8C
+
+# Code addresses are not converted, they move when an earlier unit grows (low_pc, high_pc, entry_pc, call_return_pc, call_pc)
+CODE_ATTRS = {0x11, 0x12, 0x52, 0x7D, 0x81}
+
+
+def read_leb128(data: bytes, pos: int) -> (int, int):
+    """Unsigned LEB128 at pos, returns the value and the position after it"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+def c_string(data: bytes, offset: int) -> bytes:
+    return data[offset : data.index(b"\0", offset) + 1]
+
+
+def contribution(data: bytes, base: int, header_size: int, offset_size: int) -> bytes:
+    """Entries of the .debug_str_offsets, .debug_addr or .debug_loclists contribution of a unit, base points after its header"""
+    length_pos = base - header_size + (4 if offset_size == 8 else 0)
+    length = int.from_bytes(data[length_pos : length_pos + offset_size], "little")
+    return data[base : length_pos + offset_size + length]
+
+
+def location_list(data: bytes, offset: int, version: int, address_size: int) -> bytes:
+    """Entries of the location list at offset in .debug_loc, or in .debug_loclists from version 5"""
+    pos = offset
+    if version < 5:
+        # Pairs of addresses followed by an expression, a pair of zeros ends the list
+        while True:
+            begin = int.from_bytes(data[pos : pos + address_size], "little")
+            end = int.from_bytes(data[pos + address_size : pos + 2 * address_size], "little")
+            pos += 2 * address_size
+            if begin == 0 and end == 0:
+                return data[offset:pos]
+            # A base address selection entry has no expression
+            if begin != (1 << 8 * address_size) - 1:
+                pos += 2 + int.from_bytes(data[pos : pos + 2], "little")
+
+    # Entries start with their kind, DW_LLE_end_of_list ends the list
+    while True:
+        kind = data[pos]
+        pos += 1
+        if kind == 0:
+            return data[offset:pos]
+        if kind in (1, 2, 3, 4):
+            # base_addressx, startx_endx, startx_length, offset_pair
+            for _ in range(1 if kind == 1 else 2):
+                _, pos = read_leb128(data, pos)
+        elif kind == 6 or kind == 7:
+            # base_address, start_end
+            pos += address_size * (kind - 5)
+        elif kind == 8:
+            # start_length
+            _, pos = read_leb128(data, pos + address_size)
+        elif kind != 5:
+            raise ValueError(f"Unknown location list entry {kind}")
+        # Every entry but the base address has an expression
+        if kind not in (1, 6):
+            size, pos = read_leb128(data, pos)
+            pos += size
+
+
+def cu_key_update(key, info: bytes, abbrevs: dict[int, list[(int, int)]], cu: CompileUnit, sections: dict[str, bytes]) -> bool:
+    """
+    Add the DIEs of a compile unit to the key, with the data they refer to instead of their offsets into other sections.
+    Returns False when the unit can not be cached, because it refers outside of the unit or uses an unsupported form.
+    """
+    version = cu["version"]
+    offset_size = 8 if cu.dwarf_format() == 64 else 4
+    address_size = cu["address_size"]
+    bases = {}
+    forms = set()
+
+    # The unit header without the offset of the abbreviation table, the table itself is part of the key
+    header = cu.cu_offset + (12 if offset_size == 8 else 4)
+    abbrev_pos = header + (4 if version >= 5 else 2)
+    key.update(info[header:abbrev_pos])
+    key.update(info[abbrev_pos + offset_size : cu.cu_die_offset])
+
+    end = cu.cu_offset + cu.size
+    pos = last = cu.cu_die_offset
+    while pos < end:
+        code, pos = read_leb128(info, pos)
+        if code == 0:
+            continue
+        if code not in abbrevs:
+            return False
+        for attr, form in abbrevs[code]:
+            # DW_FORM_indirect stores the form before the value
+            while form == 0x16:
+                form, pos = read_leb128(info, pos)
+            forms.add(form)
+            start = pos
+            if form in FORM_SIZE:
+                pos += FORM_SIZE[form]
+            elif form in FORM_LEB128:
+                _, pos = read_leb128(info, pos)
+            elif form in FORM_STRP or form == DW_FORM_sec_offset:
+                pos += offset_size
+            elif form == 0x01:
+                pos += address_size
+            elif form == 0x08:
+                pos = info.index(b"\0", pos) + 1
+            elif form in (0x09, 0x18):
+                size, pos = read_leb128(info, pos)
+                pos += size
+            elif form in FORM_BLOCK:
+                size_size = FORM_BLOCK[form]
+                pos += size_size + int.from_bytes(info[pos : pos + size_size], "little")
+            else:
+                # Also FORM_EXTERNAL, those units depend on other units and are not cached by load either
+                return False
+
+            # Offsets into other sections and code addresses move when an earlier unit grows, they are left out.
+            # The strings and location lists that are converted are added by their contents.
+            # Before version 4 location lists are referred to with data4 and data8.
+            offset = form == DW_FORM_sec_offset or (version < 4 and form in (DW_FORM_data4, DW_FORM_data8) and attr in (DW_AT_location, DW_AT_data_member_location))
+            if not (offset or form in FORM_STRP or attr in CODE_ATTRS):
+                continue
+            key.update(info[last:start])
+            last = pos
+            value = int.from_bytes(info[start:pos], "little")
+            if form in FORM_STRP:
+                key.update(c_string(sections[FORM_STRP[form]], value))
+            elif attr in (DW_AT_str_offsets_base, DW_AT_addr_base, DW_AT_loclists_base):
+                bases[attr] = value
+            elif offset and attr in (DW_AT_location, DW_AT_data_member_location):
+                key.update(location_list(sections["loc" if version < 5 else "loclists"], value, version, address_size))
+    if pos != end:
+        return False
+    key.update(info[last:end])
+
+    # Strings, addresses and location lists indexed by strx, addrx and loclistx.
+    # Only the contribution of this unit is used, a unit without a base uses the first contribution.
+    # The headers of .debug_loclists are 4 bytes longer.
+    header_size = 2 * offset_size
+    if DW_AT_str_offsets_base in bases or forms & FORM_STRX:
+        entries = contribution(sections["str_offsets"], bases.get(DW_AT_str_offsets_base, header_size), header_size, offset_size)
+        for i in range(0, len(entries), offset_size):
+            key.update(c_string(sections["str"], int.from_bytes(entries[i : i + offset_size], "little")))
+    if DW_AT_addr_base in bases or forms & FORM_ADDRX:
+        key.update(contribution(sections["addr"], bases.get(DW_AT_addr_base, header_size), header_size, offset_size))
+    if DW_FORM_loclistx in forms:
+        key.update(contribution(sections["loclists"], bases.get(DW_AT_loclists_base, header_size + 4), header_size + 4, offset_size))
+    return True
+
+
+def cu_cache_keys(dwarf: DWARFInfo, cu_list: list[CompileUnit]) -> list[str]:
+    """
+    Cache key of each compile unit, None when the unit can not be cached.
+
+    The key covers the DIEs and abbreviation table of the unit, and the strings, addresses and location lists those DIEs use.
+    Offsets into shared sections are left out, so changes to other compile units do not change the key.
+    """
+    info = section_data(dwarf.debug_info_sec)
+    abbrev = section_data(dwarf.debug_abbrev_sec)
+    abbrev_stream = BytesIO(abbrev)
+    sections = {
+        "str": section_data(dwarf.debug_str_sec),
+        "line_str": section_data(dwarf.debug_line_str_sec),
+        "str_offsets": section_data(dwarf.debug_str_offsets_sec),
+        "addr": section_data(dwarf.debug_addr_sec),
+        "loc": section_data(dwarf.debug_loc_sec),
+        "loclists": section_data(dwarf.debug_loclists_sec),
+    }
+
+    # Units often share an abbreviation table
+    abbrev_tables: dict[int, (dict, bytes)] = {}
+    keys = []
+    for cu in cu_list:
+        abbrev_offset = cu["debug_abbrev_offset"]
+        if abbrev_offset not in abbrev_tables:
+            abbrevs = read_abbrev_table(abbrev_stream, abbrev_offset)
+            abbrev_tables[abbrev_offset] = abbrevs, abbrev[abbrev_offset : abbrev_stream.tell()]
+        abbrevs, abbrev_data = abbrev_tables[abbrev_offset]
+
+        key = hashlib.blake2b(loader_digest, digest_size=16)
+        key.update(abbrev_data)
+        try:
+            keyed = cu_key_update(key, info, abbrevs, cu, sections)
+        except (IndexError, ValueError):
+            # Truncated or corrupt unit, just parse it every time
+            keyed = False
+        keys.append(key.hexdigest() if keyed else None)
+    return keys
+
+
+def cache_load(cache: DiskCache, key: str) -> list[Value]:
+    data = cache.get(key)
+    if data is None:
+        return None
+    try:
+        return pickle.loads(data)
+    except Exception:
+        # Corrupt or incompatible entry, just parse the compile unit again
+        return None
+
+
+def load_cu(dwarf: DWARFInfo, cu: CompileUnit) -> (list[Value], bool):
+    """
+    Convert a single compile unit to values, every compile unit gets its own set of values.
+    Also returns if the values only depend on DIEs of this compile unit.
+    """
+    self_contained = True
     location_list: LocationLists = dwarf.location_lists()
     location_parser = LocationParser(location_list)
     expr_parser = DWARFExprParser(dwarf.structs)
@@ -65,10 +418,16 @@ def load(path: str) -> Value:
         return result
 
     def visit(die: DIE) -> [Value]:
+        nonlocal self_contained
+
         # Check cache
         if die.offset in value_cache:
             return [value_cache[die.offset]]
 
+        # Referenced from another compile unit
+        if die.cu is not cu:
+            self_contained = False
+
         # Append a value
         if die.tag == "DW_TAG_compile_unit" or die.tag == "DW_TAG_namespace":
             value = value_new(die, ValueTag.Namespace)
@@ -101,8 +460,7 @@ def load(path: str) -> Value:
         elif die.tag == "DW_TAG_pointer_type":
             value = value_new(die, ValueTag.Pointer)
             value.children = visit_typeof(die)
-            # TODO: use native platform size
-            value.value = 8
+            value.value = die.attributes["DW_AT_byte_size"].value if "DW_AT_byte_size" in die.attributes else die.cu["address_size"]
             return [value]
         elif die.tag == "DW_TAG_array_type":
             value = value_new(die, ValueTag.Array)
@@ -136,6 +494,9 @@ def load(path: str) -> Value:
         elif die.tag == "DW_TAG_enumerator":
             value = value_new(die, ValueTag.EnumValue)
             value.value = die.attributes["DW_AT_const_value"].value
+            # Unsigned constants of 64 bit enums are stored signed, like the enum values in a table
+            if value.value >= 1 << 63:
+                value.value -= 1 << 64
             return [value]
         elif die.tag == "DW_TAG_base_type":
             value = value_new(die, ValueTag.BaseType)
@@ -154,9 +515,47 @@ def load(path: str) -> Value:
             return []
 
     # ==== Parsing ====
-    root = Value(ValueTag.Namespace, path)
-    for cu in dwarf.iter_CUs():  # type: CompileUnit
-        cu_die: DIE = cu.get_top_DIE()
-        root.children += visit(cu_die)
-    elf.close()
-    return root
+    values = visit(cu.get_top_DIE())
+    return values, self_contained
+
+
+def test_cu_cache_keys(tmp_path):
+    import pytest
+    import shutil
+    import subprocess
+
+    if shutil.which("gcc") is None:
+        pytest.skip("gcc is not installed")
+
+    # Optimized code has location lists, every unit refers to shared strings
+    sources = {
+        "a.c": "static struct { int x, y; } g_a_point; int a_sum(int n) { int s = 0; while (n) s += n--; return s + g_a_point.x; }\n",
+        "b.c": "enum mode { MODE_OFF, MODE_ON }; static enum mode g_b_mode; int b_scale(int v, int k) { int r = v * k; return g_b_mode ? r : r + 1; }\n",
+        "c.c": "static long g_c_value; int a_sum(int); int b_scale(int, int); int main(int argc, char **argv) { (void)argv; g_c_value += argc; return a_sum(argc) + b_scale(argc, 3) + (int)g_c_value; }\n",
+    }
+
+    def keys(version: int, sources: dict[str, str]) -> list[str]:
+        for name, source in sources.items():
+            (tmp_path / name).write_text(source)
+        path = str(tmp_path / "prog")
+        subprocess.check_call(["gcc", f"-gdwarf-{version}", "-O2", "-o", path, *sources], cwd=tmp_path)
+        with open(path, "rb") as file:
+            dwarf = ELFFile(file).get_dwarf_info()
+            return cu_cache_keys(dwarf, list(dwarf.iter_CUs()))
+
+    for version in [4, 5]:
+        before = keys(version, sources)
+        assert len(before) == 3 and None not in before
+
+        # A larger first unit moves the strings, abbreviations, location lists and code of the others
+        grown = dict(sources)
+        grown["a.c"] += "int a_more(int argument_with_a_new_name) { int t = 1; while (argument_with_a_new_name--) t *= 3; return t; }\n"
+        after = keys(version, grown)
+        assert after[0] != before[0]
+        assert after[1:] == before[1:]
+
+        # A changed variable changes only its own unit
+        changed = dict(sources)
+        changed["b.c"] = changed["b.c"].replace("static enum mode g_b_mode", "static enum mode g_b_mode_renamed").replace("g_b_mode ?", "g_b_mode_renamed ?")
+        after = keys(version, changed)
+        assert [a == b for a, b in zip(before, after)] == [True, False, True]
@@ -2,8 +2,12 @@ import argparse
 import time
 import curses
 from typing import Self
+import cache
+from cache import DiskCache
 from value import Value, ValueTag
-from client import Client
+from client import Client, print_progress
+from shadow import ShadowView
+from transport import open_target
 
 
 class RtNode:
@@ -16,18 +20,64 @@ class RtNode:
         self.offset = offset
         self.addr = 0
 
+        # Type that waits for data during an update
+        self.pending: Value = None
+
         if self.value.tag == ValueTag.Variable:
             self.offset = self.value.value
 
         if not self.name:
             self.name = self.value.pretty()
 
-    def update(self, client: Client, addr: int):
+    def update(self, client: Client | ShadowView, addr: int) -> int:
+        """
+        Read the values of this node and all expanded nodes below it, returns the number of bulk reads.
+
+        Each pass first walks every node as far as it can without data and collects the ranges the nodes wait for,
+        then reads all of them at once. Nodes behind one more pointer wait for the next pass.
+        """
+        self.start(addr)
+        todo = [self]
+        passes = 0
+        while todo:
+            waiting: list[(RtNode, (int, int))] = []
+            while todo:
+                node = todo.pop()
+                range = node.step()
+                if range is not None:
+                    waiting.append((node, range))
+                elif node.text == "NULL":
+                    for child in node.children:
+                        child.clear()
+                else:
+                    for child in node.children:
+                        child.start(node.addr)
+                        todo.append(child)
+
+            if waiting:
+                passes += 1
+                for (node, _), data in zip(waiting, client.read_many([range for _, range in waiting])):
+                    node.decode(data)
+                    todo.append(node)
+        return passes
+
+    def start(self, addr: int):
         # Add array/struct offset
         self.addr = addr + self.offset
         self.text = None
         self.can_edit = False
-        type: Value = self.value
+        self.pending = self.value
+
+    def clear(self):
+        self.text = None
+        self.can_edit = False
+        for c in self.children:
+            c.clear()
+
+    def step(self) -> (int, int):
+        """Follow the type until data is needed, returns the (addr, size) range to read or None when the value is known"""
+        type = self.pending
+        self.pending = None
         while True:
             if type == None:
                 break
@@ -35,38 +85,43 @@ class RtNode:
                 type = type.type()
             elif type.tag == ValueTag.Typedef:
                 type = type.type()
-            elif type.tag == ValueTag.Pointer:
-                self.addr = client.read_int(self.addr, type.value)
-                type = type.type()
-                if self.addr == 0:
-                    self.text = "NULL"
-                    break
-            elif type.tag == ValueTag.Enum:
-                data = client.read_int(self.addr, type.value)
-                tag = [c for c in type.children if c.value == data]
-                self.text = f"{tag[0].name} ({data})" if tag != [] else str(data)
-                break
+            elif type.tag == ValueTag.Pointer or type.tag == ValueTag.Enum or type.tag == ValueTag.BaseType:
+                self.pending = type
+                return (self.addr, type.value)
             elif type.tag == ValueTag.Struct:
                 self.text = "{}"
                 break
             elif type.tag == ValueTag.Array:
                 self.text = "[]"
                 break
-            elif type.tag == ValueTag.BaseType:
-                self.can_edit = True
-                data = client.read_int(self.addr, type.value)
-                if type.name == "char":
-                    self.text = f"{str(data)} ({repr(chr(data))})"
-                else:
-                    self.text = str(data)
-                break
             else:
                 break
+        return None
+
+    def decode(self, data: bytes):
+        """Continue with the data of the range returned by step"""
+        type = self.pending
+        self.pending = None
+        value = int.from_bytes(data, "little")
+        if type.tag == ValueTag.Pointer:
+            self.addr = value
+            if value == 0:
+                self.text = "NULL"
+            else:
+                self.pending = type.type()
+        elif type.tag == ValueTag.Enum:
+            # Enumerators can be negative, compare their bit patterns at the size of the enum
+            mask = (1 << 8 * type.value) - 1
+            tag = [c for c in type.children if c.value & mask == value]
+            self.text = f"{tag[0].name} ({value})" if tag != [] else str(value)
+        elif type.tag == ValueTag.BaseType:
+            self.can_edit = True
+            if type.name == "char":
+                self.text = f"{str(value)} ({repr(chr(value))})"
+            else:
+                self.text = str(value)
 
-        for c in self.children:
-            c.update(client, self.addr)
-
-    def write(self, client: Client, value: str):
+    def write(self, client: Client | ShadowView, value: str):
         type: Value = self.value
         while True:
             if type == None:
@@ -96,8 +151,9 @@ class RtNode:
             else:
                 break
 
-    def expand(self):
+    def expand(self, client: Client):
         if self.value.tag == ValueTag.Namespace:
+            client.load(self.value)
             self.children = [RtNode(n) for n in self.value.children]
             return
 
@@ -166,12 +222,15 @@ class RtNode:
 
 class Gui:
 
-    def __init__(self, client: Client):
+    def __init__(self, client: Client, max_age: float = 0.0):
         self.client = client
 
+        # Values are read through the memory mirror, redrawing right after a key press needs no new reads
+        self.memory = client.view(max_age)
+
         # Tree of expanded nodes
         self.node = RtNode(client.root)
-        self.node.expand()
+        self.node.expand(client)
 
         # Current highlighed line
         self.cursor = 0
@@ -186,8 +245,17 @@ class Gui:
         self.edit_text: str = ""
         self.debug = False
 
+        # Duration and reads of the last update
+        self.frame_time = 0.0
+        self.passes = 0
+        self.round_trips = 0
+
     def update(self):
-        self.node.update(self.client, self.client.base_address)
+        start = time.perf_counter()
+        round_trips = self.client.round_trips
+        self.passes = self.node.update(self.memory, self.client.base_address)
+        self.round_trips = self.client.round_trips - round_trips
+        self.frame_time = time.perf_counter() - start
         self.lines = [l for c in self.node.children for l in c.draw()]
         self.cursor_update()
 
@@ -221,7 +289,7 @@ class Gui:
 
     def cursor_down(self):
         if self.cursor_node().children == []:
-            self.cursor_node().expand()
+            self.cursor_node().expand(self.client)
         if self.cursor_node().children != []:
             self.cursor_next()
 
@@ -233,13 +301,17 @@ class Gui:
 
     def cursor_toggle(self):
         if self.cursor_node().children == []:
-            self.cursor_node().expand()
+            self.cursor_node().expand(self.client)
         else:
             self.cursor_node().collapse()
 
     def draw(self, scr):
         size_x = curses.COLS
-        size_y = curses.LINES
+
+        # The last line shows how long the update took
+        size_y = curses.LINES - 1
+        status = f"{self.frame_time * 1000:.2f} ms, {self.round_trips} round trips, {self.passes} passes"
+        scr.addstr(size_y, 0, status[: size_x - 1], curses.A_DIM)
 
         # Update scroll
         screen_pad = 6
@@ -296,13 +368,22 @@ def main():
     parser.add_argument("-c", "--host", default="localhost", help="Router host")
     parser.add_argument("-p", "--port", type=int, default=1234, help="Router port")
     parser.add_argument("-s", "--symbol", default="DEBUG_DATA", help="Debug table name")
+    parser.add_argument("-t", "--target", help="Target like unix:PATH, serial:DEVICE[@BAUDRATE] or pid:PID, instead of host and port")
+    parser.add_argument("-d", "--device", type=int, help="Id of the device behind the router")
+    parser.add_argument("--max-age", type=float, default=0.5, help="Seconds a value read from the target is shown without reading it again")
+    parser.add_argument("--cache", default=cache.default_path("tables"), help="Directory used to cache decoded tables")
+    parser.add_argument("--cache-size", type=int, default=64, help="Maximum size of the table cache in MiB")
+    parser.add_argument("--no-cache", action="store_true", help="Always download the table")
     args = parser.parse_args()
 
-    client = Client()
-    client.connect(args.host, args.port, args.symbol)
+    client = Client(None if args.no_cache else DiskCache(args.cache, args.cache_size * 1024 * 1024))
+    if args.target:
+        client.open(open_target(args.target), args.symbol, print_progress, args.device)
+    else:
+        client.connect(args.host, args.port, args.symbol, print_progress, args.device)
 
     def gui_main(scr):
-        gui = Gui(client)
+        gui = Gui(client, args.max_age)
         curses.cbreak()
         curses.noecho()
         scr.keypad(True)
@@ -331,7 +412,7 @@ def main():
                     gui.edit_text = gui.edit_text[:-1]
                 elif k == "\n":
                     gui.edit_mode = False
-                    cursor_node.write(gui.client, gui.edit_text)
+                    cursor_node.write(gui.memory, gui.edit_text)
                     gui.edit_text = ""
                 elif k is not None and len(k) == 1:
                     gui.edit_text += k
@@ -361,5 +442,53 @@ def main():
     curses.wrapper(gui_main)
 
 
+def test_update():
+    # struct Node { int value; Node *next; }; Node *g_head; int g_count;
+    type_int = Value(ValueTag.BaseType, "int", 4)
+    node = Value(ValueTag.Struct, "Node", 16)
+    node_ptr = Value(ValueTag.Pointer, "", 8)
+    node_ptr.children = [node]
+    for name, offset, type in [("value", 0, type_int), ("next", 8, node_ptr)]:
+        member = Value(ValueTag.Variable, name, offset)
+        member.children = [type]
+        node.children.append(member)
+    g_head = Value(ValueTag.Variable, "g_head", 0x100)
+    g_head.children = [node_ptr]
+    g_count = Value(ValueTag.Variable, "g_count", 0x108)
+    g_count.children = [type_int]
+    cu = Value(ValueTag.Namespace, "main.c")
+    cu.children = [g_head, g_count]
+
+    memory = bytearray(0x400)
+    for addr, value in [(0x100, 0x200), (0x108, 5), (0x200, 7), (0x208, 0x300), (0x300, 8)]:
+        memory[addr : addr + 8] = value.to_bytes(8, "little")
+
+    class Memory:
+        def __init__(self):
+            self.reads = []
+
+        def read_many(self, ranges: list[(int, int)]) -> list[bytes]:
+            self.reads.append(ranges)
+            return [bytes(memory[addr : addr + size]) for addr, size in ranges]
+
+    root = RtNode(cu)
+    root.children = [RtNode(n) for n in cu.children]
+    head = root.children[0]
+    head.expand(None)
+    head.children[1].expand(None)
+
+    # One bulk read per level of pointers
+    target = Memory()
+    assert root.update(target, 0) == 3
+    assert [len(ranges) for ranges in target.reads] == [2, 2, 2]
+    assert [node.text for node, _ in root.draw()][1:] == ["{}", "7", "{}", "8", "NULL", "5"]
+
+    # Members behind a NULL pointer are not read
+    memory[0x208:0x210] = bytes(8)
+    target.reads = []
+    assert root.update(target, 0) == 2
+    assert head.children[1].text == "NULL" and head.children[1].children[0].text is None
+
+
 if __name__ == "__main__":
     main()
@@ -1,16 +1,25 @@
 from value import Value
 import argparse
+import os
 import sys
 import zlib
 import time
+from elftools.elf.elffile import ELFFile
 
 import dwarfdb
+import tableformat
+import cache
+from cache import DiskCache
 import store
 from value import Value
 
 opt_verbose = False
 opt_magic = bytes.fromhex("a1072345f05cae4c")
 opt_lang = "c"
+opt_jobs = 1
+opt_cache: DiskCache = None
+opt_table_version = tableformat.FORMAT_VERSION
+opt_codec = "auto"
 
 
 def help_header(size: int):
@@ -82,23 +91,63 @@ def write_db(path: str, data: bytes):
     return data
 
 
+def table_address(path: str) -> int:
+    """Address of the debug table in the loaded image, 0 if it is not part of this file"""
+    with open(path, "rb") as file:
+        offset = file.read().find(opt_magic)
+        if offset < 0:
+            return 0
+
+        file.seek(0)
+        for segment in ELFFile(file).iter_segments():
+            if segment["p_type"] != "PT_LOAD":
+                continue
+            if segment["p_offset"] <= offset < segment["p_offset"] + segment["p_filesz"]:
+                return segment["p_vaddr"] + offset - segment["p_offset"]
+    return 0
+
+
+def compress(sections: list[(str, bytes, list[str])], table_addr: int) -> bytes:
+    """Pack the sections with the selected codec, or with the smallest one in auto mode"""
+    codecs = tableformat.CODECS if opt_codec == "auto" else [tableformat.CODEC_NAMES[opt_codec]]
+
+    print(f"{'codec':<10} {'size':>10} {'decode':>10}")
+    best: bytes = None
+    for codec in codecs:
+        data = tableformat.pack_sections(sections, table_addr, codec)
+
+        # Time needed to decode every section
+        start = time.perf_counter()
+        tableformat.unpack(data)
+        duration = time.perf_counter() - start
+
+        print(f"{codec.name:<10} {len(data):>10} {duration * 1000:>8.2f}ms")
+        if best is None or len(data) < len(best):
+            best = data
+
+    info = tableformat.unpack_prefix(best)
+    print(f"Using codec '{info.codec.name}', table hash {info.hash.hex()}")
+    return best
+
+
 def patch(input: str, target: [str]):
     print(f"Reading debug data from '{input}'...")
-    value = dwarfdb.load(input)
+    table = dwarfdb.load(input, opt_jobs, opt_cache)
 
     if opt_verbose:
-        for var in value.variables():
-            print(f"{var.name}")
+        for var in table.variables():
+            print(f"{table.name(var)}")
 
     print(f"Deduplicating...")
-    value.join_namespaces()
-    value.deduplicate()
-    value.sort()
-    value.debug_print()
+    table.join_namespaces()
+    table.deduplicate()
+    table.sort()
+    table.debug_print()
     print(f"Encoding...")
-    data = store.encode(value)
-    print(f"Compressing...")
-    data = zlib.compress(data)
+    if opt_table_version == 0:
+        data = zlib.compress(store.encode(table, version=tableformat.store_version(0)))
+    else:
+        data = compress(tableformat.encode_sections(table), table_address(input))
     print(f"Final table size: {len(data) + 16} bytes")
     for t in target:
         print(f"Writing debug data to '{t}'...")
@@ -109,6 +158,10 @@ def patch(input: str, target: [str]):
 def main():
     global opt_magic
     global opt_verbose
+    global opt_jobs
+    global opt_cache
+    global opt_table_version
+    global opt_codec
 
     # Randomly generated using:
     # > openssl rand -hex 8
@@ -117,12 +170,32 @@ def main():
     parser.add_argument("-v", "--verbose", action="store_true")
     parser.add_argument("-m", "--magic", help=f"Table header of 8 bytes (default: {opt_magic.hex()})")
     parser.add_argument("-t", "--target", help="Apply changes to this file instead of input file", action="append")
+    parser.add_argument("-j", "--jobs", type=int, default=opt_jobs, help="Number of processes used to read the debug info (0 = all cores)")
+    parser.add_argument("--cache", default=cache.default_path("cu"), help="Directory used to cache parsed compile units")
+    parser.add_argument("--cache-size", type=int, default=256, help="Maximum size of the compile unit cache in MiB")
+    parser.add_argument("--no-cache", action="store_true", help="Always parse all compile units")
+    parser.add_argument("--table-version", type=int, choices=[0, tableformat.FORMAT_VERSION], default=opt_table_version, help="Table format version, 0 is a single compressed block")
+    parser.add_argument("--codec", choices=["auto"] + list(tableformat.CODEC_NAMES), default=opt_codec, help="Table compression, auto picks the smallest")
     args = parser.parse_args()
     print(args)
 
     # Verbose
     opt_verbose = args.verbose
 
+    # Jobs
+    opt_jobs = args.jobs or os.cpu_count()
+
+    # Cache
+    if not args.no_cache:
+        opt_cache = DiskCache(args.cache, args.cache_size * 1024 * 1024)
+
+    # Table format
+    opt_table_version = args.table_version
+    opt_codec = args.codec
+    if opt_table_version == 0 and opt_codec not in ["auto", "zlib"]:
+        print("ERROR: Table version 0 only supports the zlib codec")
+        sys.exit(1)
+
     # Target
     target = args.target or [args.FILE]
 
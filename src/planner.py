@@ -0,0 +1,114 @@
+import bisect
+from typing import Sequence
+
+
+class ReadPlan:
+    """
+    Minimal set of transfers for a list of (addr, size) ranges.
+
+    Ranges that overlap or are at most max_gap bytes apart are merged into one transfer,
+    transfers larger than max_size are split. Only bytes between requested ranges are read in addition,
+    with a gap smaller than a page these bytes are always on a page that holds a requested byte as well.
+    """
+
+    def __init__(self, ranges: list[(int, int)], max_gap: int = 64, max_size: int = 4096):
+        self.ranges = list(ranges)
+        self.transfers: list[(int, int)] = []
+
+        # Bytes covered by the requested ranges, overlapping bytes are only counted once
+        self.requested_bytes = 0
+
+        start, end = 0, -1
+        for addr, size in sorted(set(r for r in self.ranges if r[1] > 0)):
+            if addr + size <= end:
+                continue
+            self.requested_bytes += addr + size - max(addr, end)
+
+            if end < 0 or addr - end > max_gap:
+                # Too far from the current transfer, start a new one
+                if end >= 0:
+                    self.transfers.append((start, end - start))
+                start = addr
+            end = addr + size
+
+            # Split off full transfers, the rest can still be merged with the next range
+            while end - start > max_size:
+                self.transfers.append((start, max_size))
+                start += max_size
+        if end >= 0:
+            self.transfers.append((start, end - start))
+
+        self.starts = [addr for addr, _ in self.transfers]
+
+    def transferred_bytes(self) -> int:
+        return sum(size for _, size in self.transfers)
+
+    def split(self, data: Sequence[bytes]) -> list[bytes]:
+        """Cut the data of every requested range out of the data of the transfers"""
+        result = []
+        for addr, size in self.ranges:
+            parts = []
+            index = bisect.bisect_right(self.starts, addr) - 1
+            while size > 0:
+                transfer_addr = self.starts[index]
+                offset = addr - transfer_addr
+                part = data[index][offset : offset + size]
+                parts.append(part)
+                addr += len(part)
+                size -= len(part)
+                index += 1
+            result.append(b"".join(parts))
+        return result
+
+
+class ReadStats:
+    """Totals over all planned reads"""
+
+    def __init__(self):
+        self.requests = 0
+        self.transfers = 0
+        self.requested_bytes = 0
+        self.transferred_bytes = 0
+
+    def add(self, plan: ReadPlan):
+        self.requests += len(plan.ranges)
+        self.transfers += len(plan.transfers)
+        self.requested_bytes += plan.requested_bytes
+        self.transferred_bytes += plan.transferred_bytes()
+
+    def saved(self) -> int:
+        """Number of reads that were not needed"""
+        return self.requests - self.transfers
+
+    def overfetched(self) -> int:
+        """Bytes that were read without being requested"""
+        return self.transferred_bytes - self.requested_bytes
+
+    def __str__(self) -> str:
+        return f"{self.requests} ranges in {self.transfers} transfers ({self.saved()} saved), {self.overfetched()} bytes over-fetched"
+
+
+def test_plan():
+    plan = ReadPlan([(100, 4), (104, 4), (102, 4), (120, 8), (200, 4), (0, 0)], max_gap=16, max_size=4096)
+    assert plan.transfers == [(100, 28), (200, 4)]
+    assert plan.requested_bytes == 20
+    assert plan.transferred_bytes() == 32
+
+    memory = bytes(range(256))
+    data = plan.split([memory[addr : addr + size] for addr, size in plan.transfers])
+    assert data == [memory[addr : addr + size] for addr, size in plan.ranges]
+
+    stats = ReadStats()
+    stats.add(plan)
+    assert (stats.saved(), stats.overfetched()) == (4, 12)
+
+
+def test_plan_max_size():
+    ranges = [(0, 10), (8, 4), (16, 20), (40, 4)]
+    plan = ReadPlan(ranges, max_gap=8, max_size=16)
+    assert all(size <= 16 for _, size in plan.transfers)
+    assert plan.transfers == [(0, 16), (16, 16), (32, 12)]
+
+    memory = bytes(range(64))
+    data = plan.split([memory[addr : addr + size] for addr, size in plan.transfers])
+    assert data == [memory[addr : addr + size] for addr, size in ranges]
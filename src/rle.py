@@ -0,0 +1,104 @@
+# Encodings of the compressed read command, see inspect_rle in embed/inspect.c
+ENCODING_RAW = 0
+ENCODING_RLE = 1
+ENCODING_DELTA = 2
+
+# The target can not read the range, there is no data
+ENCODING_ERROR = 3
+
+# Shortest run that is encoded as a run, shorter runs are part of the literal bytes around them
+MIN_RUN = 4
+
+
+def put_varint(out: bytearray, value: int):
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode(data: bytes) -> bytes:
+    """
+    Run-length encode data. Every token starts with a varint, bit 0 is set for a run of one repeated byte
+    and clear for literal bytes, the other bits hold the length.
+    """
+    out = bytearray()
+    pos = 0
+    literal = 0
+    while pos < len(data):
+        value = data[pos]
+        end = pos + 1
+        while end < len(data) and data[end] == value:
+            end += 1
+        if end - pos < MIN_RUN:
+            pos = end
+            continue
+        if literal < pos:
+            put_varint(out, (pos - literal) << 1)
+            out += data[literal:pos]
+        put_varint(out, (end - pos) << 1 | 1)
+        out.append(value)
+        pos = literal = end
+    if literal < len(data):
+        put_varint(out, (len(data) - literal) << 1)
+        out += data[literal:]
+    return bytes(out)
+
+
+def decode(data: bytes, size: int) -> bytearray:
+    out = bytearray()
+    pos = 0
+    while pos < len(data):
+        token = 0
+        shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            token |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        length = token >> 1
+        if token & 1:
+            out += data[pos : pos + 1] * length
+            pos += 1
+        else:
+            out += data[pos : pos + length]
+            pos += length
+    if len(out) != size:
+        raise ValueError(f"Compressed data holds {len(out)} bytes instead of {size}")
+    return out
+
+
+def xor(data: bytes, base: bytes) -> bytes:
+    return (int.from_bytes(data, "little") ^ int.from_bytes(base, "little")).to_bytes(len(data), "little")
+
+
+def unpack(encoding: int, data: bytes, size: int, base: bytes = None) -> bytes:
+    """Data of a compressed read, base is the data of the previous compressed read of the same range"""
+    if encoding == ENCODING_RAW:
+        return data
+    if encoding == ENCODING_RLE:
+        return decode(data, size)
+    if encoding == ENCODING_ERROR:
+        # Unreadable memory reads as zeros, like with the plain read command
+        return bytes(size)
+    if encoding == ENCODING_DELTA:
+        if base is None or len(base) != size:
+            raise ValueError("Delta without the data of the previous read")
+        return xor(decode(data, size), base)
+    raise ValueError(f"Unknown encoding {encoding}")
+
+
+def test_rle():
+    for data in [b"", b"a", b"abc", bytes(4096), b"xy" + bytes(100) + b"abcabc" + b"\xff" * 5 + b"z", bytes(range(256)) * 2]:
+        assert decode(encode(data), len(data)) == data
+    assert len(encode(bytes(4096))) == 3
+
+    base = bytes(range(256)) * 4
+    data = bytearray(base)
+    data[100] = 0
+    encoded = encode(xor(data, base))
+    assert len(encoded) < 10
+    assert unpack(ENCODING_DELTA, encoded, len(data), base) == data
+    assert unpack(ENCODING_ERROR, b"", 4) == bytes(4)
@@ -1,7 +1,184 @@
 import argparse
+import os
+import select
+import sys
 import time
+from client import Client, print_progress
+from symbols import Symbol
+from transport import open_target
 from value import Value, ValueTag
-from client import Client
+
+# Start of the id of a control block that is initialized by the target
+RTT_ID = b"SEGGER RTT"
+
+# Fields of SEGGER_RTT_BUFFER_UP and SEGGER_RTT_BUFFER_DOWN
+BUFFER_FIELDS = ["sName", "pBuffer", "SizeOfBuffer", "WrOff", "RdOff", "Flags"]
+
+# Longest channel name that is read
+MAX_NAME = 32
+
+
+class RttChannel:
+    """One up (target to host) or down (host to target) buffer, with the address and size of every descriptor field"""
+
+    def __init__(self, up: bool, index: int, fields: dict[str, Symbol]):
+        self.up = up
+        self.index = index
+        self.fields = fields
+        self.name = ""
+
+        # Data for a down buffer that did not fit yet
+        self.pending = bytearray()
+
+        # Totals, full counts the polls that found an up buffer full, the target dropped or waited for data then
+        self.bytes = 0
+        self.full = 0
+
+        # Part of the buffer that was used at the last poll
+        self.fill = 0.0
+
+    def __repr__(self) -> str:
+        return f"RttChannel({'up' if self.up else 'down'}, {self.index}, {self.name!r})"
+
+    def get(self, data: bytes, start: int, name: str) -> int:
+        """Value of a field in the descriptor data read from start"""
+        field = self.fields[name]
+        return int.from_bytes(data[field.addr - start : field.addr - start + field.size], "little")
+
+    def put(self, client: Client, name: str, value: int):
+        field = self.fields[name]
+        client.write(field.addr, value.to_bytes(field.size, "little"))
+
+
+class Rtt:
+    """
+    Reader and writer of the SEGGER RTT buffers of a target, the layout of the control block comes from the debug table.
+
+    Every poll reads the descriptors of all buffers in one transfer and then the new data of every up buffer in one
+    read_many, both parts of a wrapped buffer included. RdOff is written back right after, so the target can reuse the space.
+    """
+
+    def __init__(self, client: Client, symbol: str = "_SEGGER_RTT"):
+        self.client = client
+        self.polls = 0
+        self.start = time.monotonic()
+
+        id = client.resolve(f"{symbol}.acID")
+        if not client.read(id.addr, id.size).startswith(RTT_ID):
+            raise ValueError(f"{symbol} is not initialized by the target")
+
+        self.up = self.find_channels(symbol, "aUp", "MaxNumUpBuffers", True)
+        self.down = self.find_channels(symbol, "aDown", "MaxNumDownBuffers", False)
+        fields = [field for channel in self.up + self.down for field in channel.fields.values()]
+        start = min(field.addr for field in fields)
+        end = max(field.addr + field.size for field in fields)
+        self.descriptors = (start, end - start)
+
+        for channel in self.up + self.down:
+            addr = client.read_int(channel.fields["sName"].addr, channel.fields["sName"].size)
+            if addr:
+                channel.name = client.read(addr, MAX_NAME).split(b"\0", 1)[0].decode(errors="replace")
+
+    def find_channels(self, symbol: str, array: str, count: str, up: bool) -> list[RttChannel]:
+        count = self.client.resolve(f"{symbol}.{count}")
+        channels = []
+        for index in range(self.client.read_int(count.addr, count.size)):
+            try:
+                fields = {name: self.client.resolve(f"{symbol}.{array}[{index}].{name}") for name in BUFFER_FIELDS}
+            except ValueError:
+                # More buffers than the array holds
+                break
+            channels.append(RttChannel(up, index, fields))
+        return channels
+
+    def send(self, index: int, data: bytes):
+        """Queue data for a down buffer, it is written by the next polls as space becomes free"""
+        self.down[index].pending += data
+
+    def poll(self) -> dict[RttChannel, bytes]:
+        """Read the new data of every up buffer and write pending data to the down buffers"""
+        self.polls += 1
+        start = self.descriptors[0]
+        data = self.client.read_many([self.descriptors])[0]
+
+        ranges = []
+        reads: list[(RttChannel, int, int)] = []
+        for channel in self.up:
+            buffer = channel.get(data, start, "pBuffer")
+            size = channel.get(data, start, "SizeOfBuffer")
+            write = channel.get(data, start, "WrOff")
+            read = channel.get(data, start, "RdOff")
+            if size == 0 or write >= size or read >= size:
+                continue
+            used = (write - read) % size
+            channel.fill = used / size
+            if used == size - 1:
+                channel.full += 1
+            if used == 0:
+                continue
+
+            if write > read:
+                parts = [(buffer + read, write - read)]
+            else:
+                parts = [(buffer + read, size - read)] + ([(buffer, write)] if write else [])
+            ranges += parts
+            reads.append((channel, len(parts), write))
+
+        result = {}
+        received = iter(self.client.read_many(ranges) if ranges else [])
+        for channel, count, write in reads:
+            chunk = b"".join(next(received) for _ in range(count))
+            channel.bytes += len(chunk)
+            channel.put(self.client, "RdOff", write)
+            result[channel] = chunk
+
+        for channel in self.down:
+            if channel.pending:
+                self.write_down(channel, data, start)
+        return result
+
+    def write_down(self, channel: RttChannel, data: bytes, start: int):
+        buffer = channel.get(data, start, "pBuffer")
+        size = channel.get(data, start, "SizeOfBuffer")
+        write = channel.get(data, start, "WrOff")
+        read = channel.get(data, start, "RdOff")
+        if size == 0 or write >= size or read >= size:
+            return
+
+        part = channel.pending[: (read - write - 1) % size]
+        if not part:
+            channel.full += 1
+            return
+        first = min(len(part), size - write)
+        self.client.write(buffer + write, part[:first])
+        if first < len(part):
+            self.client.write(buffer, part[first:])
+        channel.put(self.client, "WrOff", (write + len(part)) % size)
+        channel.bytes += len(part)
+        del channel.pending[: len(part)]
+
+    def __str__(self) -> str:
+        seconds = max(time.monotonic() - self.start, 1e-9)
+        total = sum(channel.bytes for channel in self.up)
+        lines = [f"{self.polls} polls, {self.polls / seconds:.0f} polls/s, {total / seconds / 1024:.1f} KiB/s"]
+        for channel in self.up + self.down:
+            direction = "up" if channel.up else "down"
+            lines.append(f"  {direction} {channel.index} {channel.name!r}: {channel.bytes} bytes, full {channel.full} times")
+        return "\n".join(lines)
+
+
+def open_outputs(rtt: Rtt, pattern: str, channels: list[int]) -> dict[RttChannel, object]:
+    """Output file of every up channel, a pattern like rtt_{index}.log gives every channel its own file"""
+    files = {}
+    outputs = {}
+    for channel in rtt.up:
+        if channels and channel.index not in channels:
+            continue
+        path = pattern.format(index=channel.index, name=channel.name or channel.index)
+        if path not in files:
+            files[path] = sys.stdout.buffer if path == "-" else open(path, "ab")
+        outputs[channel] = files[path]
+    return outputs
 
 
 def main():
@@ -9,33 +186,150 @@ def main():
     parser.add_argument("-c", "--host", default="localhost", help="Router host")
     parser.add_argument("-p", "--port", type=int, default=1234, help="Router port")
     parser.add_argument("-s", "--symbol", default="DEBUG_DATA", help="Debug table name")
+    parser.add_argument("-t", "--target", help="Target like unix:PATH, serial:DEVICE[@BAUDRATE] or pid:PID, instead of host and port")
+    parser.add_argument("-d", "--device", type=int, help="Id of the device behind the router")
+    parser.add_argument("-r", "--rtt", default="_SEGGER_RTT", help="RTT control block name")
+    parser.add_argument("-o", "--output", default="-", help="Output file, {index} and {name} give every up channel its own file")
+    parser.add_argument("-u", "--up", type=int, action="append", default=[], help="Up channel to read, can be given multiple times, all by default")
+    parser.add_argument("--min-interval", type=float, default=0.001, help="Seconds between polls while data arrives")
+    parser.add_argument("--max-interval", type=float, default=0.1, help="Seconds between polls when the target is idle")
+    parser.add_argument("--stats", type=float, default=5.0, help="Seconds between statistics on stderr, 0 to disable")
+    parser.add_argument("--no-input", action="store_true", help="Do not send stdin to down channel 0")
     args = parser.parse_args()
 
     client = Client()
-    client.connect(args.host, args.port, args.symbol)
-    val = client.find_variable("_SEGGER_RTT")
+    if args.target:
+        client.open(open_target(args.target), args.symbol, print_progress, args.device)
+    else:
+        client.connect(args.host, args.port, args.symbol, print_progress, args.device)
 
-    rtt_addr = client.base_address + val.value
-    rtt_size_addr = rtt_addr + 40
-    rtt_woff_addr = rtt_addr + 44
-    rtt_buff_ptr_addr = rtt_addr + 44 - 0xC + 0xC0
+    rtt = Rtt(client, args.rtt)
+    print("\n".join(str(channel) for channel in rtt.up + rtt.down), file=sys.stderr)
+    outputs = open_outputs(rtt, args.output, args.up)
+    inputs = [] if args.no_input or not rtt.down else [sys.stdin.fileno()]
 
-    max_size = client.read_int(rtt_size_addr, 4)
-    buff_addr = client.read_int(rtt_buff_ptr_addr, 8)
-    print(max_size)
-    print(f"{buff_addr:x}")
-
-    last_off = 0
+    # Poll fast while data arrives, back off while the target is idle
+    interval = args.min_interval
+    next_stats = time.monotonic() + args.stats
     while True:
-        new_off = client.read_int(rtt_woff_addr, 4)
-        print(new_off)
-        if new_off == last_off:
-            time.sleep(0.1)
-            continue
-        if new_off < last_off:
-            new_off = max_size
-        print("K: ", client.read(buff_addr + last_off, new_off - last_off).decode())
-        last_off = new_off % max_size
+        received = rtt.poll()
+        for channel, data in received.items():
+            if channel in outputs:
+                outputs[channel].write(data)
+                outputs[channel].flush()
+
+        if received:
+            interval = args.min_interval
+        else:
+            interval = min(interval * 2, args.max_interval)
+
+        # A buffer that is more than half full is read again right away
+        if any(channel.fill > 0.5 for channel in rtt.up):
+            interval = 0
+
+        # Waiting for stdin is the sleep between polls
+        ready, _, _ = select.select(inputs, [], [], interval)
+        if ready:
+            data = os.read(inputs[0], 4096)
+            if data:
+                rtt.send(0, data)
+            else:
+                inputs.clear()
+        elif not inputs:
+            time.sleep(interval)
+
+        if args.stats > 0 and time.monotonic() >= next_stats:
+            print(rtt, file=sys.stderr)
+            next_stats += args.stats
+
+
+def test_rtt():
+    from symbols import SymbolIndex
+
+    # 32-bit target: struct { char acID[16]; int MaxNumUpBuffers; int MaxNumDownBuffers; BUFFER aUp[2]; BUFFER aDown[1]; }
+    type_char = Value(ValueTag.BaseType, "char", 1)
+    type_int = Value(ValueTag.BaseType, "unsigned", 4)
+    pointer = Value(ValueTag.Pointer, "", 4)
+    pointer.children = [type_char]
+    buffer = Value(ValueTag.Struct, "SEGGER_RTT_BUFFER", 24)
+    for i, name in enumerate(BUFFER_FIELDS):
+        member = Value(ValueTag.Variable, name, i * 4)
+        member.children = [pointer if name in ["sName", "pBuffer"] else type_int]
+        buffer.children.append(member)
+
+    def array(type: Value, count: int) -> Value:
+        value = Value(ValueTag.Array, "", count)
+        value.children = [type]
+        return value
+
+    cb = Value(ValueTag.Struct, "SEGGER_RTT_CB", 96)
+    for name, offset, type in [("acID", 0, array(type_char, 16)), ("MaxNumUpBuffers", 16, type_int), ("MaxNumDownBuffers", 20, type_int), ("aUp", 24, array(buffer, 2)), ("aDown", 72, array(buffer, 1))]:
+        member = Value(ValueTag.Variable, name, offset)
+        member.children = [type]
+        cb.children.append(member)
+    var = Value(ValueTag.Variable, "_SEGGER_RTT", 0x100)
+    var.children = [cb]
+    cu = Value(ValueTag.Namespace, "rtt.c")
+    cu.children = [var]
+    root = Value(ValueTag.Namespace, "app")
+    root.children = [cu]
+
+    memory = bytearray(0x400)
+
+    def put(addr: int, *values: int):
+        for i, value in enumerate(values):
+            memory[addr + i * 4 : addr + i * 4 + 4] = value.to_bytes(4, "little")
+
+    memory[0x100:0x110] = RTT_ID.ljust(16, b"\0")
+    put(0x110, 2, 1)
+    memory[0x300:0x309] = b"Terminal\0"
+    put(0x118, 0x300, 0x200, 16, 4, 12, 0)
+    put(0x130, 0, 0x220, 16, 0, 0, 0)
+    put(0x148, 0, 0x240, 8, 6, 2, 0)
+    memory[0x20C:0x210] = b"abcd"
+    memory[0x200:0x204] = b"efgh"
+
+    class Target:
+        def __init__(self):
+            self.index = SymbolIndex(root)
+            self.round_trips = 0
+
+        def read(self, addr: int, size: int) -> bytes:
+            return bytes(memory[addr : addr + size])
+
+        def read_int(self, addr: int, size: int) -> int:
+            return int.from_bytes(memory[addr : addr + size], "little")
+
+        def read_many(self, ranges: list[(int, int)]) -> list[bytes]:
+            self.round_trips += 1
+            return [self.read(addr, size) for addr, size in ranges]
+
+        def write(self, addr: int, data: bytes):
+            memory[addr : addr + len(data)] = data
+
+        def resolve(self, path: str) -> Symbol:
+            return self.index.resolve(path, 0, self.read_int)
+
+    target = Target()
+    rtt = Rtt(target)
+    assert [c.name for c in rtt.up] == ["Terminal", ""] and len(rtt.down) == 1
+    assert rtt.descriptors == (0x118, 72)
+
+    # The wrapped data is read in one round trip and RdOff is written back
+    rtt.send(0, b"hello")
+    assert rtt.poll() == {rtt.up[0]: b"abcdefgh"}
+    assert target.round_trips == 2
+    assert target.read_int(0x118 + 16, 4) == 4
+
+    # Down buffer wraps, only 3 bytes fit before RdOff
+    assert memory[0x246:0x248] + memory[0x240:0x241] == b"hel"
+    assert target.read_int(0x148 + 12, 4) == 1 and rtt.down[0].pending == b"lo"
+
+    # Nothing new, one round trip; a full buffer is counted
+    assert rtt.poll() == {} and target.round_trips == 3
+    put(0x118 + 12, 3)
+    assert rtt.poll()[rtt.up[0]] == bytes(memory[0x204:0x210]) + bytes(memory[0x200:0x203])
+    assert rtt.up[0].full == 1
 
 
 if __name__ == "__main__":
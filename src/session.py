@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import hashlib
+import time
+import tableformat
+from aclient import AsyncClient
+from symbols import Symbol, SymbolIndex
+from value import Value
+
+
+class SharedTable:
+    """Decoded table of one firmware, shared by every device running it"""
+
+    def __init__(self, root: Value, table_addr: int):
+        self.root = root
+        self.symbols = SymbolIndex(root)
+
+        # Address of the DEBUG_DATA table in the debug info, the load address of a device is relative to it
+        self.table_addr = table_addr
+
+
+class PollStats:
+    """Totals over all polls"""
+
+    def __init__(self):
+        self.polls = 0
+        self.reads = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def add(self, reads: int, size: int, seconds: float):
+        self.polls += 1
+        self.reads += reads
+        self.bytes += size
+        self.seconds += seconds
+
+    def __str__(self) -> str:
+        seconds = max(self.seconds, 1e-9)
+        return f"{self.polls} polls, {self.reads / seconds:.0f} reads/s, {self.bytes / seconds / 1024:.1f} KiB/s"
+
+
+class Device:
+    """One device behind a connection"""
+
+    def __init__(self, client: AsyncClient, id: int, name: str, addr: int):
+        self.client = client
+        self.id = id
+        self.name = name
+        self.addr = addr
+        self.table: SharedTable = None
+        self.base_address = 0
+        self.stats = PollStats()
+
+        # Resolved paths, None when the firmware of this device does not have the path
+        self.resolved: dict[str, Symbol] = {}
+
+    def __repr__(self) -> str:
+        return f"Device({self.id}, {self.name!r}, {self.addr:#x})"
+
+    async def read(self, addr: int, size: int) -> bytes:
+        return await self.client.read(addr, size, self.id)
+
+    def resolve(self, path: str) -> Symbol:
+        """Address and type of a path in this device, pointers can not be followed"""
+        if path not in self.resolved:
+            try:
+                self.resolved[path] = self.table.symbols.resolve(path, self.base_address)
+            except ValueError:
+                self.resolved[path] = None
+        return self.resolved[path]
+
+
+class Session:
+    """
+    All devices behind a set of connections, polled at the same time.
+
+    Every table is downloaded and decoded once per firmware. Tables with a hash in their prefix are shared
+    before downloading them, older tables are shared after downloading by the hash of their data.
+    """
+
+    def __init__(self, symbol_name: str = "DEBUG_DATA"):
+        self.symbol_name = symbol_name
+        self.clients: list[AsyncClient] = []
+        self.devices: list[Device] = []
+        self.tables: dict[bytes, asyncio.Future] = {}
+        self.stats = PollStats()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def connect(self, host: str, port: int) -> list[Device]:
+        """Add all devices behind a router and read their tables"""
+        client = AsyncClient()
+        await client.connect(host, port)
+        self.clients.append(client)
+
+        devices = [Device(client, *device) for device in await client.devices()]
+        await asyncio.gather(*map(self.load_table, devices))
+        self.devices += devices
+        return devices
+
+    async def close(self):
+        for client in self.clients:
+            await client.close()
+        self.clients.clear()
+        self.devices.clear()
+
+    async def load_table(self, device: Device):
+        header = await device.read(device.addr, 16)
+        data_size = int.from_bytes(header[12:16], "little")
+        data_addr = device.addr + 16
+        info = tableformat.unpack_prefix(await device.read(data_addr, min(data_size, tableformat.PREFIX_SIZE)))
+
+        data = None
+        key = info.hash
+        if not key:
+            data = await device.read(data_addr, data_size)
+            key = hashlib.blake2b(data, digest_size=tableformat.HASH_SIZE).digest()
+
+        # The first device with this firmware reads the table, the others wait for it
+        table = self.tables.get(key)
+        if table is None:
+            table = self.tables[key] = asyncio.ensure_future(self.decode_table(device, info, data, data_addr, data_size))
+        try:
+            device.table = await table
+        except Exception:
+            if self.tables.get(key) is table:
+                del self.tables[key]
+            raise
+        device.base_address = device.addr - device.table.table_addr
+
+    async def decode_table(self, device: Device, info: tableformat.TableIndex, data: bytes, data_addr: int, data_size: int) -> SharedTable:
+        if data is None:
+            data = await device.read(data_addr, data_size)
+        root = tableformat.unpack(data).to_value()
+        table = SharedTable(root, info.table_addr)
+        if not table.table_addr:
+            var = table.symbols.find(self.symbol_name)
+            if var is None:
+                raise ValueError(f"No variable '{self.symbol_name}' in the table of {device}")
+            table.table_addr = var.value
+        return table
+
+    async def poll(self, paths: list[str]) -> dict[Device, list[bytes]]:
+        """Read the paths on every device at the same time, the data is None for paths a device does not have"""
+
+        total_reads = 0
+        total_bytes = 0
+
+        async def poll_device(device: Device) -> list[bytes]:
+            nonlocal total_reads, total_bytes
+            start = time.perf_counter()
+            symbols = [device.resolve(path) for path in paths]
+            ranges = [(symbol.addr, symbol.size) for symbol in symbols if symbol is not None]
+            data = iter(await device.client.read_many(ranges, device.id))
+            device_size = sum(size for _, size in ranges)
+            device.stats.add(len(ranges), device_size, time.perf_counter() - start)
+            total_reads += len(ranges)
+            total_bytes += device_size
+            return [None if symbol is None else next(data) for symbol in symbols]
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*map(poll_device, self.devices))
+        self.stats.add(total_reads, total_bytes, time.perf_counter() - start)
+        return dict(zip(self.devices, results))
+
+
+async def run(args: argparse.Namespace):
+    async with Session(args.symbol) as session:
+        for target in args.target:
+            host, _, port = target.rpartition(":")
+            for device in await session.connect(host or "localhost", int(port)):
+                print(f"{target} {device}: base address {device.base_address:#x}")
+        print(f"{len(session.devices)} devices, {len(session.tables)} different tables")
+
+        while True:
+            for device, values in (await session.poll(args.paths)).items():
+                text = ", ".join("-" if data is None else data.hex() for data in values)
+                print(f"{device.id:4} {device.name:16} {text}")
+            print(session.stats)
+            await asyncio.sleep(args.interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-t", "--target", action="append", default=[], help="Router as host:port, can be given multiple times")
+    parser.add_argument("-s", "--symbol", default="DEBUG_DATA", help="Debug table name")
+    parser.add_argument("-i", "--interval", type=float, default=1.0, help="Seconds between polls")
+    parser.add_argument("paths", nargs="+", help="Variables to poll, like g_state.motor[2].speed")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+def test_session():
+    from aclient import serve_memory
+    from table import ValueTable
+    from transport import FEATURE_DEVICES, FEATURE_READ_MANY
+    from value import ValueTag
+
+    # One firmware with DEBUG_DATA at offset 0 and a counter at 0x800
+    root = Value(ValueTag.Namespace, "app")
+    cu = Value(ValueTag.Namespace, "main.c")
+    type_int = Value(ValueTag.BaseType, "int", 4)
+    cu.children = [Value(ValueTag.Variable, "DEBUG_DATA", 0), Value(ValueTag.Variable, "g_count", 0x800)]
+    for var in cu.children:
+        var.children = [type_int]
+    root.children = [cu]
+    data = tableformat.pack(ValueTable.from_value(root), 0)
+
+    memories = []
+    for id in range(4):
+        memory = bytearray(0x1000)
+        memory[0:16] = bytes(12) + len(data).to_bytes(4, "little")
+        memory[16 : 16 + len(data)] = data
+        memory[0x800:0x804] = (id * 100).to_bytes(4, "little")
+        memories.append(memory)
+
+    async def run():
+        servers = [
+            await asyncio.start_server(lambda r, w: serve_memory(memories[:3], FEATURE_READ_MANY | FEATURE_DEVICES, r, w), "127.0.0.1", 0),
+            await asyncio.start_server(lambda r, w: serve_memory(memories[3:], 0, r, w), "127.0.0.1", 0),
+        ]
+        async with Session() as session:
+            for server in servers:
+                await session.connect("127.0.0.1", server.sockets[0].getsockname()[1])
+            assert [(d.id, d.name) for d in session.devices] == [(0, "board0"), (1, "board1"), (2, "board2"), (0, "")]
+            assert len(session.tables) == 1
+            assert all(d.table is session.devices[0].table and d.base_address == 0x1000 for d in session.devices)
+
+            values = await session.poll(["g_count", "g_missing"])
+            assert [v for v in values.values()] == [[(id * 100).to_bytes(4, "little"), None] for id in range(4)]
+            assert (session.stats.polls, session.stats.reads, session.stats.bytes) == (1, 4, 16)
+        for server in servers:
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import time
+from typing import Callable
+
+Fetch = Callable[[list[(int, int)]], list[bytes]]
+
+
+class ShadowStats:
+    """Totals over all reads from the mirror"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.fetched_bytes = 0
+
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def __str__(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses ({self.hit_rate():.0%} hit rate), {self.fetched_bytes} bytes fetched"
+
+
+class ShadowMemory:
+    """
+    Local mirror of the target memory that was read, in aligned blocks that each remember when they were read.
+
+    A read is served from the mirror when all its blocks are younger than the max_age of the reader,
+    otherwise only the missing and stale blocks are fetched in one go. Blocks are aligned and smaller than a page,
+    so fetching a whole block never touches a page that was not requested.
+    Writes go to the target and are copied into the mirror right away.
+    """
+
+    def __init__(self, fetch: Fetch, block_size: int = 64, max_blocks: int = 16384):
+        self.fetch = fetch
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.stats = ShadowStats()
+
+        # Block address to (read time, data), oldest first
+        self.blocks: dict[int, (float, bytearray)] = {}
+
+    def block_range(self, addr: int, size: int) -> range:
+        start = addr - addr % self.block_size
+        return range(start, addr + size, self.block_size)
+
+    def read_many(self, ranges: list[(int, int)], max_age: float) -> list[bytes]:
+        """Read (addr, size) ranges, data that is at most max_age seconds old is not fetched again"""
+        now = time.monotonic()
+        missing = set()
+        for addr, size in ranges:
+            for block in self.block_range(addr, size):
+                entry = self.blocks.get(block)
+                if entry is None or now - entry[0] > max_age:
+                    missing.add(block)
+
+        if missing:
+            self.stats.misses += 1
+            self.refresh(sorted(missing))
+        else:
+            self.stats.hits += 1
+        result = [self.copy(addr, size) for addr, size in ranges]
+
+        while len(self.blocks) > self.max_blocks:
+            del self.blocks[next(iter(self.blocks))]
+        return result
+
+    def read(self, addr: int, size: int, max_age: float) -> bytes:
+        return self.read_many([(addr, size)], max_age)[0]
+
+    def refresh(self, blocks: list[int]):
+        """Fetch sorted blocks, neighbouring blocks are fetched together"""
+        ranges = []
+        for block in blocks:
+            if ranges and ranges[-1][0] + ranges[-1][1] == block:
+                ranges[-1][1] += self.block_size
+            else:
+                ranges.append([block, self.block_size])
+
+        # Stamp with the time of the request, the data can not be older than that
+        now = time.monotonic()
+        for (addr, size), data in zip(ranges, self.fetch([(addr, size) for addr, size in ranges])):
+            self.stats.fetched_bytes += size
+            for offset in range(0, size, self.block_size):
+                self.blocks.pop(addr + offset, None)
+                self.blocks[addr + offset] = (now, bytearray(data[offset : offset + self.block_size]))
+
+    def copy(self, addr: int, size: int) -> bytes:
+        parts = []
+        for block in self.block_range(addr, size):
+            data = self.blocks[block][1]
+            start = max(addr - block, 0)
+            end = min(addr + size - block, self.block_size)
+            parts.append(data[start:end])
+        return b"".join(parts)
+
+    def store(self, addr: int, data: bytes):
+        """Copy written data into the blocks that are mirrored"""
+        for block in self.block_range(addr, len(data)):
+            entry = self.blocks.get(block)
+            if entry is None:
+                continue
+            start = max(addr - block, 0)
+            end = min(addr + len(data) - block, self.block_size)
+            entry[1][start:end] = data[block + start - addr : block + end - addr]
+
+    def invalidate(self):
+        self.blocks.clear()
+
+
+class ShadowView:
+    """Reads of one consumer through the mirror, with its own staleness budget. Has the read and write methods of Client."""
+
+    def __init__(self, client, max_age: float):
+        self.client = client
+        self.shadow: ShadowMemory = client.shadow
+        self.max_age = max_age
+
+    def read(self, addr: int, size: int) -> bytes:
+        return self.shadow.read(addr, size, self.max_age)
+
+    def read_many(self, ranges: list[(int, int)]) -> list[bytes]:
+        return self.shadow.read_many(ranges, self.max_age)
+
+    def write(self, addr: int, data: bytes):
+        self.client.write(addr, data)
+
+    def read_int(self, addr: int, len: int) -> int:
+        return int.from_bytes(self.read(addr, len), "little")
+
+    def write_int(self, addr: int, len: int, data: int):
+        self.client.write_int(addr, len, data)
+
+
+def test_shadow():
+    memory = bytearray(range(256)) * 4
+    fetches = []
+
+    def fetch(ranges: list[(int, int)]) -> list[bytes]:
+        fetches.append(ranges)
+        return [bytes(memory[addr : addr + size]) for addr, size in ranges]
+
+    shadow = ShadowMemory(fetch, block_size=16, max_blocks=8)
+    assert shadow.read(10, 20, 1.0) == memory[10:30]
+    assert fetches == [[(0, 32)]]
+
+    # Fresh enough, no fetch
+    memory[12] = 99
+    assert shadow.read(12, 4, 1.0) == bytes([12, 13, 14, 15])
+    assert len(fetches) == 1
+
+    # Only the missing blocks are fetched, no staleness allowed fetches everything again
+    assert shadow.read_many([(20, 4), (40, 2), (100, 1)], 1.0) == [memory[20:24], memory[40:42], memory[100:101]]
+    assert fetches[-1] == [(32, 16), (96, 16)]
+    assert shadow.read(12, 1, 0.0) == bytes([99])
+    assert fetches[-1] == [(0, 16)]
+
+    # Writes update the mirror
+    shadow.store(14, b"\xaa\xbb\xcc\xdd")
+    assert shadow.read(13, 6, 1.0) == bytes([13, 0xAA, 0xBB, 0xCC, 0xDD, 18])
+    assert (shadow.stats.hits, shadow.stats.misses) == (2, 3)
+
+    # Oldest blocks are dropped first
+    shadow.read(128, 128, 1.0)
+    assert len(shadow.blocks) == 8 and 0 not in shadow.blocks
@@ -1,69 +1,267 @@
+from array import array
 from io import BytesIO
+from typing import Sequence
 from value import Value, ValueTag
+from table import VALUE_MASK, ValueTable, signed_value
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def encode(root: Value) -> bytes:
-    # value, children, pairs
-    values: list[(Value, list[int])] = []
+# Use the vectorized varint code when numpy is available
+use_numpy = numpy is not None
 
-    # (value, id) pairs
-    mapping: dict[Value, int] = {}
 
-    def store(val: Value) -> int:
-        if val in mapping:
-            return mapping[val]
+# Version 1 stores names in full and all columns as absolute values.
+# Version 2 front codes the string pool and delta codes the name, child and address columns.
+STORE_VERSION = 2
 
-        # Append new value
-        id = len(values)
-        values.append((val, []))
-        mapping[val] = id
 
-        # Visit children
-        for child in val.children:
-            values[id][1].append(store(child))
+def encode(table: ValueTable, root: int = 0, version: int = STORE_VERSION) -> bytes:
+    # Number the values in depth first order, starting at the root
+    ids = array("q", [-1]) * len(table)
+    rows = array("I", [root])
+    ids[root] = 0
+    stack = [(root, 0)]
+    while stack:
+        row, i = stack[-1]
+        if i == table.child_count[row]:
+            stack.pop()
+            continue
+        stack[-1] = (row, i + 1)
 
-        return id
+        child = table.child_data[table.child_start[row] + i]
+        if ids[child] < 0:
+            ids[child] = len(rows)
+            rows.append(child)
+            stack.append((child, 0))
 
-    store(root)
+    tags = [table.tags[row] for row in rows]
 
-    # Encode data
+    # 64 bit patterns of the values, version 1 stores them as they are
+    values = [table.values[row] for row in rows]
+    child_counts = [table.child_count[row] for row in rows]
+    child_data = [ids[child] for row in rows for child in table.children(row)]
+    names = [table.name(row).encode() for row in rows]
+
+    # Encode data, column by column
     data = BytesIO()
-    write_varint(data, len(values))
-    for val, _ in values:
-        write_varint(data, val.tag.value)
-    for val, _ in values:
-        write_varint(data, len(val.name))
-    for val, _ in values:
-        data.write(val.name.encode())
-    for val, _ in values:
-        write_varint(data, val.value)
-    for val, children in values:
-        write_varint(data, len(children))
-    for val, children in values:
-        for child in children:
-            write_varint(data, child)
+    write_varint(data, len(rows))
+    data.write(write_varints(tags))
+    if version == 1:
+        data.write(write_varints([len(name) for name in names]))
+        data.write(b"".join(names))
+        data.write(write_varints(values))
+        data.write(write_varints(child_counts))
+        data.write(write_varints(child_data))
+        return data.getvalue()
+
+    # Every string is stored once in order of first use, names refer back to it by distance, 0 is the next new string
+    strings = list(dict.fromkeys(names))
+    string_ids = {name: i for i, name in enumerate(strings)}
+    name_refs = []
+    next_id = 0
+    for name in names:
+        id = string_ids[name]
+        name_refs.append(next_id - id if id < next_id else 0)
+        next_id = max(next_id, id + 1)
+    write_strings(data, strings)
+    data.write(write_varints(name_refs))
+    data.write(write_varints(child_counts))
+
+    # Children are relative to their parent, the first child usually directly follows it
+    parents = [row for row, count in enumerate(child_counts) for _ in range(count)]
+    data.write(write_varints(zigzag_encode([child - parent - 1 for child, parent in zip(child_data, parents)])))
+
+    # Values are signed 64 bit, addresses are relative to the previous address and wrap around
+    previous = 0
+    for row, is_address in enumerate(address_rows(tags, child_counts, child_data)):
+        if is_address:
+            values[row], previous = values[row] - previous & VALUE_MASK, values[row]
+        values[row] = signed_value(values[row])
+    data.write(write_varints(zigzag_encode(values)))
     return data.getvalue()
 
 
-def decode(data: bytes) -> Value:
-    data = BytesIO(data)
+def decode(data: bytes, version: int = STORE_VERSION) -> ValueTable:
+    buf = BytesIO(data)
+    value_count = read_varint(buf)
+    offset = buf.tell()
+
+    # Every column is decoded in one pass
+    tags, offset = read_varints(data, offset, value_count)
+    if version == 1:
+        name_lens, offset = read_varints(data, offset, value_count)
+        names = []
+        for name_len in name_lens:
+            names.append(data[offset : offset + name_len].decode())
+            offset += name_len
+        values, offset = read_varints(data, offset, value_count)
+        child_counts, offset = read_varints(data, offset, value_count)
+        child_data, offset = read_varints(data, offset, sum(child_counts))
+        return ValueTable.from_columns(tags, names, values, child_counts, child_data)
+
+    strings, offset = read_strings(data, offset)
+    name_refs, offset = read_varints(data, offset, value_count)
+    names = []
+    next_id = 0
+    for ref in name_refs:
+        if ref == 0:
+            names.append(strings[next_id])
+            next_id += 1
+        else:
+            names.append(strings[next_id - ref])
+    child_counts, offset = read_varints(data, offset, value_count)
+
+    child_deltas, offset = read_varints(data, offset, sum(child_counts))
+    parents = [row for row, count in enumerate(child_counts) for _ in range(count)]
+    child_data = [delta + parent + 1 for delta, parent in zip(zigzag_decode(child_deltas), parents)]
+
+    values, offset = read_varints(data, offset, value_count)
+    values = zigzag_decode(values)
+    previous = 0
+    for row, is_address in enumerate(address_rows(tags, child_counts, child_data)):
+        if is_address:
+            values[row] = values[row] + previous & VALUE_MASK
+            previous = values[row]
+
+    # The root node is always the first
+    return ValueTable.from_columns(tags, names, values, child_counts, child_data)
+
+
+def address_rows(tags: Sequence[int], child_counts: Sequence[int], child_data: Sequence[int]) -> list[bool]:
+    """Rows holding a variable address, the variables that are first referenced by a namespace"""
+    result = [False] * len(tags)
+    seen = [False] * len(tags)
+    offset = 0
+    for row, count in enumerate(child_counts):
+        for child in child_data[offset : offset + count]:
+            if not seen[child]:
+                seen[child] = True
+                result[child] = tags[row] == ValueTag.Namespace and tags[child] == ValueTag.Variable
+        offset += count
+    return result
+
+
+def write_strings(buf: BytesIO, strings: list[bytes]):
+    """Front coded strings, every string only stores the part that differs from the previous one"""
+    prefixes = []
+    suffixes = []
+    previous = b""
+    for string in strings:
+        prefix = 0
+        limit = min(len(previous), len(string))
+        while prefix < limit and previous[prefix] == string[prefix]:
+            prefix += 1
+        prefixes.append(prefix)
+        suffixes.append(string[prefix:])
+        previous = string
+
+    write_varint(buf, len(strings))
+    buf.write(write_varints(prefixes))
+    buf.write(write_varints([len(suffix) for suffix in suffixes]))
+    buf.write(b"".join(suffixes))
+
+
+def read_strings(data: bytes, offset: int) -> (list[str], int):
+    buf = BytesIO(data)
+    buf.seek(offset)
+    count = read_varint(buf)
+    prefixes, offset = read_varints(data, buf.tell(), count)
+    suffix_lens, offset = read_varints(data, offset, count)
+
+    # Prefixes are in bytes, so strings are only decoded after they are complete
+    strings = []
+    previous = b""
+    for prefix, suffix_len in zip(prefixes, suffix_lens):
+        previous = previous[:prefix] + data[offset : offset + suffix_len]
+        offset += suffix_len
+        strings.append(previous.decode())
+    return strings, offset
+
+
+def zigzag_encode(values: Sequence[int]) -> list[int]:
+    """Map signed integers to unsigned ones, small negative numbers stay small"""
+    return [value * 2 if value >= 0 else -value * 2 - 1 for value in values]
+
+
+def zigzag_decode(values: Sequence[int]) -> list[int]:
+    return [value >> 1 if not value & 1 else -(value >> 1) - 1 for value in values]
+
+
+def write_varints(values: Sequence[int]) -> bytes:
+    """Encode a list of varints at once"""
+    if use_numpy and len(values) >= 64:
+        return write_varints_numpy(values)
 
-    # Values
-    value_count = read_varint(data)
-    ix_list = range(0, value_count)
-    tag_list = [ValueTag(read_varint(data)) for _ in ix_list]
-    name_len_list = [read_varint(data) for _ in ix_list]
-    name_list = [data.read(l).decode() for l in name_len_list]
-    value_list = [read_varint(data) for _ in ix_list]
-    child_len_list = [read_varint(data) for _ in ix_list]
-    child_list = [[read_varint(data) for _ in range(0, l)] for l in child_len_list]
+    data = bytearray()
+    for value in values:
+        while value >= 0x80:
+            data.append((value & 0x7F) | 0x80)
+            value >>= 7
+        data.append(value)
+    return bytes(data)
 
-    values = [Value(tag, name, value) for tag, name, value in zip(tag_list, name_list, value_list)]
-    for val, children in zip(values, child_list):
-        val.children = [values[child] for child in children]
 
-    # Return root node (always the first)
-    return values[0]
+def read_varints(data: bytes, offset: int, count: int) -> (array, int):
+    """Decode count varints starting at offset, returns the values and the offset after the last one"""
+    if use_numpy and count >= 64:
+        return read_varints_numpy(data, offset, count)
+
+    values = array("Q")
+    for _ in range(count):
+        value = 0
+        shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        values.append(value)
+    return values, offset
+
+
+def write_varints_numpy(values: Sequence[int]) -> bytes:
+    values = numpy.asarray(values, numpy.uint64)
+
+    # Number of bytes for each value, 7 bits per byte
+    lengths = numpy.ones(len(values), numpy.int64)
+    for i in range(1, 10):
+        lengths += (values >> numpy.uint64(7 * i)) != 0
+    offsets = numpy.cumsum(lengths) - lengths
+
+    data = numpy.empty(int(lengths.sum()), numpy.uint8)
+    for i in range(0, 10):
+        mask = lengths > i
+        if not mask.any():
+            break
+        byte = ((values[mask] >> numpy.uint64(7 * i)) & numpy.uint64(0x7F)).astype(numpy.uint8)
+        byte[lengths[mask] > i + 1] |= 0x80
+        data[offsets[mask] + i] = byte
+    return data.tobytes()
+
+
+def read_varints_numpy(data: bytes, offset: int, count: int) -> (array, int):
+    # A varint is at most 10 bytes
+    raw = numpy.frombuffer(data, numpy.uint8, min(len(data) - offset, count * 10), offset)
+
+    # Every varint ends with a byte without the continuation bit
+    ends = numpy.flatnonzero(raw < 0x80)[:count]
+    if len(ends) < count:
+        raise ValueError("Unexpected end of varint data")
+    size = int(ends[-1]) + 1
+    starts = numpy.empty(count, numpy.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+
+    # Shift every byte by its position in the varint and sum them up
+    shifts = (numpy.arange(size) - numpy.repeat(starts, ends - starts + 1)) * 7
+    parts = (raw[:size] & 0x7F).astype(numpy.uint64) << shifts.astype(numpy.uint64)
+    values = numpy.add.reduceat(parts, starts)
+    return array("Q", values.tobytes()), offset + size
 
 
 def write_u8(buf: BytesIO, value: int):
@@ -95,3 +293,84 @@ def read_varint(buf: BytesIO) -> int:
         if not (byte & 0x80):
             break
     return value
+
+
+def test_store_roundtrip():
+    root = Value(ValueTag.Namespace, "root")
+    var = Value(ValueTag.Variable, "g_µs", 0x20001000)
+    ptr = Value(ValueTag.Pointer, "", 4)
+    struct = Value(ValueTag.Struct, "Node", 8)
+    member = Value(ValueTag.Variable, "next", 4)
+    root.children = [var, var]
+    var.children = [ptr]
+    ptr.children = [struct]
+    struct.children = [member]
+    member.children = [ptr]
+
+    for version in [1, 2]:
+        data = encode(ValueTable.from_value(root), version=version)
+        value = decode(data, version).to_value()
+        assert value.equals_deep(root)
+        assert value.children[0] is value.children[1]
+        assert encode(decode(data, version), version=version) == data
+
+
+def test_store_delta():
+    root = Value(ValueTag.Namespace, "root")
+    enum = Value(ValueTag.Enum, "Mode", 4)
+    enum.children = [Value(ValueTag.EnumValue, "MODE_ERROR", -1), Value(ValueTag.EnumValue, "MODE_IDLE", 0)]
+    for i, addr in enumerate([0x20001000, 0x20000F00, 0x20001008]):
+        var = Value(ValueTag.Variable, f"ns::g_motor{i}", addr)
+        var.children = [enum]
+        root.children.append(var)
+
+    # Negative values can only be stored with zigzag coding
+    data = encode(ValueTable.from_value(root))
+    assert decode(data).to_value().equals_deep(root)
+    assert encode(decode(data)) == data
+
+    # Values that only fit in 64 bits unsigned, addresses on both sides of the upper half
+    enum.children.append(Value(ValueTag.EnumValue, "MODE_ALL", 2**64 - 1))
+    for addr in [0xFFFFFFFF80001000, 0x1000]:
+        var = Value(ValueTag.Variable, f"g_{addr:x}", addr)
+        var.children = [enum]
+        root.children.append(var)
+    table = ValueTable.from_value(root)
+    for version in [1, 2]:
+        data = encode(table, version=version)
+        decoded = decode(data, version)
+        assert decoded.to_value().equals_deep(table.to_value())
+        assert encode(decoded, version=version) == data
+    assert decoded.to_value().children[-2].value == 0xFFFFFFFF80001000
+    assert decoded.to_value().children[0].children[0].children[-1].value == -1
+
+
+def test_strings():
+    strings = [b"", b"ns::Foo::bar", b"ns::Foo::baz", b"ns::F\xc2\xb5", b"ns::F\xc2\xb6"]
+    buf = BytesIO()
+    write_strings(buf, strings)
+    buf.write(b"tail")
+    data = buf.getvalue()
+    decoded, offset = read_strings(data, 0)
+    assert decoded == [s.decode() for s in strings]
+    assert data[offset:] == b"tail"
+    assert zigzag_decode(zigzag_encode([0, -1, 1, -2**63, 2**63 - 1])) == [0, -1, 1, -2**63, 2**63 - 1]
+
+
+def test_varints():
+    global use_numpy
+
+    values = [0, 1, 127, 128, 300, 2**32, 2**63 - 1, 2**64 - 1] * 20
+    data = write_varints(values) + b"tail"
+    buf = BytesIO(data)
+    assert [read_varint(buf) for _ in values] == values
+
+    for numpy_enabled in [False, numpy is not None]:
+        use_numpy = numpy_enabled
+        try:
+            assert write_varints(values) + b"tail" == data
+            decoded, offset = read_varints(data, 0, len(values))
+            assert list(decoded) == values
+            assert data[offset:] == b"tail"
+        finally:
+            use_numpy = numpy is not None
@@ -0,0 +1,255 @@
+import re
+from typing import Callable, Iterator
+from value import Value, ValueTag
+
+# The variable name ends at the first member or index
+path_start = re.compile(r"\.|->|\[")
+path_part = re.compile(r"(?:\.|->)\s*([^.\[\-\s]+)\s*|\[\s*(\w+)\s*\]\s*")
+
+
+class Symbol:
+    """A resolved path, the address of the value and its type"""
+
+    def __init__(self, path: str, addr: int, type: Value):
+        self.path = path
+        self.addr = addr
+        self.type = type
+        self.size = type.size()
+
+    def __repr__(self) -> str:
+        return f"Symbol({self.path!r}, {self.addr:#x}, {self.type.pretty()!r}, {self.size})"
+
+
+def variable_names(value: Value, depth: int = 0, skip: set[Value] = frozenset()) -> Iterator[tuple[str, Value]]:
+    """
+    Names of the variables below value in table order, depth is the depth of value below the root.
+    Every variable has its plain name and the name qualified with the namespaces below the compile unit, like `ns::g_state`.
+    Namespaces in skip are left out.
+    """
+    todo = [(value, "", depth)]
+    while todo:
+        value, prefix, depth = todo.pop()
+        if value.tag == ValueTag.Variable:
+            yield value.name, value
+            if prefix:
+                yield prefix + value.name, value
+        elif value.tag == ValueTag.Namespace:
+            if depth >= 2:
+                prefix += value.name + "::"
+            todo += [(c, prefix, depth + 1) for c in reversed(value.children) if c not in skip]
+
+
+class SymbolIndex:
+    """
+    Lookup of variables and their members by name, built once from the decoded tree.
+
+    Variables are found by their plain name and by the name qualified with the namespaces
+    below the compile unit, like `ns::g_state`. When names clash the first variable in table order wins.
+
+    The directory maps the names in namespaces of the root that are not read yet to the first namespace that has them.
+    Such a namespace is passed to load and added to the index once, when one of its names is looked up.
+    Names that are neither indexed nor in the directory are not found, without reading anything.
+    """
+
+    def __init__(self, root: Value, directory: dict[str, Value] = None, load: Callable[[Value], None] = None):
+        self.variables: dict[str, Value] = {}
+        self.directory = directory or {}
+        self.load = load
+
+        # Members of every struct that was used in a path, including the members of anonymous structs and unions
+        self.members: dict[Value, dict[str, (int, Value)]] = {}
+
+        # Namespaces of the directory are indexed when they are needed
+        self.unindexed = set(self.directory.values())
+        self.add(root, 0)
+
+    def add(self, value: Value, depth: int, namespace: Value = None):
+        """Index the variables below value, names in the directory only belong to their namespace"""
+        for name, var in variable_names(value, depth, self.unindexed):
+            if self.directory.get(name, namespace) is namespace:
+                self.variables.setdefault(name, var)
+
+    def __len__(self) -> int:
+        return len(self.variables.keys() | self.directory.keys())
+
+    def find(self, name: str) -> Value:
+        namespace = self.directory.get(name)
+        if namespace in self.unindexed:
+            self.unindexed.remove(namespace)
+            if self.load is not None:
+                self.load(namespace)
+            self.add(namespace, 1, namespace)
+        return self.variables.get(name)
+
+    def member(self, struct: Value, name: str) -> (int, Value):
+        """Offset and variable of a struct member, None if there is no such member"""
+        members = self.members.get(struct)
+        if members is None:
+            members = {}
+
+            def collect(struct: Value, offset: int):
+                for member in struct.children:
+                    if member.name:
+                        members.setdefault(member.name, (offset + member.value, member))
+                    elif member.type() is not None and member.type().untypedef().tag == ValueTag.Struct:
+                        collect(member.type().untypedef(), offset + member.value)
+
+            collect(struct, 0)
+            self.members[struct] = members
+        return members.get(name)
+
+    def resolve(self, path: str, base: int = 0, read_int: Callable[[int, int], int] = None) -> Symbol:
+        """
+        Find the address and type of a path like `ns::g_state.motor[2].speed`.
+
+        Addresses are relative to base. Pointers can only be followed when read_int is given.
+        """
+        start = path_start.search(path)
+        name = path[: start.start()] if start else path
+        var = self.find(name.strip())
+        if var is None:
+            raise ValueError(f"Unknown variable '{name.strip()}'")
+
+        addr = base + var.value
+        type = var.type()
+        pos = len(name)
+        while pos < len(path):
+            part = path_part.match(path, pos)
+            if part is None:
+                raise ValueError(f"Invalid path '{path}' at '{path[pos:]}'")
+            parent = path[: part.start()].strip()
+            member, index = part.groups()
+            pos = part.end()
+
+            type = type.untypedef()
+            pointer = type.tag == ValueTag.Pointer
+            if pointer:
+                if read_int is None:
+                    raise ValueError(f"'{parent}' is a pointer, it can only be followed when connected")
+                addr = read_int(addr, type.value)
+                type = type.type()
+                if type is None:
+                    raise ValueError(f"'{parent}' is a void pointer")
+
+            if member is not None:
+                type = type.untypedef()
+                found = self.member(type, member) if type.tag == ValueTag.Struct else None
+                if found is None:
+                    raise ValueError(f"'{parent}' has no member '{member}'")
+                offset, var = found
+                addr += offset
+                type = var.type()
+            elif pointer:
+                # Indexing a pointer selects an element of the array it points to
+                addr += int(index, 0) * type.size()
+            elif type.tag == ValueTag.Array:
+                index = int(index, 0)
+                if type.value and index >= type.value:
+                    raise ValueError(f"Index {index} is out of range for '{parent}'")
+                type = type.type()
+                addr += index * type.size()
+            else:
+                raise ValueError(f"'{parent}' is not an array")
+        return Symbol(path, addr, type)
+
+
+def make_example() -> Value:
+    root = Value(ValueTag.Namespace, "app")
+    cu = Value(ValueTag.Namespace, "main.c")
+    ns = Value(ValueTag.Namespace, "ns")
+    root.children = [cu]
+
+    type_int = Value(ValueTag.BaseType, "int", 4)
+    motor = Value(ValueTag.Struct, "Motor", 8)
+    motor.children = [Value(ValueTag.Variable, "pos", 0), Value(ValueTag.Variable, "speed", 4)]
+    for member in motor.children:
+        member.children = [type_int]
+    motors = Value(ValueTag.Array, "", 3)
+    motors.children = [motor]
+
+    # struct State { int mode; Motor motor[3]; union { int flags; }; State *next; }
+    flags = Value(ValueTag.Struct, "", 4)
+    flags.children = [Value(ValueTag.Variable, "flags", 0)]
+    flags.children[0].children = [type_int]
+    state = Value(ValueTag.Struct, "State", 40)
+    state_ptr = Value(ValueTag.Pointer, "", 8)
+    state_ptr.children = [state]
+    for name, offset, type in [("mode", 0, type_int), ("motor", 4, motors), ("", 28, flags), ("next", 32, state_ptr)]:
+        member = Value(ValueTag.Variable, name, offset)
+        member.children = [type]
+        state.children.append(member)
+    state_t = Value(ValueTag.Typedef, "State_t", 0)
+    state_t.children = [state]
+
+    g_state = Value(ValueTag.Variable, "g_state", 0x100)
+    g_state.children = [state_t]
+    g_count = Value(ValueTag.Variable, "g_count", 0x200)
+    g_count.children = [type_int]
+    ns.children = [g_state]
+    cu.children = [ns, g_count]
+    return root
+
+
+def test_symbols():
+    index = SymbolIndex(make_example())
+    assert index.find("g_state") is index.find("ns::g_state")
+    assert index.find("main.c::g_count") is None
+    assert index.find("g_count").value == 0x200
+
+    symbol = index.resolve("ns::g_state.motor[2].speed", 0x1000)
+    assert (symbol.addr, symbol.size, symbol.type.name) == (0x1000 + 0x100 + 4 + 2 * 8 + 4, 4, "int")
+    symbol = index.resolve("g_state")
+    assert (symbol.addr, symbol.size, symbol.type.name) == (0x100, 40, "State_t")
+    assert index.resolve("g_state.motor").size == 24
+    assert index.resolve("g_state.flags").addr == 0x100 + 28
+
+    for path in ["g_missing", "g_state.missing", "g_state.motor[3]", "g_state.mode[0]", "g_state.next->mode", "g_state.motor[1"]:
+        try:
+            index.resolve(path)
+            assert False, path
+        except ValueError:
+            pass
+
+
+def test_symbols_pointer():
+    index = SymbolIndex(make_example())
+    memory = {0x100 + 32: 0x5000, 0x5000 + 40 + 32: 0x6000}
+    read_int = lambda addr, size: memory[addr]
+    assert index.resolve("g_state.next->motor[1].pos", 0, read_int).addr == 0x5000 + 4 + 8
+    assert index.resolve("g_state.next[1].next.mode", 0, read_int).addr == 0x6000
+
+
+def test_symbols_directory():
+    root = make_example()
+    other = Value(ValueTag.Namespace, "other.c")
+    late = Value(ValueTag.Namespace, "late.c")
+    root.children += [other, late]
+    contents = {}
+    for namespace, names in [(other, ["g_other", "g_count"]), (late, ["g_late", "g_other"])]:
+        contents[namespace] = []
+        for i, name in enumerate(names):
+            var = Value(ValueTag.Variable, name, 0x1000 * len(contents) + i)
+            var.children = [Value(ValueTag.BaseType, "int", 4)]
+            contents[namespace].append(var)
+
+    def load(namespace: Value):
+        loaded.append(namespace.name)
+        namespace.children = contents[namespace]
+
+    # Like the table directory, every name maps to the first namespace that has it and names of the root section are left out
+    directory = {name: namespace for namespace in [late, other] for var in contents[namespace] for name, _ in variable_names(var)}
+    del directory["g_count"]
+
+    loaded = []
+    index = SymbolIndex(root, directory, load)
+    assert index.resolve("g_state.mode").addr == 0x100
+    assert index.find("g_missing") is None
+    assert index.find("g_count").value == 0x200
+    assert loaded == []
+
+    assert index.find("g_late").value == 0x2000
+    assert loaded == ["late.c"]
+    assert index.find("g_other").value == 0x1000
+    assert index.find("g_other").value == 0x1000
+    assert loaded == ["late.c", "other.c"]
+    assert len(index) == 5
@@ -0,0 +1,330 @@
+import itertools
+from array import array
+from typing import Callable, Sequence
+from value import Value, ValueTag, StructureDigest, sort_children, structural_classes
+
+# Values are stored as their 64 bit pattern. Enum values are signed, all other values
+# (addresses, sizes, offsets and counts) are unsigned, so an enum value of 2**64 - 1 reads back as -1.
+VALUE_MASK = (1 << 64) - 1
+
+
+def value_bits(value: int) -> int:
+    """64 bit pattern of a signed or unsigned value"""
+    if not -(1 << 63) <= value <= VALUE_MASK:
+        raise OverflowError(f"Value {value} does not fit in 64 bits")
+    return value & VALUE_MASK
+
+
+def signed_value(bits: int) -> int:
+    return bits - (1 << 64) if bits >> 63 else bits
+
+
+class RowView:
+    """Read only sequence of `get(row)` for every row"""
+
+    def __init__(self, count: int, get: Callable[[int], object]):
+        self.count = count
+        self.get = get
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, row: int):
+        return self.get(row)
+
+
+class ValueTable:
+    """
+    Compact version of a Value graph, stored as a struct of arrays.
+
+    Every value is a row, row 0 is the root. Names are indices into an interned string pool,
+    values are 64 bit patterns, use `value(row)` for the number.
+    The children of a row are stored in `child_data` at [child_start, child_start + child_count).
+    """
+
+    def __init__(self):
+        self.tags = array("B")
+        self.names = array("I")
+        self.values = array("Q")
+        self.child_start = array("I")
+        self.child_count = array("I")
+        self.child_data = array("I")
+
+        # Interned string pool
+        self.strings: list[str] = []
+        self.string_ids: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.tags)
+
+    def intern(self, name: str) -> int:
+        id = self.string_ids.get(name)
+        if id is None:
+            id = len(self.strings)
+            self.strings.append(name)
+            self.string_ids[name] = id
+        return id
+
+    def add(self, tag: ValueTag, name: str, value: int = 0) -> int:
+        """Append a new row without children"""
+        row = len(self.tags)
+        self.tags.append(tag)
+        self.names.append(self.intern(name))
+        self.values.append(value_bits(value))
+        self.child_start.append(len(self.child_data))
+        self.child_count.append(0)
+        return row
+
+    def tag(self, row: int) -> ValueTag:
+        return ValueTag(self.tags[row])
+
+    def name(self, row: int) -> str:
+        return self.strings[self.names[row]]
+
+    def value(self, row: int) -> int:
+        bits = self.values[row]
+        return signed_value(bits) if self.tags[row] == ValueTag.EnumValue else bits
+
+    def label(self, row: int) -> (int, int, int):
+        return (self.tags[row], self.names[row], self.value(row))
+
+    def children(self, row: int) -> array:
+        start = self.child_start[row]
+        return self.child_data[start : start + self.child_count[row]]
+
+    def set_children(self, row: int, children: Sequence[int]):
+        """Replace the children of a row, the old children are left unused in child_data"""
+        self.child_start[row] = len(self.child_data)
+        self.child_count[row] = len(children)
+        self.child_data.extend(children)
+
+    def add_value(self, value: Value, rows: dict[Value, int]) -> int:
+        """Append all values reachable from value, rows maps already added values to their row"""
+        added: list[Value] = []
+        todo = [value]
+        while todo:
+            val = todo.pop()
+            if val in rows:
+                continue
+            rows[val] = self.add(val.tag, val.name, val.value)
+            added.append(val)
+            todo += val.children
+
+        for val in added:
+            self.set_children(rows[val], [rows[c] for c in val.children])
+        return rows[value]
+
+    @staticmethod
+    def from_columns(tags: Sequence[int], names: Sequence[str], values: Sequence[int], child_counts: Sequence[int], child_data: Sequence[int]) -> "ValueTable":
+        """Create a table from its columns, the children of every row follow each other in child_data"""
+        table = ValueTable()
+        table.tags = array("B", tags)
+        table.names = array("I", [table.intern(name) for name in names])
+        table.values = array("Q", [value_bits(value) for value in values])
+        table.child_count = array("I", child_counts)
+        table.child_start = array("I", itertools.accumulate(child_counts, initial=0))
+        table.child_start.pop()
+        table.child_data = array("I", child_data)
+        return table
+
+    @staticmethod
+    def from_value(root: Value) -> "ValueTable":
+        table = ValueTable()
+        table.add_value(root, {})
+        return table
+
+    def to_value(self, root: int = 0) -> Value:
+        values: dict[int, Value] = {}
+        todo = [root]
+        while todo:
+            row = todo.pop()
+            if row in values:
+                continue
+            values[row] = Value(self.tag(row), self.name(row), self.value(row))
+            todo += self.children(row)
+
+        for row, value in values.items():
+            value.children = [values[c] for c in self.children(row)]
+        return values[root]
+
+    def variables(self, root: int = 0) -> list[int]:
+        result = []
+        todo = [root]
+        while todo:
+            row = todo.pop()
+            if self.tags[row] == ValueTag.Variable:
+                result.append(row)
+            elif self.tags[row] == ValueTag.Namespace:
+                todo += reversed(self.children(row))
+        return result
+
+    def debug_print(self, root: int = 0):
+        skip = set()
+
+        def debug(row: int, parents: list[int]):
+            show_kids = True
+            text = f"{self.tag(row)}({self.name(row)!r},{self.value(row)!r})"
+            if row in parents:
+                text += " (CYCLE)"
+                show_kids = False
+            if row in skip:
+                text += " (REUSED)"
+                show_kids = False
+            else:
+                skip.add(row)
+            print(f"{"    "*len(parents)}{text}")
+            if show_kids:
+                for c in self.children(row):
+                    debug(c, parents + [row])
+
+        debug(root, [])
+
+    def deduplicate(self):
+        """Deduplicate equal values, same result as Value.deduplicate"""
+        count = len(self)
+        classes = structural_classes(RowView(count, self.label), RowView(count, self.children))
+
+        # The first visited row of each class is kept, rows are visited depth first
+        first = array("q", [-1]) * count
+        first[classes[0]] = 0
+        stack = [(0, 0)]
+        while stack:
+            row, i = stack[-1]
+            if i == self.child_count[row]:
+                stack.pop()
+                continue
+            stack[-1] = (row, i + 1)
+
+            index = self.child_start[row] + i
+            child = self.child_data[index]
+            cls = classes[child]
+            if first[cls] < 0:
+                first[cls] = child
+                stack.append((child, 0))
+            self.child_data[index] = first[cls]
+
+    def sort_key(self, row: int) -> (int, str, int):
+        return (self.tags[row], self.strings[self.names[row]], self.value(row))
+
+    def sort(self):
+        """Sort the children of every row, in the same order as Value.sort"""
+        digest = StructureDigest(self.sort_key, self.children)
+        visited = array("b", [False]) * len(self)
+        todo = [0]
+        while todo:
+            row = todo.pop()
+            if visited[row]:
+                continue
+            visited[row] = True
+
+            start = self.child_start[row]
+            end = start + self.child_count[row]
+            children = sort_children(self.child_data[start:end], self.sort_key, digest)
+            self.child_data[start:end] = array("I", children)
+            todo += children
+
+    def join_namespaces(self):
+        """Merge sibling namespaces with the same name"""
+        todo = [0]
+        while todo:
+            row = todo.pop()
+            if self.tags[row] != ValueTag.Namespace:
+                continue
+
+            visited: dict[int, int] = {}
+            joined: dict[int, list[int]] = {}
+            children: list[int] = []
+            for c in self.children(row):
+                if self.tags[c] != ValueTag.Namespace:
+                    children.append(c)
+                    continue
+
+                name = self.names[c]
+                if name in visited:
+                    joined[visited[name]] += self.children(c)
+                else:
+                    visited[name] = c
+                    joined[c] = list(self.children(c))
+                    children.append(c)
+
+            for c, grand_children in joined.items():
+                if len(grand_children) != self.child_count[c]:
+                    self.set_children(c, grand_children)
+            if len(children) != self.child_count[row]:
+                self.set_children(row, children)
+            todo += reversed(children)
+
+
+def make_example() -> Value:
+    root = Value(ValueTag.Namespace, "root")
+    cu0 = Value(ValueTag.Namespace, "a.c")
+    cu1 = Value(ValueTag.Namespace, "b.c")
+    ns0 = Value(ValueTag.Namespace, "ns")
+    ns1 = Value(ValueTag.Namespace, "ns")
+    root.children = [cu1, cu0]
+    cu0.children = [ns0]
+    cu1.children = [ns1]
+
+    type_int = Value(ValueTag.BaseType, "int", 4)
+    list_struct = Value(ValueTag.Struct, "List", 16)
+    list_ptr = Value(ValueTag.Pointer, "", 8)
+    list_ptr.children = [list_struct]
+    member_next = Value(ValueTag.Variable, "next", 8)
+    member_next.children = [list_ptr]
+    member_value = Value(ValueTag.Variable, "value", 0)
+    member_value.children = [type_int]
+    list_struct.children = [member_next, member_value]
+
+    for i, ns in enumerate([ns0, ns1, ns1]):
+        var_x = Value(ValueTag.Variable, f"x{i}", 0x100 + i)
+        var_x.children = [Value(ValueTag.BaseType, "int", 4)]
+        var_list = Value(ValueTag.Variable, "items", 0x200 + i)
+        var_list.children = [list_ptr]
+        ns.children += [var_x, var_list]
+    return root
+
+
+def test_table_roundtrip():
+    root = make_example()
+    table = ValueTable.from_value(root)
+    assert table.name(0) == "root"
+    assert [table.name(v) for v in table.variables()] == ["x1", "items", "x2", "items", "x0", "items"]
+
+    value = table.to_value()
+    assert [c.name for c in value.children] == ["b.c", "a.c"]
+    list_ptr = value.children[0].children[0].children[1].children[0]
+    assert list_ptr.children[0].children[0].children[0] is list_ptr
+
+
+def test_table_matches_value():
+    # Both representations should give the same tree
+    root = make_example()
+    table = ValueTable.from_value(make_example())
+    for val, tab in [(root.join_namespaces, table.join_namespaces), (root.deduplicate, table.deduplicate), (root.sort, table.sort)]:
+        val()
+        tab()
+        assert ValueTable.from_value(root).to_value().equals_deep(table.to_value())
+
+    value = table.to_value()
+    assert [c.name for c in value.children] == ["a.c", "b.c"]
+    assert [v.name for v in ValueTable.from_value(value).to_value().variables()] == ["items", "x0", "items", "items", "x1", "x2"]
+
+
+def test_table_large_values():
+    # An 8 byte enum value of -1 read as unsigned, and an address in the upper half
+    root = Value(ValueTag.Namespace, "root")
+    enum = Value(ValueTag.Enum, "Mode", 8)
+    enum.children = [Value(ValueTag.EnumValue, "MODE_ALL", 2**64 - 1), Value(ValueTag.EnumValue, "MODE_NONE", -2)]
+    var = Value(ValueTag.Variable, "g_mode", 0xFFFFFFFF80001000)
+    var.children = [enum]
+    root.children = [var]
+
+    table = ValueTable.from_value(root)
+    value = table.to_value()
+    assert value.children[0].value == 0xFFFFFFFF80001000
+    assert [c.value for c in value.children[0].children[0].children] == [-1, -2]
+    try:
+        ValueTable.from_value(Value(ValueTag.Variable, "big", 2**64))
+        assert False
+    except OverflowError:
+        pass
@@ -0,0 +1,274 @@
+"""
+Layout of the table data following the 16 byte DEBUG_DATA header (magic, max_size, data_size).
+
+Version 0 (legacy) is the zlib compressed store data of the entire tree.
+
+Version 1 splits the tree into sections that are compressed separately,
+so a reader only has to fetch the parts it needs:
+
+    u8[4]  magic "ITBL"
+    u8     version
+    u8     codec used for all sections (version 2, always zlib in version 1)
+    u8[2]  reserved
+    u32    size of the index in bytes
+    u64    address of the DEBUG_DATA table in the debug info (0 if unknown)
+    u8[16] blake2b hash of everything after the prefix (version 4)
+    index: varint section count,
+           per section: varint name length, name, varint compressed size
+           varint compressed directory size, compressed directory (version 5)
+    compressed sections, in index order
+
+Section 0 holds the root without its namespaces, every other section holds one namespace of the root.
+
+The directory holds the names of the variables in the namespace sections, front coded in sorted order,
+followed by a varint section number per name. A name is only listed with the first section that has it,
+and not at all when section 0 has it. Readers only read the section of a variable they look up.
+
+Version 3 uses store version 2 for the sections, earlier versions use store version 1.
+Version 4 adds the hash, so readers can recognize a table they decoded before.
+Version 5 adds the directory.
+"""
+
+import bz2
+import hashlib
+import lzma
+import zlib
+from io import BytesIO
+from typing import Callable
+import store
+from symbols import variable_names
+from table import ValueTable
+from value import ValueTag
+
+FORMAT_MAGIC = b"ITBL"
+FORMAT_VERSION = 5
+
+# Size of the fixed part before the index, versions before 4 have no hash
+PREFIX_SIZE = 36
+HASH_SIZE = 16
+
+
+class Codec:
+    def __init__(self, id: int, name: str, compress: Callable[[bytes], bytes], decompress: Callable[[bytes], bytes]):
+        self.id = id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+def deflate_compress(data: bytes) -> bytes:
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+# Raw LZMA2 stream without the xz container, the filters are needed for decompression as well
+lzma_filters = [{"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME}]
+
+CODECS = [
+    Codec(0, "zlib", zlib.compress, zlib.decompress),
+    Codec(1, "zlib9", lambda data: zlib.compress(data, 9), zlib.decompress),
+    Codec(2, "deflate", deflate_compress, lambda data: zlib.decompress(data, -15)),
+    Codec(3, "lzma", lambda data: lzma.compress(data, lzma.FORMAT_RAW, filters=lzma_filters), lambda data: lzma.decompress(data, lzma.FORMAT_RAW, filters=lzma_filters)),
+    Codec(4, "bz2", lambda data: bz2.compress(data, 9), bz2.decompress),
+]
+CODEC_NAMES = {codec.name: codec for codec in CODECS}
+
+
+def find_codec(id: int) -> Codec:
+    if id >= len(CODECS):
+        raise ValueError(f"Unsupported table codec {id}")
+    return CODECS[id]
+
+
+class Section:
+    def __init__(self, name: str, offset: int, size: int):
+        # Namespace name, empty for the root section
+        self.name = name
+
+        # Offset of the compressed data from the start of the table data
+        self.offset = offset
+        self.size = size
+
+
+class TableIndex:
+    def __init__(self, version: int, codec: Codec = CODECS[0], index_size: int = 0, table_addr: int = 0, hash: bytes = b""):
+        self.version = version
+        self.codec = codec
+        self.index_size = index_size
+        self.table_addr = table_addr
+        self.hash = hash
+        self.prefix_size = PREFIX_SIZE if version >= 4 else PREFIX_SIZE - HASH_SIZE
+        self.sections: list[Section] = []
+
+        # Section number of every variable name outside of section 0, None before version 5
+        self.directory: dict[str, int] = None
+
+
+def encode_sections(table: ValueTable) -> list[(str, bytes, list[str])]:
+    """Encode the root and every namespace of the root separately, with the names of the variables in them"""
+    namespaces = [c for c in table.children(0) if table.tags[c] == ValueTag.Namespace]
+    others = [c for c in table.children(0) if table.tags[c] != ValueTag.Namespace]
+
+    # The root section only contains the values that are not in a namespace section
+    start, count = table.child_start[0], table.child_count[0]
+    table.set_children(0, others)
+    names = [name for name, _ in variable_names(table.to_value())]
+    sections = [("", store.encode(table, version=store_version(FORMAT_VERSION)), names)]
+    table.child_start[0], table.child_count[0] = start, count
+
+    for row in namespaces:
+        names = [name for name, _ in variable_names(table.to_value(row), 1)]
+        sections.append((table.name(row), store.encode(table, row, store_version(FORMAT_VERSION)), names))
+    return sections
+
+
+def pack_directory(sections: list[(str, bytes, list[str])]) -> bytes:
+    directory = {}
+    for number, (_, _, names) in enumerate(sections):
+        for name in names:
+            directory.setdefault(name, number)
+    entries = sorted((name.encode(), number) for name, number in directory.items() if number > 0)
+
+    data = BytesIO()
+    store.write_strings(data, [name for name, _ in entries])
+    data.write(store.write_varints([number for _, number in entries]))
+    return data.getvalue()
+
+
+def pack_sections(sections: list[(str, bytes, list[str])], table_addr: int, codec: Codec) -> bytes:
+    """Compress the encoded sections and add the index"""
+    directory = codec.compress(pack_directory(sections))
+    sections = [(name, codec.compress(data)) for name, data, _ in sections]
+
+    index = BytesIO()
+    store.write_varint(index, len(sections))
+    for name, data in sections:
+        name = name.encode()
+        store.write_varint(index, len(name))
+        index.write(name)
+        store.write_varint(index, len(data))
+    store.write_varint(index, len(directory))
+    index.write(directory)
+    index = index.getvalue()
+    content = index + b"".join(section for _, section in sections)
+
+    data = BytesIO()
+    data.write(FORMAT_MAGIC)
+    data.write(bytes([FORMAT_VERSION, codec.id, 0, 0]))
+    data.write(len(index).to_bytes(4, "little"))
+    data.write(table_addr.to_bytes(8, "little"))
+    data.write(hashlib.blake2b(content, digest_size=HASH_SIZE).digest())
+    data.write(content)
+    return data.getvalue()
+
+
+def pack(table: ValueTable, table_addr: int, codec: Codec = CODECS[0]) -> bytes:
+    """Encode and compress the table in sections"""
+    return pack_sections(encode_sections(table), table_addr, codec)
+
+
+def unpack_prefix(prefix: bytes) -> TableIndex:
+    """Read the fixed part of the table data, returns version 0 for legacy tables"""
+    if len(prefix) < PREFIX_SIZE - HASH_SIZE or prefix[0:4] != FORMAT_MAGIC:
+        # A zlib stream never starts with the format magic
+        return TableIndex(0)
+
+    version = prefix[4]
+    if version > FORMAT_VERSION:
+        raise ValueError(f"Unsupported table version {version}")
+    codec = find_codec(prefix[5] if version >= 2 else 0)
+    index_size = int.from_bytes(prefix[8:12], "little")
+    table_addr = int.from_bytes(prefix[12:20], "little")
+    hash = prefix[20:36] if version >= 4 else b""
+    return TableIndex(version, codec, index_size, table_addr, hash)
+
+
+def unpack_index(info: TableIndex, data: bytes):
+    """Read the section list following the prefix"""
+    buf = BytesIO(data)
+    offset = info.prefix_size + info.index_size
+    for _ in range(store.read_varint(buf)):
+        name = buf.read(store.read_varint(buf)).decode()
+        size = store.read_varint(buf)
+        info.sections.append(Section(name, offset, size))
+        offset += size
+
+    if info.version >= 5:
+        directory = info.codec.decompress(buf.read(store.read_varint(buf)))
+        names, offset = store.read_strings(directory, 0)
+        numbers, _ = store.read_varints(directory, offset, len(names))
+        info.directory = dict(zip(names, numbers))
+
+
+def store_version(version: int) -> int:
+    """Store encoding used by a table version"""
+    return 2 if version >= 3 else 1
+
+
+def unpack_section(info: TableIndex, data: bytes) -> ValueTable:
+    return store.decode(info.codec.decompress(data), store_version(info.version))
+
+
+def unpack_legacy(data: bytes) -> ValueTable:
+    return store.decode(zlib.decompress(data), store_version(0))
+
+
+def unpack(data: bytes) -> ValueTable:
+    """Decode complete table data of any version"""
+    info = unpack_prefix(data[:PREFIX_SIZE])
+    if info.version == 0:
+        return unpack_legacy(data)
+
+    unpack_index(info, data[info.prefix_size : info.prefix_size + info.index_size])
+    sections = [unpack_section(info, data[s.offset : s.offset + s.size]) for s in info.sections]
+
+    # Add the namespace sections back to the root
+    root = sections[0]
+    children = list(root.children(0))
+    for section in sections[1:]:
+        rows = {}
+        children.append(root.add_value(section.to_value(), rows))
+    root.set_children(0, children)
+    return root
+
+
+def test_pack():
+    from table import make_example
+
+    table = ValueTable.from_value(make_example())
+    table.join_namespaces()
+    table.deduplicate()
+    table.sort()
+
+    data = pack(table, 0x1234)
+    info = unpack_prefix(data[:PREFIX_SIZE])
+    assert (info.version, info.table_addr) == (FORMAT_VERSION, 0x1234)
+    assert info.hash == hashlib.blake2b(data[PREFIX_SIZE:], digest_size=HASH_SIZE).digest()
+    unpack_index(info, data[PREFIX_SIZE : PREFIX_SIZE + info.index_size])
+    assert [s.name for s in info.sections] == ["", "a.c", "b.c"]
+    assert info.sections[-1].offset + info.sections[-1].size == len(data)
+    a_names = ["x0", "ns::x0", "items", "ns::items"]
+    assert info.directory == {name: 1 for name in a_names} | {name: 2 for name in ["x1", "ns::x1", "x2", "ns::x2"]}
+
+    value = unpack(data).to_value()
+    assert value.equals_deep(table.to_value())
+
+
+def test_codecs():
+    from table import make_example
+
+    table = ValueTable.from_value(make_example())
+    for codec in CODECS:
+        data = pack(table, 0, codec)
+        info = unpack_prefix(data[:PREFIX_SIZE])
+        assert info.codec is codec
+        assert unpack(data).to_value().equals_deep(table.to_value())
+
+
+def test_unpack_legacy():
+    from table import make_example
+
+    table = ValueTable.from_value(make_example())
+    data = zlib.compress(store.encode(table, version=store_version(0)))
+    assert unpack_prefix(data[:PREFIX_SIZE]).version == 0
+    assert unpack(data).to_value().equals_deep(table.to_value())
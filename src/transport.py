@@ -0,0 +1,235 @@
+import os
+import socket
+import struct
+import termios
+import tty
+from collections import deque
+
+# Start of the DEBUG_DATA header
+HEADER_MAGIC = bytes.fromhex("a1072345f05cae4c")
+
+# Reply to the features command, never equal to the start of an aligned address returned by info
+FEATURES_MAGIC = 0x3BA7F0E1
+
+# Checksum of a block the target can not read, the low half of an Adler-32 is always below 65521
+CHECKSUM_ERROR = 0xFFFFFFFF
+
+# Optional commands of the target
+FEATURE_READ_MANY = 1 << 0
+FEATURE_DEVICES = 1 << 1
+FEATURE_CHECKSUM = 1 << 2
+FEATURE_SAMPLE = 1 << 3
+FEATURE_SUBSCRIBE = 1 << 4
+FEATURE_COMPRESSED_READ = 1 << 5
+
+
+class Transport:
+    """Byte stream to a target"""
+
+    def sendall(self, data: bytes):
+        raise NotImplementedError
+
+    def recv_into(self, view: memoryview) -> int:
+        """Receive at most len(view) bytes, returns the number of bytes received, 0 when the target is gone"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SocketTransport(Transport):
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+
+    def sendall(self, data: bytes):
+        self.sock.sendall(data)
+
+    def recv_into(self, view: memoryview) -> int:
+        return self.sock.recv_into(view)
+
+    def close(self):
+        self.sock.close()
+
+
+class TcpTransport(SocketTransport):
+    def __init__(self, host: str, port: int):
+        super().__init__(socket.create_connection((host, port)))
+        # Requests are small and every one of them is waited for
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class UnixTransport(SocketTransport):
+    def __init__(self, path: str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        super().__init__(sock)
+
+
+class SerialTransport(Transport):
+    """Serial port in raw mode"""
+
+    def __init__(self, device: str, baudrate: int = 115200):
+        speed = getattr(termios, f"B{baudrate}", None)
+        if speed is None:
+            raise ValueError(f"Unsupported baudrate {baudrate}")
+
+        self.fd = os.open(device, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(self.fd)
+        attrs = termios.tcgetattr(self.fd)
+        attrs[4] = attrs[5] = speed
+        attrs[6][termios.VMIN] = 1
+        attrs[6][termios.VTIME] = 0
+        termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+
+    def sendall(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view) :]
+
+    def recv_into(self, view: memoryview) -> int:
+        return os.readv(self.fd, [view])
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ProcessTransport(Transport):
+    """
+    Local process as target, its memory is accessed through /proc/<pid>/mem without a server in the process.
+
+    The protocol is handled here, replies to reads are read from the process straight into the buffer of the caller.
+    Reading another process needs ptrace access to it, for example by being its parent or with ptrace_scope 0.
+    """
+
+    def __init__(self, pid: int, table_addr: int = None):
+        self.mem = os.open(f"/proc/{pid}/mem", os.O_RDWR)
+        self.table_addr = find_table(pid) if table_addr is None else table_addr
+
+        # Bytes of commands that are not complete yet
+        self.request = bytearray()
+
+        # Replies that are not received yet, either bytes or an [addr, size] range of process memory
+        self.replies: deque[bytes | list[int]] = deque()
+
+    def sendall(self, data: bytes):
+        self.request += data
+        while self.request:
+            size = self.handle(self.request)
+            if size == 0:
+                break
+            del self.request[:size]
+
+    def handle(self, request: bytearray) -> int:
+        """Handle the first command in request, returns its size or 0 if it is not complete"""
+        command = request[0]
+        if command == 0:
+            self.replies.append(struct.pack("<Q", self.table_addr))
+        elif command == 1 or command == 2:
+            if len(request) < 17:
+                return 0
+            addr, size = struct.unpack_from("<QQ", request, 1)
+            if command == 1:
+                self.replies.append([addr, size])
+            else:
+                if len(request) < 17 + size:
+                    return 0
+                os.pwrite(self.mem, request[17 : 17 + size], addr)
+                return 17 + size
+            return 17
+        elif command == 3:
+            self.replies.append(struct.pack("<II", FEATURES_MAGIC, FEATURE_READ_MANY))
+        elif command == 4:
+            if len(request) < 5:
+                return 0
+            (count,) = struct.unpack_from("<I", request, 1)
+            if len(request) < 5 + count * 16:
+                return 0
+            for i in range(count):
+                self.replies.append(list(struct.unpack_from("<QQ", request, 5 + i * 16)))
+            return 5 + count * 16
+
+        # Unknown commands are ignored, like the other targets do
+        return 1
+
+    def recv_into(self, view: memoryview) -> int:
+        while self.replies:
+            reply = self.replies[0]
+            if isinstance(reply, list):
+                addr, size = reply
+                if size == 0:
+                    self.replies.popleft()
+                    continue
+                count = os.preadv(self.mem, [view[:size]], addr)
+                if count == 0:
+                    raise OSError(f"Unable to read process memory at {addr:#x}")
+                reply[0] += count
+                reply[1] -= count
+                return count
+
+            count = min(len(reply), len(view))
+            view[:count] = reply[:count]
+            if count == len(reply):
+                self.replies.popleft()
+            else:
+                self.replies[0] = reply[count:]
+            return count
+        raise ConnectionError("No reply is expected from the process")
+
+    def close(self):
+        os.close(self.mem)
+
+
+def find_table(pid: int) -> int:
+    """Address of the DEBUG_DATA table in a running process, found through the file offset of the header"""
+    exe = os.readlink(f"/proc/{pid}/exe")
+    with open(exe, "rb") as file:
+        offset = file.read().find(HEADER_MAGIC)
+    if offset < 0:
+        raise ValueError(f"No DEBUG_DATA table found in {exe}")
+
+    with open(f"/proc/{pid}/maps") as maps:
+        for line in maps:
+            fields = line.split(maxsplit=5)
+            if len(fields) < 6 or fields[5].strip() != exe:
+                continue
+            start, end = (int(addr, 16) for addr in fields[0].split("-"))
+            file_offset = int(fields[2], 16)
+            if file_offset <= offset < file_offset + end - start:
+                return start + offset - file_offset
+    raise ValueError(f"The DEBUG_DATA table of {exe} is not mapped in process {pid}")
+
+
+def open_target(target: str) -> Transport:
+    """Open a target like 'host:port', 'unix:PATH', 'serial:DEVICE[@BAUDRATE]' or 'pid:PID'"""
+    kind, _, arg = target.partition(":")
+    if kind == "unix":
+        return UnixTransport(arg)
+    if kind == "serial":
+        device, _, baudrate = arg.partition("@")
+        return SerialTransport(device, int(baudrate or 115200))
+    if kind == "pid":
+        return ProcessTransport(int(arg))
+    host, _, port = target.rpartition(":")
+    return TcpTransport(host or "localhost", int(port))
+
+
+def test_process_transport():
+    import ctypes
+    from client import Client
+
+    # This process is the target
+    memory = ctypes.create_string_buffer(bytes(range(256)) * 64)
+    addr = ctypes.addressof(memory)
+    client = Client()
+    client.transport = ProcessTransport(os.getpid(), addr)
+    try:
+        assert client.probe() == addr
+        assert client.features == FEATURE_READ_MANY
+        assert client.read(addr + 3, 10000) == memory.raw[3:10003]
+        assert client.read_many([(addr + 10, 2), (addr, 0), (addr + 1, 1)]) == [b"\x0a\x0b", b"", b"\x01"]
+
+        client.write_int(addr + 4, 4, 0x12345678)
+        assert memory.raw[4:8] == bytes([0x78, 0x56, 0x34, 0x12])
+        assert client.info() == addr
+    finally:
+        client.transport.close()
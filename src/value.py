@@ -1,5 +1,8 @@
+import hashlib
+import itertools
+from array import array
 from enum import IntEnum
-from typing import Self
+from typing import Callable, Self, Sequence
 
 
 class ValueTag(IntEnum):
@@ -52,6 +55,16 @@ class Value:
             return self.type().untypedef()
         return self
 
+    def size(self) -> int:
+        """Size of this type in bytes"""
+        if self.tag in [ValueTag.Variable, ValueTag.Typedef]:
+            return self.type().size()
+        if self.tag == ValueTag.Array:
+            return self.value * self.type().size()
+        if self.tag in [ValueTag.BaseType, ValueTag.Pointer, ValueTag.Struct, ValueTag.Enum]:
+            return self.value
+        return 0
+
     def pretty(self) -> str:
         if self.tag == ValueTag.Namespace:
             return f"{self.name}"
@@ -149,24 +162,38 @@ class Value:
     def deduplicate(self):
         """Deduplicate equal values in the tree"""
 
-        visited: dict[(ValueTag, str, int, int), set[Value]] = dict()
+        # Number all reachable values
+        values: list[Value] = []
+        index: dict[Value, int] = {}
+        todo = [self]
+        while todo:
+            value = todo.pop()
+            if value in index:
+                continue
+            index[value] = len(values)
+            values.append(value)
+            todo += value.children
+
+        classes = structural_classes(
+            [(v.tag, v.name, v.value) for v in values],
+            [[index[c] for c in v.children] for v in values],
+        )
+
+        # The first visited value of each class is kept
+        visited: dict[int, Value] = dict()
         cache: dict[Value, Value] = dict()
 
         def visit(value: Value) -> Value:
             if value in cache:
                 return cache[value]
 
-            key = (value.tag, value.name, value.value, len(value.children))
-            vis = visited.setdefault(key, set())
-
-            # Compre deeply
-            for v in vis:
-                if v.equals_deep(value):
-                    cache[value] = v
-                    return v
+            cls = classes[index[value]]
+            if cls in visited:
+                cache[value] = visited[cls]
+                return visited[cls]
 
             cache[value] = value
-            vis.add(value)
+            visited[cls] = value
             value.children = [visit(c) for c in value.children]
             return value
 
@@ -181,14 +208,21 @@ class Value:
 
         return []
 
-    def sort(self, parents: list[Self] = []):
-        if self in parents:
-            return
-
-        self.children.sort(key=lambda k: (k.tag, k.name, k.value))
-
-        for c in self.children:
-            c.sort(parents + [self])
+    def sort_key(self) -> (ValueTag, str, int):
+        return (self.tag, self.name, self.value)
+
+    def sort(self):
+        """Sort the children of every value, shared values are only sorted once"""
+        digest = StructureDigest(lambda v: (int(v.tag), v.name, v.value), lambda v: v.children)
+        visited: set[Value] = set()
+        todo = [self]
+        while todo:
+            value = todo.pop()
+            if value in visited:
+                continue
+            visited.add(value)
+            value.children = sort_children(value.children, Value.sort_key, digest)
+            todo += value.children
 
     def join_namespaces(self):
         if self.tag != ValueTag.Namespace:
@@ -213,6 +247,153 @@ class Value:
             c.join_namespaces()
 
 
+class StructureDigest:
+    """
+    Digest of the labels below a node up to a fixed depth.
+
+    It only depends on the structure, not on the order in which nodes were created,
+    so it can be used to order otherwise equal nodes in the same way for every build.
+    """
+
+    def __init__(self, label: Callable[[object], tuple], children: Callable[[object], Sequence[object]], depth: int = 8):
+        self.label = label
+        self.children = children
+        self.depth = depth
+        self.cache: dict[(object, int), bytes] = {}
+
+    def __call__(self, node: object, depth: int = None) -> bytes:
+        if depth is None:
+            depth = self.depth
+
+        key = (node, depth)
+        if key in self.cache:
+            return self.cache[key]
+
+        digest = hashlib.blake2b(repr(self.label(node)).encode(), digest_size=8)
+        if depth > 0:
+            for child in self.children(node):
+                digest.update(self(child, depth - 1))
+        self.cache[key] = digest.digest()
+        return self.cache[key]
+
+
+def sort_children(children: Sequence[object], key: Callable[[object], tuple], digest: StructureDigest) -> list[object]:
+    """Sort on key, children with an equal key are ordered by their structure digest"""
+    result = []
+    for _, group in itertools.groupby(sorted(children, key=key), key=key):
+        group = list(group)
+        if len(group) > 1:
+            group.sort(key=digest)
+        result += group
+    return result
+
+
+def structural_classes(labels: Sequence[tuple], children: Sequence[Sequence[int]]) -> Sequence[int]:
+    """
+    Group graph nodes that are structurally equal.
+
+    Two nodes are equal when they have the same label and their children are pairwise equal,
+    this also holds for cycles (a 'struct List { List *next; }' in two compile units is equal).
+    Returns a class id for every node, equal nodes share the same class id.
+
+    The strongly connected components are visited children first. Nodes outside of a cycle are hash-consed
+    on their label and the classes of their children. The nodes of a cycle are first partitioned
+    by refining their labels until stable, then the partition is numbered in sorted order, which makes the
+    numbering independent of how the cycle was reached, and looked up by that canonical form.
+    """
+    count = len(labels)
+    classes = array("q", [-1]) * count
+    signatures: dict[tuple, int] = {}
+    cycles: dict[tuple, int] = {}
+    class_count = 0
+
+    def lookup(table: dict[tuple, int], key: tuple) -> int:
+        nonlocal class_count
+        if key not in table:
+            table[key] = class_count
+            class_count += 1
+        return table[key]
+
+    def resolve(scc: list[int]):
+        node = scc[0]
+        if len(scc) == 1 and node not in children[node]:
+            classes[node] = lookup(signatures, (labels[node], tuple(classes[c] for c in children[node])))
+            return
+
+        inside = set(scc)
+        colors: dict[int, int] = {}
+
+        def refs(v: int) -> tuple:
+            return tuple((1, colors[c]) if c in inside else (0, classes[c]) for c in children[v])
+
+        # Refine until the number of colors is stable
+        color_count = 0
+        keys = {v: labels[v] for v in scc}
+        while True:
+            ranks = {key: rank for rank, key in enumerate(sorted(set(keys.values())))}
+            if len(ranks) == color_count:
+                break
+            color_count = len(ranks)
+            colors = {v: ranks[keys[v]] for v in scc}
+            keys = {v: (colors[v], refs(v)) for v in scc}
+
+        # One node for every color, in color order
+        nodes = {colors[v]: v for v in scc}
+        nodes = [nodes[color] for color in range(color_count)]
+        shape = tuple((labels[v], refs(v)) for v in nodes)
+        color_class = [lookup(cycles, (shape, color)) for color in range(color_count)]
+        for v in scc:
+            classes[v] = color_class[colors[v]]
+
+        # Values outside of a cycle can also be equal to it
+        for v in nodes:
+            signatures.setdefault((labels[v], tuple(classes[c] for c in children[v])), classes[v])
+
+    # Iterative version of Tarjan's algorithm, components are found after all their children
+    order = array("q", [-1]) * count
+    low = array("q", [0]) * count
+    on_stack = array("b", [False]) * count
+    stack: list[int] = []
+    counter = 0
+    for start in range(count):
+        if order[start] >= 0:
+            continue
+        order[start] = low[start] = counter
+        counter += 1
+        stack.append(start)
+        on_stack[start] = True
+        work = [(start, children[start], 0)]
+        while work:
+            node, node_children, i = work[-1]
+            if i < len(node_children):
+                work[-1] = (node, node_children, i + 1)
+                child = node_children[i]
+                if order[child] < 0:
+                    order[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack[child] = True
+                    work.append((child, children[child], 0))
+                elif on_stack[child]:
+                    low[node] = min(low[node], order[child])
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+            if low[node] == order[node]:
+                scc = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    scc.append(member)
+                    if member == node:
+                        break
+                resolve(scc)
+    return classes
+
+
 def test_dedup0():
     value = Value(ValueTag.Namespace, "root")
     value.deduplicate()
@@ -343,3 +524,100 @@ def test_dedup5():
     assert root.children == [cu0, cu1, cu1]
     assert cu0.children == [var_x0, var_y0, var_x0, var_y2]
     assert cu1.children == [var_x0, var_y0, var_x0, var_y2]
+
+
+def test_dedup_cycle():
+    def make_list() -> Value:
+        # struct List { int value; List *next; }
+        list_struct = Value(ValueTag.Struct, "List", 16)
+        list_ptr = Value(ValueTag.Pointer, "", 8)
+        list_ptr.children = [list_struct]
+        var_value = Value(ValueTag.Variable, "value", 0)
+        var_value.children = [Value(ValueTag.BaseType, "int", 4)]
+        var_next = Value(ValueTag.Variable, "next", 8)
+        var_next.children = [list_ptr]
+        list_struct.children = [var_value, var_next]
+        return list_ptr
+
+    root = Value(ValueTag.Namespace, "root")
+    cu0 = Value(ValueTag.Variable, "items")
+    cu1 = Value(ValueTag.Variable, "items")
+    cu0.children = [make_list()]
+    cu1.children = [make_list()]
+    root.children = [cu0, cu1]
+
+    root.deduplicate()
+    assert root.children == [cu0, cu0]
+    list_ptr = cu0.children[0]
+    assert list_ptr.children[0].children[1].children[0] is list_ptr
+
+
+def test_dedup_cycle_unrolled():
+    # A -> A is equal to B -> A when A and B have the same label
+    a = Value(ValueTag.Pointer, "", 8)
+    a.children = [a]
+    b = Value(ValueTag.Pointer, "", 8)
+    b.children = [a]
+    c = Value(ValueTag.Pointer, "", 4)
+    c.children = [c]
+    root = Value(ValueTag.Namespace, "root")
+    root.children = [b, a, c]
+    root.deduplicate()
+    assert root.children == [b, b, c]
+    assert b.children == [b]
+
+
+def test_dedup_matches_equals_deep():
+    import random
+
+    rng = random.Random(1234)
+    for cycle_chance in [0.0, 0.2]:
+        for _ in range(50):
+            values = [Value(rng.choice([ValueTag.Struct, ValueTag.Pointer]), rng.choice("ab"), rng.randint(0, 1)) for _ in range(12)]
+            for i, v in enumerate(values):
+                # Mostly forward edges, backward edges create cycles
+                targets = values if rng.random() < cycle_chance else values[i + 1 :]
+                if targets:
+                    v.children = [rng.choice(targets) for _ in range(rng.randint(0, 2))]
+
+            index = {v: i for i, v in enumerate(values)}
+            classes = structural_classes([(v.tag, v.name, v.value) for v in values], [[index[c] for c in v.children] for v in values])
+            for left in values:
+                for right in values:
+                    same = classes[index[left]] == classes[index[right]]
+                    if left.equals_deep(right):
+                        assert same
+                    elif cycle_chance == 0.0:
+                        # Without cycles both are exactly the same
+                        assert not same
+
+
+def test_sort_shared():
+    # Every level is reachable through two paths, sorting each path separately would take 2**64 steps
+    root = Value(ValueTag.Namespace, "root")
+    node = root
+    for i in range(64):
+        child = Value(ValueTag.Struct, f"level{i}", i)
+        node.children = [Value(ValueTag.Variable, "b"), Value(ValueTag.Variable, "a")]
+        node.children[0].children = [child]
+        node.children[1].children = [child]
+        node = child
+    root.sort()
+    assert [c.name for c in root.children] == ["a", "b"]
+
+
+def test_sort_ties():
+    def make(order: list[int]) -> Value:
+        root = Value(ValueTag.Namespace, "root")
+        for i in order:
+            var = Value(ValueTag.Variable, "x", 0)
+            var.children = [Value(ValueTag.BaseType, "int", i)]
+            root.children.append(var)
+        return root
+
+    # Equal keys are ordered by structure, not by the input order
+    left = make([1, 2, 4])
+    right = make([4, 1, 2])
+    left.sort()
+    right.sort()
+    assert [c.children[0].value for c in left.children] == [c.children[0].value for c in right.children]